@@ -0,0 +1,512 @@
+# bench_db_hot_paths.py - pytest-benchmark suite for the bot's database hot paths
+"""
+Times the SQL behind the busiest bot paths against a seeded local Postgres:
+
+  link resolution     _handle_link_access for file and group links
+  file save           _save_file_to_db into an existing group
+  group file list     _list_group_files
+  my links            _show_my_links
+  stats               _show_detailed_stats
+  file search         _search_files for one owner with BENCH_SEARCH_FILES files, its
+                      EXPLAIN plan (must use the pg_trgm index when installed) and
+                      typo-tolerant matching
+  group deletion      _execute_delete_group on a group with BENCH_DELETE_GROUP_SIZE files
+
+The real FileStoreBot methods are driven with stub queries/messages, so Telegram
+is never contacted and file delivery is skipped; only the database work is timed.
+
+The database named by BENCH_DATABASE_URL is TRUNCATED and reseeded with
+generate_series. BENCH_SCALE=1.0 seeds 10k users, 100k groups, 5M files, 5M file
+links and 100k group links; the default 0.02 is a quick local run. The seed is
+reused while the scale stays the same. The search owner's files (default 100k,
+the /search target of under 50 ms) are seeded on top, independent of the scale.
+
+Never point this at production. Run explicitly and store JSON results:
+    pip install pytest pytest-benchmark
+    BENCH_DATABASE_URL=postgresql://postgres@localhost/filestore_bench BENCH_SCALE=0.2 \\
+        python -m pytest benchmarks/bench_db_hot_paths.py --benchmark-json=bench_db.json
+
+Compare against an earlier run with --benchmark-autosave / --benchmark-compare.
+"""
+import asyncio
+import os
+import random
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+BENCH_DATABASE_URL = os.environ.get("BENCH_DATABASE_URL")
+if not BENCH_DATABASE_URL:
+    pytest.skip("BENCH_DATABASE_URL not set", allow_module_level=True)
+
+BENCH_SCALE = float(os.environ.get("BENCH_SCALE", 0.02))
+BENCH_DELETE_GROUP_SIZE = int(os.environ.get("BENCH_DELETE_GROUP_SIZE", 500))
+BENCH_SEARCH_FILES = int(os.environ.get("BENCH_SEARCH_FILES", 100_000))
+
+FULL_SCALE = {"users": 10_000, "groups": 100_000, "files": 5_000_000}
+SEED_SETTING_KEY = "bench_seed_scale"
+USER_ID_BASE = 10_000_000
+BENCH_OWNER_ID = USER_ID_BASE + 1
+SEARCH_OWNER_ID = USER_ID_BASE - 1  # Outside the seeded users, so only the search seed belongs to it
+SEARCH_GROUPS = 100
+SEARCH_TITLES = ["Nebula", "Harbor", "Quartz", "Meridian", "Falcon", "Lantern", "Cobalt", "Summit",
+                 "Orchid", "Tundra", "Vertex", "Willow", "Ember", "Glacier", "Mosaic", "Pioneer",
+                 "Raven", "Sapphire", "Timber", "Zephyr"]
+
+os.environ["SUPABASE_URL"] = BENCH_DATABASE_URL
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("STORAGE_CHANNEL_ID", "-1000000000001")
+os.environ.setdefault("BOT_USERNAME", "bench_filestore_bot")
+os.environ.setdefault("ADMIN_IDS", "1,2")
+os.environ.setdefault("ADMIN_CONTACT", "@bench")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import logging  # noqa: E402
+
+import psycopg2  # noqa: E402
+
+import filecloudsupabaseX as filestore  # noqa: E402
+
+filestore.logger.setLevel(logging.WARNING)
+
+
+# ---------------- seeding ----------------
+
+def _seed_counts() -> dict:
+    return {name: max(int(count * BENCH_SCALE), 1) for name, count in FULL_SCALE.items()}
+
+
+def seed_database() -> dict:
+    """(Re)seed the benchmark database unless it already holds this scale"""
+    filestore.init_database()
+    counts = _seed_counts()
+
+    conn = psycopg2.connect(BENCH_DATABASE_URL)
+    cursor = conn.cursor()
+    cursor.execute("SELECT value FROM bot_settings WHERE key = %s", (SEED_SETTING_KEY,))
+    row = cursor.fetchone()
+    if row and row[0] == str(BENCH_SCALE):
+        conn.close()
+        return counts
+
+    cursor.execute("TRUNCATE file_links, files, groups, authorized_users, bot_sessions RESTART IDENTITY CASCADE")
+    cursor.execute("""
+        INSERT INTO authorized_users (user_id, username, first_name, added_by, is_active)
+        SELECT %(base)s + u, 'user' || u, 'User ' || u, 1, 1
+        FROM generate_series(1, %(users)s) u
+    """, dict(counts, base=USER_ID_BASE))
+
+    # Group g belongs to user (g % users) + 1; file i goes to group (i % groups) + 1
+    cursor.execute("""
+        INSERT INTO groups (name, owner_id, created_at)
+        SELECT 'group_' || g, %(base)s + (g %% %(users)s) + 1, NOW() - (g %% 365) * INTERVAL '1 day'
+        FROM generate_series(1, %(groups)s) g
+    """, dict(counts, base=USER_ID_BASE))
+    cursor.execute("""
+        INSERT INTO files (group_id, serial_number, unique_id, file_name, file_type, file_size,
+                           telegram_file_id, uploader_id, uploader_username, uploaded_at,
+                           storage_channel_id, storage_message_id, file_unique_id)
+        SELECT (i %% %(groups)s) + 1,
+               (i / %(groups)s) + 1,
+               'bf' || i,
+               'Movie.' || (i %% 997) || '.S' || (i %% 12) || 'E' || (i %% 24) || '.1080p.mkv',
+               CASE WHEN i %% 10 = 0 THEN 'video' ELSE 'document' END,
+               1048576 + (i %% 2048) * 4096,
+               'BQACAgQAAx' || md5(i::text),
+               %(base)s + ((i %% %(groups)s) + 1) %% %(users)s + 1,
+               'user' || (((i %% %(groups)s) + 1) %% %(users)s + 1),
+               NOW() - (i %% 365) * INTERVAL '1 day',
+               %(channel)s,
+               i,
+               'uniq' || i
+        FROM generate_series(1, %(files)s) i
+    """, dict(counts, base=USER_ID_BASE, channel=filestore.STORAGE_CHANNEL_ID))
+    # total_files/total_size/last_serial are filled in by the files triggers
+    # One link per file (every 20th revoked) and one per group
+    cursor.execute("""
+        INSERT INTO file_links (link_code, link_type, file_id, owner_id, created_at, clicks, is_active)
+        SELECT 'bfl' || f.id, 'file', f.id, g.owner_id, f.uploaded_at, f.id % 100,
+               CASE WHEN f.id % 20 = 0 THEN 0 ELSE 1 END
+        FROM files f JOIN groups g ON g.id = f.group_id
+    """)
+    cursor.execute("""
+        INSERT INTO file_links (link_code, link_type, group_id, owner_id, created_at, clicks, is_active)
+        SELECT 'bgl' || g.id, 'group', g.id, g.owner_id, g.created_at, g.id % 1000, 1
+        FROM groups g
+    """)
+    cursor.execute("""
+        INSERT INTO bot_settings (key, value) VALUES (%s, %s)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = CURRENT_TIMESTAMP
+    """, (SEED_SETTING_KEY, str(BENCH_SCALE)))
+    conn.commit()
+
+    conn.autocommit = True
+    conn.cursor().execute("VACUUM ANALYZE")
+    conn.close()
+    return counts
+
+
+def seed_search_owner() -> int:
+    """Give SEARCH_OWNER_ID BENCH_SEARCH_FILES files with varied names, unless already there"""
+    conn = psycopg2.connect(BENCH_DATABASE_URL)
+    cursor = conn.cursor()
+    cursor.execute("SELECT COALESCE(SUM(total_files), 0) FROM groups WHERE owner_id = %s", (SEARCH_OWNER_ID,))
+    if cursor.fetchone()[0] == BENCH_SEARCH_FILES:
+        conn.close()
+        return BENCH_SEARCH_FILES
+
+    cursor.execute("DELETE FROM groups WHERE owner_id = %s", (SEARCH_OWNER_ID,))
+    cursor.execute("""
+        INSERT INTO groups (name, owner_id) SELECT 'search_group_' || g, %s FROM generate_series(1, %s) g
+    """, (SEARCH_OWNER_ID, SEARCH_GROUPS))
+    # 20 titles x 10 seasons x 24 episodes x 3 qualities x 2 containers, plus a running number
+    cursor.execute("""
+        INSERT INTO files (group_id, serial_number, unique_id, file_name, file_type, file_size,
+                           telegram_file_id, uploader_id, storage_channel_id, storage_message_id)
+        SELECT g.id, (i / %(groups)s) + 1, 'bs' || i,
+               (%(titles)s::text[])[1 + i %% 20] || '.S' || lpad((1 + i / 20 %% 10)::text, 2, '0')
+                   || 'E' || lpad((1 + i / 200 %% 24)::text, 2, '0')
+                   || '.' || (ARRAY['720p', '1080p', '2160p'])[1 + i / 4800 %% 3]
+                   || '.part' || i || (ARRAY['.mkv', '.mp4'])[1 + i / 14400 %% 2],
+               'document', 1048576, 'BQACAgQAAxsearch' || i, %(owner)s, %(channel)s, 10000000 + i
+        FROM generate_series(0, %(files)s - 1) i
+        JOIN groups g ON g.owner_id = %(owner)s AND g.name = 'search_group_' || (1 + i %% %(groups)s)
+    """, {"titles": SEARCH_TITLES, "groups": SEARCH_GROUPS, "owner": SEARCH_OWNER_ID,
+          "channel": filestore.STORAGE_CHANNEL_ID, "files": BENCH_SEARCH_FILES})
+    conn.commit()
+    conn.autocommit = True
+    conn.cursor().execute("ANALYZE files")
+    conn.cursor().execute("ANALYZE groups")
+    conn.close()
+    return BENCH_SEARCH_FILES
+
+
+# ---------------- stubs ----------------
+
+class StubMessage:
+    """Collects reply texts instead of sending them"""
+
+    def __init__(self):
+        self.texts = []
+
+    async def reply_text(self, text, **kwargs):
+        self.texts.append(text)
+
+
+class StubQuery:
+    """CallbackQuery stand-in for the callback-driven methods"""
+
+    def __init__(self, user_id: int):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.message = StubMessage()
+        self.texts = self.message.texts
+
+    async def edit_message_text(self, text, **kwargs):
+        self.texts.append(text)
+
+
+class StubBot:
+    async def get_chat(self, chat_id):
+        return SimpleNamespace(id=chat_id, username=f"user{chat_id}")
+
+
+def assert_no_error(texts):
+    """The methods swallow exceptions into an error reply; fail the benchmark instead"""
+    assert texts and not any(text.startswith(("Error", "An error")) for text in texts), texts
+
+
+@pytest.fixture(scope="module")
+def seed():
+    counts = seed_database()
+    conn = psycopg2.connect(BENCH_DATABASE_URL)
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, owner_id FROM groups WHERE name LIKE %s ORDER BY id", ("group\\_%",))
+    groups = cursor.fetchall()
+    conn.close()
+    return {"counts": counts, "groups": groups, "owners": sorted({owner for _, owner in groups})}
+
+
+@pytest.fixture(scope="module")
+def search_seed(seed):
+    return seed_search_owner()
+
+
+@pytest.fixture(scope="module")
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="module")
+def bot(seed):
+    # Skip __init__: no listener thread, job queue or Telegram connection is needed
+    bot = filestore.FileStoreBot.__new__(filestore.FileStoreBot)
+    bot.background = []  # Coroutines the bot hands to application.create_task
+    bot.app = SimpleNamespace(bot=StubBot(), create_task=bot.background.append)
+    bot.deleting_groups = set()
+    bot.link_filter = filestore.LinkCodeFilter(BENCH_DATABASE_URL, filestore.PgNotificationListener(BENCH_DATABASE_URL))
+    bot.link_filter.rebuild()
+    bot.db_breaker = filestore.CircuitBreaker("Database", filestore.DB_BREAKER_FAILURES, filestore.DB_BREAKER_COOLDOWN)
+    bot.link_snapshot = None  # Lookups are timed against the database only
+    bot.pages = filestore.PageCache()
+    bot.callback_state = filestore.CallbackState(b"bench")
+    delivered = []
+
+    async def forward_single_file(update, telegram_file_id, *args, **kwargs):
+        delivered.append(telegram_file_id)
+        update.message.texts.append("delivered")
+
+    async def forward_group_files(update, group_id, group_name, *args, **kwargs):
+        delivered.append(group_id)
+        update.message.texts.append("delivered")
+
+    bot._forward_single_file = forward_single_file
+    bot._forward_group_files = forward_group_files
+    return bot
+
+
+@pytest.fixture
+def rng():
+    # Same key sequence on every run so results stay comparable
+    return random.Random(42)
+
+
+# ---------------- benchmarks ----------------
+
+def _link_update(user_id: int):
+    return SimpleNamespace(message=StubMessage(), effective_chat=SimpleNamespace(id=user_id),
+                           effective_user=SimpleNamespace(id=user_id))
+
+
+def test_link_resolution_file(benchmark, seed, loop, bot, rng):
+    files = seed["counts"]["files"]
+
+    def resolve():
+        file_id = rng.randint(1, files)
+        if file_id % 20 == 0:
+            file_id += 1  # Every 20th link is revoked; time the delivering path
+        update = _link_update(USER_ID_BASE + rng.randint(1, 10_000))
+        loop.run_until_complete(bot._handle_link_access(update, None, f"bfl{min(file_id, files)}"))
+        return update.message.texts
+
+    assert_no_error(benchmark(resolve))
+
+
+def test_link_resolution_group(benchmark, seed, loop, bot, rng):
+    groups = seed["counts"]["groups"]
+
+    def resolve():
+        update = _link_update(USER_ID_BASE + rng.randint(1, 10_000))
+        loop.run_until_complete(bot._handle_link_access(update, None, f"bgl{rng.randint(1, groups)}"))
+        return update.message.texts
+
+    assert_no_error(benchmark(resolve))
+
+
+def test_link_resolution_missing(benchmark, seed, loop, bot, rng):
+    # Unknown codes are answered by the link filter; about 1% still reach the database
+    def resolve():
+        update = _link_update(USER_ID_BASE + 1)
+        loop.run_until_complete(bot._handle_link_access(update, None, f"missing{rng.randint(1, 10**9)}"))
+        return update.message.texts
+
+    texts = benchmark(resolve)
+    assert texts and texts[0].startswith("Invalid or Expired Link")
+
+
+def test_save_file_to_db(benchmark, seed, loop, bot):
+    group_name = "bench_save_target"
+    file_obj = SimpleNamespace(file_id="BQACAgQAAxbenchsave")
+    counter = iter(range(10**9))
+
+    def save():
+        n = next(counter)
+        return loop.run_until_complete(bot._save_file_to_db(
+            BENCH_OWNER_ID, group_name, file_obj, "document", f"bench_save_{n}.bin", 4096,
+            file_unique_id=f"bench_save_{n}"))
+
+    try:
+        file_id, serial_number, _ = benchmark(save)
+        assert file_id and serial_number
+    finally:
+        conn = psycopg2.connect(BENCH_DATABASE_URL)
+        conn.cursor().execute("DELETE FROM groups WHERE name = %s AND owner_id = %s", (group_name, BENCH_OWNER_ID))
+        conn.commit()
+        conn.close()
+
+
+def test_list_group_files(benchmark, seed, loop, bot, rng):
+    groups = seed["groups"]
+
+    def list_files():
+        group_id, owner_id = rng.choice(groups)
+        query = StubQuery(owner_id)
+        loop.run_until_complete(bot._list_group_files(query, f"list_group_files_{group_id}"))
+        return query.texts
+
+    assert_no_error(benchmark(list_files))
+
+
+def test_show_my_links(benchmark, seed, loop, bot, rng):
+    owners = seed["owners"]
+
+    def show_links():
+        query = StubQuery(rng.choice(owners))
+        loop.run_until_complete(bot._show_my_links(query, query.from_user.id))
+        return query.texts
+
+    assert_no_error(benchmark(show_links))
+
+
+def test_detailed_stats(benchmark, seed, loop, bot):
+    def stats():
+        message = StubMessage()
+        loop.run_until_complete(bot._show_detailed_stats(message))
+        return message.texts
+
+    assert_no_error(benchmark(stats))
+
+
+# A specific episode, a title (1 in 20 files), a substring inside names, a typo'd title, no match
+SEARCH_QUERIES = ["Nebula.S03E07", "Harbor", "2160p", "Meridain", "zzqx"]
+
+
+def test_search_files(benchmark, search_seed, bot, rng):
+    def search():
+        return bot._search_files(SEARCH_OWNER_ID, rng.choice(SEARCH_QUERIES), filestore.SEARCH_PAGE_SIZE + 1)
+
+    # Enough rounds for a stable p95 over the mix of queries
+    benchmark.pedantic(search, rounds=200, iterations=1)
+    timings = sorted(benchmark.stats.stats.data)
+    benchmark.extra_info["files"] = search_seed
+    benchmark.extra_info["pg_trgm"] = filestore.TRGM_AVAILABLE
+    benchmark.extra_info["p50_ms"] = round(timings[len(timings) // 2] * 1000, 2)
+    benchmark.extra_info["p95_ms"] = round(timings[int(len(timings) * 0.95)] * 1000, 2)
+    assert bot._search_files(SEARCH_OWNER_ID, "Nebula.S03E07", 5)
+    if filestore.TRGM_AVAILABLE:
+        assert benchmark.extra_info["p95_ms"] < 50, benchmark.extra_info
+
+
+def test_search_fuzzy(search_seed, bot):
+    if not filestore.TRGM_AVAILABLE:
+        pytest.skip("pg_trgm is not installed on this server; /search only finds substrings")
+    rows = bot._search_files(SEARCH_OWNER_ID, "Meridain", filestore.SEARCH_PAGE_SIZE)
+    assert rows and all("Meridian" in row[2] for row in rows), rows
+
+
+def test_search_ranks_capped(search_seed, bot):
+    # "2160p" matches a third of the files; only the newest SEARCH_RANK_CANDIDATES are ranked
+    rows = bot._search_files(SEARCH_OWNER_ID, "2160p", search_seed)
+    assert len(rows) == min(filestore.SEARCH_RANK_CANDIDATES, search_seed // 3)
+
+
+class ExplainConnection:
+    """Runs the statements of the wrapped connection under EXPLAIN ANALYZE"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self):
+        cursor = self.conn.cursor()
+        def execute(sql, params=None):
+            if sql.lstrip().upper().startswith("SELECT"):
+                sql = "EXPLAIN (ANALYZE, COSTS OFF) " + sql
+            cursor.execute(sql, params)
+
+        return SimpleNamespace(execute=execute, fetchall=cursor.fetchall)
+
+    def close(self):
+        self.conn.close()
+
+
+@pytest.mark.parametrize("search_text", SEARCH_QUERIES)
+def test_search_plan(search_seed, bot, monkeypatch, search_text):
+    # Not timed: prints the plan of the exact /search statement (run with -s to see it)
+    get_db_connection = filestore.get_db_connection
+    monkeypatch.setattr(filestore, "get_db_connection", lambda *a, **k: ExplainConnection(get_db_connection(*a, **k)))
+    plan = "\n".join(row[0] for row in bot._search_files(SEARCH_OWNER_ID, search_text, filestore.SEARCH_PAGE_SIZE + 1))
+    print(f"\n/search {search_text!r} over {search_seed} files:\n{plan}")
+    if not filestore.TRGM_AVAILABLE:
+        pytest.skip("pg_trgm is not installed on this server; /search runs unindexed")
+    if len(search_text) >= 3:
+        assert "idx_files_file_name_trgm" in plan, plan
+
+
+def _run_background(loop, bot):
+    while bot.background:
+        loop.run_until_complete(bot.background.pop(0))
+
+
+def _create_delete_group(n: int) -> int:
+    """A fresh group with files and links to delete (untimed)"""
+    conn = psycopg2.connect(BENCH_DATABASE_URL)
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO groups (name, owner_id) VALUES (%s, %s) RETURNING id
+    """, (f"bench_delete_{n}", BENCH_OWNER_ID))
+    group_id = cursor.fetchone()[0]
+    cursor.execute("""
+        INSERT INTO files (group_id, serial_number, unique_id, file_name, file_type, file_size,
+                           telegram_file_id, uploader_id, storage_channel_id, storage_message_id, file_unique_id)
+        SELECT %(group_id)s, s, 'bd' || %(group_id)s || '_' || s, 'delete_me_' || s || '.bin', 'document', 4096,
+               'BQACAgQAAxdelete' || s, %(owner)s, %(channel)s, s, 'bench_delete_' || %(group_id)s || '_' || s
+        FROM generate_series(1, %(size)s) s
+    """, {"group_id": group_id, "owner": BENCH_OWNER_ID, "size": BENCH_DELETE_GROUP_SIZE,
+          "channel": filestore.STORAGE_CHANNEL_ID})
+    cursor.execute("""
+        INSERT INTO file_links (link_code, link_type, file_id, owner_id)
+        SELECT 'bdl' || id, 'file', id, %s FROM files WHERE group_id = %s
+    """, (BENCH_OWNER_ID, group_id))
+    cursor.execute("""
+        INSERT INTO file_links (link_code, link_type, group_id, owner_id) VALUES (%s, 'group', %s, %s)
+    """, (f"bdg{group_id}", group_id, BENCH_OWNER_ID))
+    conn.commit()
+    conn.close()
+    return group_id
+
+
+def test_delete_group(benchmark, seed, loop, bot):
+    # What the user waits for: the group is hidden, its files are removed in the background
+    counter = iter(range(10**9))
+
+    def create_group():
+        _run_background(loop, bot)
+        group_id = _create_delete_group(next(counter))
+        return (StubQuery(BENCH_OWNER_ID), f"confirm_delete_group_{group_id}"), {}
+
+    def delete_group(query, data):
+        loop.run_until_complete(bot._execute_delete_group(query, data))
+        return query.texts
+
+    texts = benchmark.pedantic(delete_group, setup=create_group, rounds=20, iterations=1)
+    _run_background(loop, bot)
+    assert texts and "deleted successfully" in texts[0], texts
+
+
+def test_delete_group_background(benchmark, seed, loop, bot, monkeypatch):
+    # Time the chunked removal itself, without the pause between chunks
+    monkeypatch.setattr(filestore, "GROUP_DELETE_CHUNK_DELAY", 0)
+    counter = iter(range(10**9))
+
+    def create_group():
+        group_id = _create_delete_group(10**6 + next(counter))
+        conn = psycopg2.connect(BENCH_DATABASE_URL)
+        conn.cursor().execute("UPDATE groups SET deleted_at = NOW() WHERE id = %s", (group_id,))
+        conn.commit()
+        conn.close()
+        return (group_id,), {}
+
+    def remove_files(group_id):
+        loop.run_until_complete(bot._run_group_deletion(group_id))
+        return group_id
+
+    group_id = benchmark.pedantic(remove_files, setup=create_group, rounds=20, iterations=1)
+    conn = psycopg2.connect(BENCH_DATABASE_URL)
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM groups WHERE id = %s", (group_id,))
+    assert cursor.fetchone()[0] == 0
+    conn.close()
@@ -3,28 +3,48 @@ import asyncio
 import os
 import uuid
 import base64
+import hashlib
+import hmac
+import json
 import logging
-from datetime import datetime, timedelta
+import math
+import re
+import select
+import time
+from collections import OrderedDict, defaultdict, deque
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Optional, Tuple, Any
+from typing import Optional, Tuple, Any, Iterable
 
 # Imports for Health Check Server
 import http.server
 import socketserver
+import sqlite3
 import threading
 
 # Import psycopg2 for PostgreSQL (Supabase)
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
 
 from telegram import (
-    Update, InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery
+    Bot, Update, InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery,
+    InlineQueryResultCachedDocument, InlineQueryResultCachedVideo, InlineQueryResultCachedPhoto,
+    InlineQueryResultCachedAudio, InlineQueryResultCachedVoice
 )
 from telegram.ext import (
     Application, ApplicationBuilder, ContextTypes,
-    CommandHandler, MessageHandler, filters, CallbackQueryHandler,
-    JobQueue # Import JobQueue explicitly for manual instantiation
+    CommandHandler, MessageHandler, filters, CallbackQueryHandler, InlineQueryHandler, TypeHandler,
+    JobQueue, # Import JobQueue explicitly for manual instantiation
+    BaseUpdateProcessor
 )
-from telegram.error import BadRequest # Import BadRequest for specific error handling
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter # Import BadRequest for specific error handling
+
+# Telethon (MTProto) is used where the Bot API has no bulk equivalent: reading the
+# storage channel by message id and deleting up to 100 posts per request
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError
+from telethon.sessions import StringSession
 
 ###############################################################################
 # 1 — CONFIGURATION (MODIFIED TO USE ENVIRONMENT VARIABLES)
@@ -36,6 +56,14 @@ if not STORAGE_CHANNEL_ID:
     raise RuntimeError("❌ STORAGE_CHANNEL_ID not found. Please set it in Railway Variables.")
 
 STORAGE_CHANNEL_ID = int(STORAGE_CHANNEL_ID)
+
+# Storage shards: new files are spread over these channels so ingest is not bound to one
+# channel's rate limit. STORAGE_CHANNEL_ID is always part of the set.
+STORAGE_CHANNEL_IDS = list(dict.fromkeys(
+    [STORAGE_CHANNEL_ID] + [int(x) for x in os.environ.get("STORAGE_CHANNEL_IDS", "").split(",") if x.strip()]
+))
+# How a shard is picked for each upload: "round_robin" or "least_load"
+STORAGE_PLACEMENT = os.environ.get("STORAGE_PLACEMENT", "round_robin")
 BOT_USERNAME = os.environ.get("BOT_USERNAME") # Read from environment variable
 
 # Admin Configuration
@@ -49,8 +77,99 @@ CUSTOM_CAPTION = os.environ.get("CUSTOM_CAPTION", "t.me/movieandwebserieshub") #
 # Use 8000 as a fallback for local testing if PORT is not set.
 HEALTH_CHECK_PORT = int(os.environ.get("PORT", 8000))
 
+# Telethon API credentials (https://my.telegram.org). Storage reconciliation is disabled without them.
+API_ID = int(os.environ.get("API_ID") or 0)
+API_HASH = os.environ.get("API_HASH")
+# Optional Telethon StringSession; when unset the session is kept in bot_settings
+TELETHON_SESSION = os.environ.get("TELETHON_SESSION")
+
+# Storage channel reconciliation: seconds between automatic passes (0 = only via /reconcile)
+RECONCILE_INTERVAL = int(os.environ.get("RECONCILE_INTERVAL", 0))
+# Posts and rows younger than this are left alone, their upload may still be in flight
+RECONCILE_GRACE_SECONDS = 3600
+# Messages fetched/deleted per MTProto request (Telegram's limit is 100) and the pause between requests
+RECONCILE_BATCH_SIZE = 100
+RECONCILE_BATCH_DELAY = 1.0
+# Seconds between drains of the storage_gc_queue (posts of deleted files)
+STORAGE_GC_INTERVAL = 300
+# Pause between 100-message batches of /importchannel
+IMPORT_BATCH_DELAY = 0.3
+# /broadcast: messages per second, recipients per checkpoint, sends in flight and seconds between progress edits.
+# Broadcasts also draw on the main bot's DELIVERY_RATE_PER_BOT budget, but only while half of it is left.
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 15))
+BROADCAST_BATCH_SIZE = 100
+BROADCAST_CONCURRENCY = 8
+BROADCAST_PROGRESS_INTERVAL = 15
+
+# Extra bot tokens that share file delivery with the main bot (comma separated).
+# Helpers must be members of the storage channels; they reach users who have started them.
+HELPER_BOT_TOKENS = [token.strip() for token in os.environ.get("HELPER_BOT_TOKENS", "").split(",") if token.strip()]
+# Messages per second each delivery bot may send (Telegram allows about 30 per bot)
+DELIVERY_RATE_PER_BOT = float(os.environ.get("DELIVERY_RATE_PER_BOT", 25))
+
+# Deep-link (/start <code>) throttling as "<requests>/<seconds>" sliding windows
+LINK_LIMIT_PER_USER = os.environ.get("LINK_LIMIT_PER_USER", "6/60")
+LINK_LIMIT_PER_LINK = os.environ.get("LINK_LIMIT_PER_LINK", "300/60")
+LINK_LIMIT_GLOBAL = os.environ.get("LINK_LIMIT_GLOBAL", "1500/60")
+# The same link opened again by the same user within this many seconds is not delivered twice
+LINK_DUPLICATE_WINDOW = 30
+# Seconds between rebuilds of the in-memory filter of valid link codes
+LINK_FILTER_REBUILD_INTERVAL = 3600
+
+# Delivered files are deleted from the recipient's chat after this many seconds
+AUTO_DELETE_SECONDS = int(os.environ.get("AUTO_DELETE_SECONDS", 600))
+# Group link delivery manifests kept in memory, and whether they are also stored in group_manifests
+GROUP_MANIFEST_CACHE_SIZE = 256
+GROUP_MANIFEST_PERSIST = os.environ.get("GROUP_MANIFEST_PERSIST", "1") == "1"
+# Deleted groups are hidden at once and their files removed in the background in chunks of this size
+GROUP_DELETE_CHUNK_SIZE = 1000
+GROUP_DELETE_CHUNK_DELAY = 0.2
+# Files per page in the multi-select delete view
+FILE_SELECT_PAGE_SIZE = 20
+# Telegram's limits for one message; longer listings are split into pages at record boundaries
+MESSAGE_TEXT_LIMIT = 4096
+MESSAGE_BUTTON_LIMIT = 100
+PAGE_CACHE_SIZE = 256
+# Button state too large to sign into callback_data is kept in memory this long
+CALLBACK_STATE_TTL = 24 * 3600
+CALLBACK_STATE_MAX_ENTRIES = 50_000
+# Group file counters are kept by triggers; a periodic pass repairs any drift, this many groups per transaction
+GROUP_RECONCILE_INTERVAL = 6 * 3600
+GROUP_RECONCILE_BATCH_SIZE = 200
+# Expired links are deactivated by a periodic sweep in batches of this size
+LINK_SWEEP_INTERVAL = 300
+LINK_SWEEP_BATCH_SIZE = 1000
+
+# Local SQLite snapshot of servable links, used while the database is failing ('' disables it)
+LINK_SNAPSHOT_PATH = os.environ.get("LINK_SNAPSHOT_PATH", "link_snapshot.db")
+LINK_SNAPSHOT_REFRESH_INTERVAL = 60
+# A snapshot not refreshed for this long is rebuilt (its change log entries may be pruned)
+LINK_SNAPSHOT_MAX_AGE = 12 * 3600
+# Statement timeout (ms) for refresh queries, so a hanging database cannot stall a refresh indefinitely
+LINK_SNAPSHOT_STATEMENT_TIMEOUT = 30_000
+# Link lookups switch to the snapshot after this many consecutive failed or timed out
+# database lookups, and try the database again after the cooldown
+DB_BREAKER_FAILURES = 3
+DB_BREAKER_COOLDOWN = 30
+LINK_LOOKUP_TIMEOUT = 3.0
+
 # Supabase Configuration
 SUPABASE_URL = os.environ.get("SUPABASE_URL")  # Full PostgreSQL connection string
+# Optional read replica for link lookups, listings and stats; the primary keeps all writes
+SUPABASE_READ_URL = os.environ.get("SUPABASE_READ_URL")
+# Reads go back to the primary while the replica lags more than this many seconds (checked every 10s)
+READ_REPLICA_MAX_LAG = float(os.environ.get("READ_REPLICA_MAX_LAG", 5))
+READ_REPLICA_CHECK_INTERVAL = 10
+# A user's reads stay on the primary for this many seconds after they wrote (read-your-writes)
+READ_YOUR_WRITES_WINDOW = 30
+# "direct": session connections, hot statements are PREPAREd once per pooled connection.
+# "transaction": behind PgBouncer/Supavisor in transaction mode, no session state is relied on
+DB_POOL_MODE = os.environ.get("DB_POOL_MODE", "direct")
+# Idle connections kept per database for reuse
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+DB_CONNECT_TIMEOUT = 5
+# Non-pooler connection string for LISTEN/NOTIFY and advisory locks (defaults to SUPABASE_URL)
+SUPABASE_DIRECT_URL = os.environ.get("SUPABASE_DIRECT_URL") or SUPABASE_URL
 
 # Database and limits - RESTORED TO ORIGINAL 2GB LIMIT
 MAX_FILE_SIZE = 2000 * 1024 * 1024  # 2GB (RESTORED ORIGINAL LIMIT)
@@ -58,6 +177,37 @@ MAX_FILE_SIZE = 2000 * 1024 * 1024  # 2GB (RESTORED ORIGINAL LIMIT)
 # Bulk Upload Delay (in seconds)
 BULK_UPLOAD_DELAY = 1.5
 
+# File search results per page
+SEARCH_PAGE_SIZE = 10
+# Minimum word similarity (0-1) for a fuzzy, typo-tolerant file name match
+SEARCH_FUZZY_THRESHOLD = float(os.environ.get("SEARCH_FUZZY_THRESHOLD", 0.5))
+# Only the newest this many matches are ranked, so broad queries stay fast
+SEARCH_RANK_CANDIDATES = 200
+# Set to False by init_database when the pg_trgm extension cannot be enabled
+TRGM_AVAILABLE = True
+
+# Inline mode (@bot query): results per page, how long answers are cached, and how
+# long to wait for the user to stop typing before querying the database
+INLINE_PAGE_SIZE = 20
+INLINE_CACHE_SECONDS = 60
+INLINE_DEBOUNCE_SECONDS = float(os.environ.get("INLINE_DEBOUNCE_SECONDS", 0.35))
+INLINE_CACHE_MAX_ENTRIES = 2000
+
+# Maximum number of users/chats whose updates are processed at the same time.
+# Updates from the same user/chat are handled strictly in order, one at a time.
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", 64))
+
+# Session state (bulk uploads, single uploads, caption edits) lives in Postgres
+# so any replica can serve any update. Idle sessions expire after SESSION_TTL seconds.
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 3600))
+# Upper bound on how long a replica trusts its in-process copy of a session
+SESSION_CACHE_SECONDS = 300
+
+# Webhook mode (required for running more than one replica). Polling is used when unset.
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # Public base URL, e.g. https://bot.example.com
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8443))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+
 ###############################################################################
 # 2 — ENHANCED LOGGING SYSTEM
 ###############################################################################
@@ -67,8 +217,6 @@ def clear_console():
 
 def setup_logging():
     """Setup logging with Windows compatibility"""
-    clear_console()
-
     logger = logging.getLogger("FileStoreBot")
     logger.setLevel(logging.INFO)
 
@@ -107,13 +255,227 @@ def setup_logging():
 
 logger = setup_logging()
 
+###############################################################################
+# 2A — DATABASE CONNECTIONS (POOLS, PREPARED STATEMENTS, READ REPLICA)
+###############################################################################
+class BotConnection(psycopg2.extensions.connection):
+    """psycopg2 connection that remembers the statements it has PREPAREd"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.last_used = time.monotonic()
+
+class PooledConnection:
+    """Wraps a pooled connection; close() hands it back to the pool instead of closing it"""
+
+    def __init__(self, conn: BotConnection, pool: "ConnectionPool"):
+        self._conn = conn
+        self._pool = pool
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise psycopg2.InterfaceError("connection already returned to the pool")
+        return getattr(self._conn, name)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.release(conn)
+
+    def __del__(self):
+        self.close()
+
+class ConnectionPool:
+    """Connections to one database, reused across operations.
+
+    Any number can be open at once; up to size idle ones are kept, the newest
+    first. A connection idle for over IDLE_CHECK_AFTER seconds is pinged before
+    reuse, since poolers and firewalls drop idle sessions.
+    """
+
+    IDLE_CHECK_AFTER = 60
+
+    def __init__(self, dsn: str, size: int):
+        self.dsn = dsn
+        self.size = size
+        self.idle = deque()
+        self.lock = threading.Lock()
+
+    def connect(self) -> PooledConnection:
+        while True:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+            if conn is None:
+                conn = psycopg2.connect(self.dsn, connection_factory=BotConnection, connect_timeout=DB_CONNECT_TIMEOUT)
+                break
+            if time.monotonic() - conn.last_used < self.IDLE_CHECK_AFTER or self._alive(conn):
+                break
+            conn.close()
+        return PooledConnection(conn, self)
+
+    def release(self, conn: BotConnection):
+        if not conn.closed and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                conn.close()
+        if not conn.closed:
+            conn.last_used = time.monotonic()
+            with self.lock:
+                if len(self.idle) < self.size:
+                    self.idle.append(conn)
+                    return
+            conn.close()
+
+    @staticmethod
+    def _alive(conn: BotConnection) -> bool:
+        try:
+            conn.cursor().execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+_db_pools = {}
+_db_pools_lock = threading.Lock()
+
+def db_pool(dsn: str) -> ConnectionPool:
+    """The connection pool for a DSN, created on first use"""
+    with _db_pools_lock:
+        if dsn not in _db_pools:
+            _db_pools[dsn] = ConnectionPool(dsn, DB_POOL_SIZE)
+        return _db_pools[dsn]
+
+def execute_prepared(cursor, name: str, sql: str, params: tuple = ()):
+    """Execute a hot statement, PREPAREd once per connection in direct mode.
+
+    Behind a transaction pooler the next transaction may run on another server
+    session, so there the statement is simply executed.
+    """
+    conn = cursor.connection
+    if DB_POOL_MODE != "direct" or not isinstance(conn, BotConnection):
+        cursor.execute(sql, params)
+        return
+    if name not in conn.prepared:
+        # One pass, so the "s" after an escaped "%%" is not taken for a placeholder
+        numbers = iter(range(1, len(params) + 1))
+        statement = re.sub(r"%%|%s", lambda match: "%" if match.group() == "%%" else f"${next(numbers)}", sql)
+        cursor.execute(f"PREPARE {name} AS {statement}")
+        conn.prepared.add(name)  # Prepared statements outlive a rolled back transaction
+    if params:
+        cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cursor.execute(f"EXECUTE {name}")
+
+class ReadReplicaRouter:
+    """Chooses where read-only work runs.
+
+    Reads use the replica while its last lag check was within max_lag and the
+    reading user has not written within the read-your-writes window; anything
+    else, and every write, uses the primary.
+    """
+
+    RECENT_WRITERS_MAX_ENTRIES = 100_000
+
+    def __init__(self, primary_dsn: str, replica_dsn: Optional[str], max_lag: float, ryw_window: float):
+        self.primary_dsn = primary_dsn
+        self.replica_dsn = replica_dsn
+        self.max_lag = max_lag
+        self.ryw_window = ryw_window
+        self.replica_ok = False  # Until the first lag check passes
+        self.recent_writers = OrderedDict()  # user_id -> monotonic time until which reads use the primary
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.replica_dsn)
+
+    def note_write(self, user_id: int):
+        with self.lock:
+            self.recent_writers[user_id] = time.monotonic() + self.ryw_window
+            self.recent_writers.move_to_end(user_id)
+            while len(self.recent_writers) > self.RECENT_WRITERS_MAX_ENTRIES:
+                self.recent_writers.popitem(last=False)
+
+    def read_dsn(self, user_id: Optional[int] = None) -> str:
+        if not self.enabled or not self.replica_ok:
+            return self.primary_dsn
+        if user_id is not None:
+            until = self.recent_writers.get(user_id)
+            if until and until > time.monotonic():
+                return self.primary_dsn
+        return self.replica_dsn
+
+    def mark_down(self, reason):
+        if self.replica_ok:
+            logger.warning(f"Read replica unusable, reading from the primary: {reason}")
+        self.replica_ok = False
+
+    def check(self) -> Optional[float]:
+        """Measure the replica's replay lag and update its state, return the lag in seconds"""
+        if not self.enabled:
+            return None
+        try:
+            conn = psycopg2.connect(self.replica_dsn, connect_timeout=3)
+            try:
+                cursor = conn.cursor()
+                # An idle primary sends no new WAL, so a fully replayed replica counts as current
+                cursor.execute("""
+                    SELECT CASE
+                        WHEN NOT pg_is_in_recovery() THEN 0
+                        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp())
+                    END
+                """)
+                lag = cursor.fetchone()[0]
+            finally:
+                conn.close()
+        except psycopg2.Error as e:
+            self.mark_down(e)
+            return None
+
+        if lag is None or float(lag) > self.max_lag:
+            self.mark_down(f"replication lag {lag}s")
+        elif not self.replica_ok:
+            logger.info(f"Read replica in use (replication lag {float(lag):.1f}s)")
+            self.replica_ok = True
+        return None if lag is None else float(lag)
+
+db_router = ReadReplicaRouter(SUPABASE_URL, SUPABASE_READ_URL, READ_REPLICA_MAX_LAG, READ_YOUR_WRITES_WINDOW)
+
+def get_db_connection(read_only: bool = False, user_id: Optional[int] = None, direct: bool = False):
+    """Get a pooled connection for one operation; close() returns it to the pool.
+
+    read_only work may run on the read replica (see ReadReplicaRouter); user_id
+    names the user a write is for, or whose reads must see their own writes.
+    direct=True opens a dedicated connection that bypasses any transaction
+    pooler, for session state such as advisory locks.
+    """
+    if direct:
+        return psycopg2.connect(SUPABASE_DIRECT_URL)
+    if not read_only:
+        if user_id is not None:
+            db_router.note_write(user_id)
+        return db_pool(SUPABASE_URL).connect()
+
+    dsn = db_router.read_dsn(user_id)
+    try:
+        return db_pool(dsn).connect()
+    except psycopg2.OperationalError as e:
+        if dsn == SUPABASE_URL:
+            raise
+        db_router.mark_down(e)
+        return db_pool(SUPABASE_URL).connect()
+
 ###############################################################################
 # 3 — FIXED DATABASE INITIALIZATION (MODIFIED FOR SUPABASE/POSTGRESQL)
 ###############################################################################
 def init_database():
     """Initialize PostgreSQL database with proper SQL syntax"""
+    global TRGM_AVAILABLE
     try:
-        conn = psycopg2.connect(SUPABASE_URL)
+        conn = get_db_connection()
         cursor = conn.cursor()
 
         # Create tables if not exists (adjusted for PostgreSQL with BIGINT where needed)
@@ -144,6 +506,11 @@ def init_database():
             )
         """)
 
+        # Bumped by the files triggers below; cached group delivery manifests are keyed on it
+        cursor.execute("ALTER TABLE groups ADD COLUMN IF NOT EXISTS manifest_version BIGINT DEFAULT 0")
+        # Set when a group is deleted; the group stays hidden until its files are removed in the background
+        cursor.execute("ALTER TABLE groups ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP")
+
         logger.info("Creating files table...")
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS files (
@@ -164,6 +531,108 @@ def init_database():
             )
         """)
 
+        # Content fingerprint used to reuse storage-channel copies of re-uploaded files
+        cursor.execute("ALTER TABLE files ADD COLUMN IF NOT EXISTS file_unique_id TEXT")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_file_unique_id ON files (file_unique_id)")
+
+        # Channel holding the file's storage post: a storage channel, or the source channel of an import
+        cursor.execute("""
+            SELECT 1 FROM information_schema.columns WHERE table_name = 'files' AND column_name = 'storage_channel_id'
+        """)
+        if not cursor.fetchone():
+            logger.info("Adding files.storage_channel_id...")
+            cursor.execute("ALTER TABLE files ADD COLUMN storage_channel_id BIGINT")
+            cursor.execute("""
+                UPDATE files SET storage_channel_id = %s WHERE storage_message_id IS NOT NULL
+            """, (STORAGE_CHANNEL_ID,))
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_files_storage_post ON files (storage_channel_id, storage_message_id)
+        """)
+
+        # Highest serial number handed out in the group; serials are never reused after deletions
+        cursor.execute("""
+            SELECT 1 FROM information_schema.columns WHERE table_name = 'groups' AND column_name = 'last_serial'
+        """)
+        if not cursor.fetchone():
+            logger.info("Adding groups.last_serial...")
+            cursor.execute("ALTER TABLE groups ADD COLUMN last_serial INTEGER NOT NULL DEFAULT 0")
+            cursor.execute("""
+                UPDATE groups g SET last_serial = s.max_serial
+                FROM (SELECT group_id, MAX(serial_number) AS max_serial FROM files GROUP BY group_id) s
+                WHERE g.id = s.group_id
+            """)
+
+        # The files triggers keep total_files/total_size exact and bump manifest_version:
+        # one UPDATE per statement with the per-group deltas of its transition tables
+        cursor.execute("""
+            CREATE OR REPLACE FUNCTION sync_group_from_files() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    UPDATE groups g SET total_files = g.total_files + d.files, total_size = g.total_size + d.size,
+                                        last_serial = GREATEST(g.last_serial, d.max_serial),
+                                        manifest_version = g.manifest_version + 1
+                    FROM (SELECT group_id, COUNT(*) AS files, COALESCE(SUM(file_size), 0) AS size,
+                                 MAX(serial_number) AS max_serial
+                          FROM new_rows GROUP BY group_id) d
+                    WHERE g.id = d.group_id;
+                ELSIF TG_OP = 'DELETE' THEN
+                    UPDATE groups g SET total_files = g.total_files - d.files, total_size = g.total_size - d.size,
+                                        manifest_version = g.manifest_version + 1
+                    FROM (SELECT group_id, COUNT(*) AS files, COALESCE(SUM(file_size), 0) AS size
+                          FROM old_rows GROUP BY group_id) d
+                    WHERE g.id = d.group_id;
+                ELSE
+                    -- Only rows whose counted or delivered columns changed touch their groups
+                    WITH changed AS (
+                        SELECT o.group_id AS old_group_id, o.file_size AS old_size,
+                               n.group_id, n.file_size, n.serial_number
+                        FROM old_rows o JOIN new_rows n ON n.id = o.id
+                        WHERE (o.group_id, o.serial_number, o.file_name, o.file_type, o.file_size, o.uploader_id,
+                               o.telegram_file_id, o.storage_channel_id, o.storage_message_id)
+                              IS DISTINCT FROM
+                              (n.group_id, n.serial_number, n.file_name, n.file_type, n.file_size, n.uploader_id,
+                               n.telegram_file_id, n.storage_channel_id, n.storage_message_id)
+                    )
+                    UPDATE groups g SET total_files = g.total_files + d.files, total_size = g.total_size + d.size,
+                                        last_serial = GREATEST(g.last_serial, d.max_serial),
+                                        manifest_version = g.manifest_version + 1
+                    FROM (SELECT group_id, SUM(files) AS files, SUM(size) AS size, MAX(max_serial) AS max_serial
+                          FROM (SELECT group_id, 1 AS files, COALESCE(file_size, 0) AS size, serial_number AS max_serial
+                                FROM changed
+                                UNION ALL
+                                SELECT old_group_id, -1, -COALESCE(old_size, 0), 0 FROM changed) changes
+                          GROUP BY group_id) d
+                    WHERE g.id = d.group_id;
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        """)
+        # UPDATE OF <columns> is not allowed with transition tables, hence the OLD/NEW comparison above
+        for event, transition in (("INSERT", "NEW TABLE AS new_rows"), ("DELETE", "OLD TABLE AS old_rows"),
+                                  ("UPDATE", "OLD TABLE AS old_rows NEW TABLE AS new_rows")):
+            cursor.execute(f"DROP TRIGGER IF EXISTS files_manifest_{event.lower()} ON files")
+            cursor.execute(f"""
+                CREATE OR REPLACE TRIGGER files_group_sync_{event.lower()}
+                AFTER {event} ON files REFERENCING {transition}
+                FOR EACH STATEMENT EXECUTE FUNCTION sync_group_from_files()
+            """)
+        cursor.execute("DROP FUNCTION IF EXISTS bump_group_manifest_version()")
+
+        # Trigram index for /search (fuzzy, substring and ranked matching on file names)
+        logger.info("Creating file name search index...")
+        cursor.execute("SAVEPOINT search_index")
+        try:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_files_file_name_trgm
+                ON files USING gin (file_name gin_trgm_ops)
+            """)
+        except Exception as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT search_index")
+            TRGM_AVAILABLE = False
+            logger.warning(f"pg_trgm unavailable, /search will not be indexed or ranked: {e}")
+
         logger.info("Creating file_links table...")
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS file_links (
@@ -181,6 +650,175 @@ def init_database():
             )
         """)
 
+        # File and group deletions cascade into file_links through these
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_links_file_id ON file_links (file_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_links_group_id ON file_links (group_id)")
+
+        # Optional expiry and click budget per link (NULL = unlimited)
+        cursor.execute("ALTER TABLE file_links ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP")
+        cursor.execute("ALTER TABLE file_links ADD COLUMN IF NOT EXISTS max_clicks BIGINT")
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_file_links_expires_at
+            ON file_links (expires_at) WHERE is_active = 1 AND expires_at IS NOT NULL
+        """)
+
+        # Change log the local link snapshots refresh from; xid orders entries by transaction, not commit
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS link_snapshot_changes (
+                id BIGSERIAL PRIMARY KEY,
+                entity TEXT NOT NULL,
+                entity_id TEXT NOT NULL,
+                xid XID8 NOT NULL DEFAULT pg_current_xact_id(),
+                changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_link_snapshot_changes_xid ON link_snapshot_changes (xid)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_link_snapshot_changes_changed_at ON link_snapshot_changes (changed_at)")
+
+        # Every replica keeps an in-memory filter of active link codes up to date from these notifications:
+        # one per statement and action, listing the changed codes ("add:code1,code2,...")
+        cursor.execute("""
+            CREATE OR REPLACE FUNCTION notify_file_links_change() RETURNS trigger AS $$
+            DECLARE
+                added TEXT[];
+                revoked TEXT[];
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    SELECT array_agg(link_code) FILTER (WHERE is_active = 1),
+                           array_agg(link_code) FILTER (WHERE is_active IS DISTINCT FROM 1)
+                    INTO added, revoked FROM new_rows;
+                ELSIF TG_OP = 'DELETE' THEN
+                    SELECT array_agg(link_code) INTO revoked FROM old_rows;
+                ELSE
+                    SELECT array_agg(n.link_code) FILTER (WHERE n.is_active = 1),
+                           array_agg(n.link_code) FILTER (WHERE n.is_active IS DISTINCT FROM 1)
+                    INTO added, revoked
+                    FROM new_rows n JOIN old_rows o ON o.id = n.id
+                    WHERE n.is_active IS DISTINCT FROM o.is_active;
+                END IF;
+
+                INSERT INTO link_snapshot_changes (entity, entity_id)
+                SELECT 'link', link_code FROM unnest(added || revoked) AS link_code;
+                -- Payloads are capped at 8000 bytes: at most 500 twelve-character codes each
+                FOR i IN 1 .. COALESCE(array_length(added, 1), 0) BY 500 LOOP
+                    PERFORM pg_notify('filestore_links', 'add:' || array_to_string(added[i:i + 499], ','));
+                END LOOP;
+                FOR i IN 1 .. COALESCE(array_length(revoked, 1), 0) BY 500 LOOP
+                    PERFORM pg_notify('filestore_links', 'revoke:' || array_to_string(revoked[i:i + 499], ','));
+                END LOOP;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        """)
+        # Transition tables rule out UPDATE OF is_active; the function skips rows whose is_active is unchanged
+        cursor.execute("DROP TRIGGER IF EXISTS file_links_notify ON file_links")
+        for event, transition in (("INSERT", "NEW TABLE AS new_rows"), ("DELETE", "OLD TABLE AS old_rows"),
+                                  ("UPDATE", "OLD TABLE AS old_rows NEW TABLE AS new_rows")):
+            cursor.execute(f"""
+                CREATE OR REPLACE TRIGGER file_links_notify_{event.lower()}
+                AFTER {event} ON file_links REFERENCING {transition}
+                FOR EACH STATEMENT EXECUTE FUNCTION notify_file_links_change()
+            """)
+
+        # File changes bump manifest_version, so group rows cover renames, deletions and content
+        cursor.execute("""
+            CREATE OR REPLACE FUNCTION log_group_snapshot_change() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO link_snapshot_changes (entity, entity_id)
+                VALUES ('group', (CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END)::TEXT);
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        """)
+        cursor.execute("""
+            CREATE OR REPLACE TRIGGER groups_snapshot_change
+            AFTER DELETE OR UPDATE OF manifest_version, name, deleted_at ON groups
+            FOR EACH ROW EXECUTE FUNCTION log_group_snapshot_change()
+        """)
+
+        logger.info("Creating bot_sessions table...")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS bot_sessions (
+                kind TEXT NOT NULL,
+                user_id BIGINT NOT NULL,
+                data JSONB NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                expires_at TIMESTAMP,
+                PRIMARY KEY (kind, user_id)
+            )
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_bot_sessions_expires_at
+            ON bot_sessions (expires_at) WHERE expires_at IS NOT NULL
+        """)
+
+        logger.info("Creating group_manifests table...")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS group_manifests (
+                group_id BIGINT PRIMARY KEY REFERENCES groups(id) ON DELETE CASCADE,
+                version BIGINT NOT NULL,
+                caption_epoch BIGINT NOT NULL,
+                manifest JSONB NOT NULL,
+                built_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        logger.info("Creating storage_gc_queue table...")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS storage_gc_queue (
+                id SERIAL PRIMARY KEY,
+                channel_id BIGINT NOT NULL,
+                message_id BIGINT NOT NULL,
+                enqueued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        # Set while the storage GC deletes the post; such a post must not be reused by deduplication
+        cursor.execute("ALTER TABLE storage_gc_queue ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_storage_gc_queue_post ON storage_gc_queue (channel_id, message_id)")
+
+        logger.info("Creating import_jobs table...")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS import_jobs (
+                id SERIAL PRIMARY KEY,
+                source_channel_id BIGINT NOT NULL,
+                owner_id BIGINT NOT NULL,
+                mapping TEXT NOT NULL,
+                last_message_id BIGINT DEFAULT 0,
+                imported_files INTEGER DEFAULT 0,
+                status TEXT DEFAULT 'running',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        logger.info("Creating broadcasts table...")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id SERIAL PRIMARY KEY,
+                admin_id BIGINT NOT NULL,
+                message_text TEXT,
+                source_chat_id BIGINT,
+                source_message_id BIGINT,
+                progress_chat_id BIGINT,
+                progress_message_id BIGINT,
+                total INTEGER DEFAULT 0,
+                last_user_id BIGINT DEFAULT 0,
+                sent INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                blocked INTEGER DEFAULT 0,
+                status TEXT DEFAULT 'running',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # Imports used to store Telethon's file id as if it were a Bot API one
+        cursor.execute("""
+            UPDATE files SET telegram_file_id = %s || telegram_file_id
+            WHERE storage_channel_id IN (SELECT source_channel_id FROM import_jobs)
+              AND storage_channel_id <> ALL(%s) AND telegram_file_id NOT LIKE %s
+        """, (IMPORTED_FILE_ID_PREFIX, STORAGE_CHANNEL_IDS, IMPORTED_FILE_ID_PREFIX + "%"))
+
         logger.info("Creating bot_settings table...")
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS bot_settings (
@@ -194,6 +832,24 @@ def init_database():
         logger.info("Inserting default bot settings...")
         cursor.execute("INSERT INTO bot_settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO NOTHING", ('caption_enabled', '1'))
         cursor.execute("INSERT INTO bot_settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO NOTHING", ('custom_caption', CUSTOM_CAPTION))
+        cursor.execute("INSERT INTO bot_settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO NOTHING", ('caption_epoch', '0'))
+        cursor.execute("INSERT INTO bot_settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO NOTHING", ('users_version', '0'))
+
+        # Any change to authorized_users bumps users_version, which keys the cached user listings
+        cursor.execute("""
+            CREATE OR REPLACE FUNCTION bump_users_version() RETURNS trigger AS $$
+            BEGIN
+                UPDATE bot_settings SET value = (value::BIGINT + 1)::TEXT, updated_at = CURRENT_TIMESTAMP
+                WHERE key = 'users_version';
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        """)
+        cursor.execute("""
+            CREATE OR REPLACE TRIGGER authorized_users_version
+            AFTER INSERT OR UPDATE OR DELETE ON authorized_users
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_users_version()
+        """)
 
         # Add admins to authorized users
         logger.info(f"Processing ADMIN_IDS: {ADMIN_IDS}")
@@ -230,6 +886,75 @@ def generate_id() -> str:
     """Generate short unique ID"""
     return base64.urlsafe_b64encode(uuid.uuid4().bytes)[:12].decode()
 
+def format_duration(seconds: int) -> str:
+    """Format a duration such as 10 minutes or 2 days"""
+    for unit, length in (("day", 86400), ("hour", 3600), ("minute", 60)):
+        if seconds >= length and seconds % length == 0:
+            count = seconds // length
+            return f"{count} {unit}{'s' if count != 1 else ''}"
+    return f"{seconds} seconds"
+
+def parse_link_options(args: list) -> Tuple[list, Optional[int], Optional[int]]:
+    """Split trailing ttl=<n>[s|m|h|d] and clicks=<n> options off command args.
+
+    Returns (remaining args, ttl seconds or None, max clicks or None); raises
+    ValueError on a malformed or non-positive option.
+    """
+    args = list(args)
+    ttl = max_clicks = None
+    while args and re.match(r"(?i)^(ttl|clicks)=", args[-1]):
+        key, value = args.pop().split("=", 1)
+        if key.lower() == "ttl":
+            match = re.fullmatch(r"(?i)(\d+)([smhd]?)", value)
+            if not match:
+                raise ValueError(f"invalid ttl '{value}'")
+            ttl = int(match.group(1)) * {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}[match.group(2).lower()]
+        else:
+            if not value.isdigit():
+                raise ValueError(f"invalid clicks '{value}'")
+            max_clicks = int(value)
+        if not (ttl if key.lower() == "ttl" else max_clicks):
+            raise ValueError(f"{key} must be positive")
+    return args, ttl, max_clicks
+
+def format_link_limits(ttl: Optional[int], max_clicks: Optional[int]) -> str:
+    """Describe a link's limits for the reply that hands it out"""
+    limits = []
+    if ttl:
+        limits.append(f"expires in {format_duration(ttl)}")
+    if max_clicks:
+        limits.append(f"valid for {max_clicks} click{'s' if max_clicks != 1 else ''}")
+    return f"\n\nThis link {' and '.join(limits)}. ⏳" if limits else ""
+
+def parse_serial_ranges(spec: str, limit: int = 10_000) -> list:
+    """Parse file numbers like "3-40,52" or "3-40 52" into a sorted list; raises ValueError if malformed"""
+    numbers = set()
+    for part in re.split(r"[,\s]+", spec):
+        if not part:
+            continue
+        match = re.fullmatch(r"(\d+)(?:-(\d+))?", part)
+        if not match:
+            raise ValueError(f"invalid file number or range '{part}'")
+        start, end = int(match.group(1)), int(match.group(2) or match.group(1))
+        if start <= 0 or end < start:
+            raise ValueError(f"invalid range '{part}'")
+        if len(numbers) + end - start + 1 > limit:
+            raise ValueError(f"at most {limit} files at once")
+        numbers.update(range(start, end + 1))
+    if not numbers:
+        raise ValueError("no file numbers given")
+    return sorted(numbers)
+
+def format_serial_ranges(serials: Iterable[int]) -> str:
+    """Format serial numbers compactly, e.g. #003-#040, #052"""
+    ranges = []
+    for serial in sorted(serials):
+        if ranges and serial == ranges[-1][1] + 1:
+            ranges[-1][1] = serial
+        else:
+            ranges.append([serial, serial])
+    return ", ".join(f"#{a:03d}" if a == b else f"#{a:03d}-#{b:03d}" for a, b in ranges)
+
 def format_size(size_bytes: int) -> str:
     """Format file size"""
     if size_bytes < 1024:
@@ -241,32 +966,185 @@ def format_size(size_bytes: int) -> str:
     else:
         return f"{size_bytes/(1024**3):.1f} GB"
 
-def extract_file_data(message: Message) -> Tuple[Optional[Any], str, str, int]:
-    """Extract file information from message"""
+def extract_file_data(message: Message) -> Tuple[Optional[Any], str, str, int, str]:
+    """Extract file information from message.
+
+    The last item is Telegram's file_unique_id, which is stable across uploads
+    of the same content and is used to deduplicate storage-channel copies.
+    """
     if message.document:
         doc = message.document
-        return doc, "document", doc.file_name or "document", doc.file_size or 0
+        return doc, "document", doc.file_name or "document", doc.file_size or 0, doc.file_unique_id
     elif message.photo:
         photo = message.photo[-1]
-        return photo, "photo", f"photo_{photo.file_id[:8]}.jpg", photo.file_size or 0
+        return photo, "photo", f"photo_{photo.file_id[:8]}.jpg", photo.file_size or 0, photo.file_unique_id
     elif message.video:
         video = message.video
-        return video, "video", video.file_name or f"video_{video.file_id[:8]}.mp4", video.file_size or 0
+        return video, "video", video.file_name or f"video_{video.file_id[:8]}.mp4", video.file_size or 0, video.file_unique_id
     elif message.audio:
         audio = message.audio
-        return audio, "audio", audio.file_name or f"audio_{audio.file_id[:8]}.mp3", audio.file_size or 0
+        return audio, "audio", audio.file_name or f"audio_{audio.file_id[:8]}.mp3", audio.file_size or 0, audio.file_unique_id
     elif message.voice:
         voice = message.voice
-        return voice, "voice", f"voice_{voice.file_id[:8]}.ogg", voice.file_size or 0
+        return voice, "voice", f"voice_{voice.file_id[:8]}.ogg", voice.file_size or 0, voice.file_unique_id
     elif message.video_note:
         vn = message.video_note
-        return vn, "video_note", f"videonote_{vn.file_id[:8]}.mp4", vn.file_size or 0
-    return None, "", "", 0
+        return vn, "video_note", f"videonote_{vn.file_id[:8]}.mp4", vn.file_size or 0, vn.file_unique_id
+    return None, "", "", 0, ""
+
+def get_bot_setting(key: str, default: Optional[str] = None) -> Optional[str]:
+    """Read a single value from bot_settings"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT value FROM bot_settings WHERE key = %s", (key,))
+        row = cursor.fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else default
+
+def set_bot_setting(key: str, value: str):
+    """Insert or update a single value in bot_settings"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO bot_settings (key, value) VALUES (%s, %s)
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = CURRENT_TIMESTAMP
+        """, (key, str(value)))
+        conn.commit()
+    finally:
+        conn.close()
+
+def deactivate_expired_links(batch_size: int = LINK_SWEEP_BATCH_SIZE) -> int:
+    """Deactivate expired links in batches (walks idx_file_links_expires_at), return how many"""
+    total = 0
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        while True:
+            cursor.execute("""
+                UPDATE file_links SET is_active = 0
+                WHERE id IN (
+                    SELECT id FROM file_links
+                    WHERE is_active = 1 AND expires_at IS NOT NULL AND expires_at <= NOW()
+                    ORDER BY expires_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+            """, (batch_size,))
+            deactivated = cursor.rowcount
+            conn.commit()
+            total += deactivated
+            if deactivated < batch_size:
+                return total
+    finally:
+        conn.close()
+
+def delete_group_files_chunk(group_id: int, chunk_size: int = GROUP_DELETE_CHUNK_SIZE) -> int:
+    """Delete up to chunk_size files of a group in one short transaction, return how many.
+
+    Their storage posts are queued for the storage GC; links go with the files
+    through ON DELETE CASCADE.
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            WITH doomed AS (
+                SELECT id FROM files WHERE group_id = %s
+                ORDER BY serial_number LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ), deleted AS (
+                DELETE FROM files f USING doomed d WHERE f.id = d.id
+                RETURNING f.storage_channel_id, f.storage_message_id
+            ), queued AS (
+                INSERT INTO storage_gc_queue (channel_id, message_id)
+                SELECT DISTINCT storage_channel_id, storage_message_id FROM deleted
+                WHERE storage_channel_id = ANY(%s) AND storage_message_id IS NOT NULL
+            )
+            SELECT COUNT(*) FROM deleted
+        """, (group_id, chunk_size, STORAGE_CHANNEL_IDS))
+        deleted = cursor.fetchone()[0]
+        conn.commit()
+        return deleted
+    finally:
+        conn.close()
+
+def finish_group_deletion(group_id: int) -> bool:
+    """Remove a hidden group once its files are gone, return True if it was removed"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            DELETE FROM groups
+            WHERE id = %s AND deleted_at IS NOT NULL AND NOT EXISTS (SELECT 1 FROM files WHERE group_id = %s)
+        """, (group_id, group_id))
+        removed = cursor.rowcount > 0
+        conn.commit()
+        return removed
+    finally:
+        conn.close()
+
+GROUP_RECONCILE_LOCK_ID = 720_043  # Only one replica reconciles group counters at a time
+
+def reconcile_group_counters(batch_size: int = GROUP_RECONCILE_BATCH_SIZE) -> Tuple[int, int]:
+    """Recount the files of every group in batches and repair drifted counters, return (checked, repaired).
+
+    Each batch first locks its group rows, so uploads in flight for those groups
+    have committed (their triggers lock the same rows) before the recount runs
+    in a fresh snapshot; uploads after the lock wait and apply their delta on
+    top of the repaired value.
+    """
+    conn = get_db_connection(direct=True)
+    checked = repaired = 0
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", (GROUP_RECONCILE_LOCK_ID,))
+        if not cursor.fetchone()[0]:
+            conn.rollback()
+            return 0, 0  # Another replica is reconciling
+        last_id = 0
+        while True:
+            cursor.execute("""
+                SELECT id FROM groups WHERE id > %s ORDER BY id LIMIT %s FOR UPDATE
+            """, (last_id, batch_size))
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                conn.commit()
+                break
+            cursor.execute("""
+                UPDATE groups g SET total_files = a.files, total_size = a.size,
+                                    last_serial = GREATEST(g.last_serial, a.max_serial)
+                FROM (
+                    SELECT g2.id, COUNT(f.id) AS files, COALESCE(SUM(f.file_size), 0) AS size,
+                           COALESCE(MAX(f.serial_number), 0) AS max_serial
+                    FROM groups g2 LEFT JOIN files f ON f.group_id = g2.id
+                    WHERE g2.id = ANY(%s)
+                    GROUP BY g2.id
+                ) a
+                WHERE g.id = a.id
+                  AND (g.total_files IS DISTINCT FROM a.files OR g.total_size IS DISTINCT FROM a.size
+                       OR g.last_serial < a.max_serial)
+                RETURNING g.id
+            """, (ids,))
+            drifted = [row[0] for row in cursor.fetchall()]
+            conn.commit()
+            if drifted:
+                logger.warning(f"Repaired file counters of group(s) {drifted[:20]}")
+            checked += len(ids)
+            repaired += len(drifted)
+            last_id = ids[-1]
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (GROUP_RECONCILE_LOCK_ID,))
+        conn.commit()
+        return checked, repaired
+    finally:
+        conn.close()
 
 def get_caption_setting() -> tuple:
     """Get current caption settings from database"""
     try:
-        conn = psycopg2.connect(SUPABASE_URL)
+        conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute("""
             SELECT key, value FROM bot_settings
@@ -292,7 +1170,7 @@ def get_file_caption(file_name: str, serial_number: int = None, user_id: int = N
     """Generate file caption with user-specific settings"""
     try:
         if user_id and not is_admin(user_id):
-            conn = psycopg2.connect(SUPABASE_URL)
+            conn = get_db_connection()
             cursor = conn.cursor()
             cursor.execute("""
                 SELECT caption_disabled FROM authorized_users WHERE user_id = %s
@@ -315,13 +1193,51 @@ def get_file_caption(file_name: str, serial_number: int = None, user_id: int = N
     except Exception:
         return file_name
 
+def get_caption_context(uploader_ids: Iterable[int]) -> Tuple[bool, str, set]:
+    """Fetch caption settings for a batch of files in one go.
+
+    Returns (caption_enabled, custom_caption, uploader ids with captions disabled).
+    """
+    caption_enabled, custom_caption = get_caption_setting()
+    disabled = set()
+    uploader_ids = [uid for uid in set(uploader_ids) if uid and not is_admin(uid)]
+    if caption_enabled and uploader_ids:
+        try:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT user_id FROM authorized_users WHERE user_id = ANY(%s) AND caption_disabled <> 0
+            """, (uploader_ids,))
+            disabled = {row[0] for row in cursor.fetchall()}
+            conn.close()
+        except Exception:
+            pass
+    return caption_enabled, custom_caption, disabled
+
+def build_file_caption(file_name: str, serial_number: Optional[int], uploader_id: Optional[int], caption_context: Tuple[bool, str, set]) -> str:
+    """Same output as get_file_caption, using settings fetched by get_caption_context"""
+    caption_enabled, custom_caption, disabled = caption_context
+    if not caption_enabled or uploader_id in disabled:
+        return file_name
+    if serial_number:
+        return f"#{serial_number:03d} {file_name}\n\n{custom_caption}"
+    return f"{file_name}\n\n{custom_caption}"
+
+def bump_caption_epoch(cursor):
+    """Mark every cached group manifest stale after a caption setting changed"""
+    cursor.execute("""
+        INSERT INTO bot_settings (key, value) VALUES ('caption_epoch', '1')
+        ON CONFLICT (key) DO UPDATE
+        SET value = (bot_settings.value::BIGINT + 1)::TEXT, updated_at = CURRENT_TIMESTAMP
+    """)
+
 def is_user_authorized(user_id: int) -> bool:
     """Check if user is authorized to use the bot"""
     if is_admin(user_id):
         return True
 
     try:
-        conn = psycopg2.connect(SUPABASE_URL)
+        conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute("""
             SELECT is_active FROM authorized_users
@@ -335,94 +1251,2409 @@ def is_user_authorized(user_id: int) -> bool:
         return False
 
 ###############################################################################
-# 5 — MAIN BOT CLASS WITH COMPLETE WORKING FUNCTIONS
+# 4A — CONCURRENT UPDATE PROCESSING WITH PER-CHAT ORDERING
 ###############################################################################
-class FileStoreBot:
-    def __init__(self, application: Application):
-        self.app = application
-        self.bulk_sessions = {}
-        self.caption_edit_pending = {} # To track pending caption edits
-        init_database()
+def update_ordering_key(update: object) -> Optional[int]:
+    """Return the key whose updates must be processed in order (user, then chat)"""
+    if not isinstance(update, Update):
+        return None
+    if update.inline_query or update.chosen_inline_result:
+        # Stateless and debounced; must not queue behind each other
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently while keeping each user's/chat's updates in order.
+
+    max_concurrent_updates is the number of users/chats served at the same
+    time: the first update of a key takes a processing slot and then runs
+    every update of that key queued behind it, while the later updates hand
+    their slot back at once. One busy user (e.g. a 300-file bulk upload)
+    therefore holds a single slot however many of their updates are queued.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._queues = {}  # key -> deque of handler coroutines waiting behind the running one
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        """Run the handler, or queue it behind the running update of the same key"""
+        key = update_ordering_key(update)
+        if key is None:
+            await coroutine
+            return
 
-    # ================= COMMAND HANDLERS =================
+        queue = self._queues.get(key)
+        if queue is not None:
+            # PTB creates one task per update in arrival order, so appending
+            # here keeps the key's updates in the order Telegram sent them.
+            queue.append(coroutine)
+            return
 
-    async def start_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle /start command with authorization check"""
-        user = update.effective_user
+        queue = self._queues[key] = deque()
+        try:
+            while True:
+                try:
+                    await coroutine
+                except Exception as e:
+                    logger.error(f"Update handler for {key} failed: {e}")
+                if not queue:
+                    break
+                coroutine = queue.popleft()
+        finally:
+            del self._queues[key]
+            for pending in queue:
+                # Only reached on cancellation (shutdown); close to avoid "never awaited" warnings
+                pending.close()
 
-        # Handle deep-link access (anyone can access files)
-        link_code = None
-        if context.args:
-            link_code = context.args[0]
-        elif update.message and " " in update.message.text:
-            link_code = update.message.text.split(maxsplit=1)[1]
+    async def initialize(self) -> None:
+        """Nothing to set up"""
 
-        if link_code:
-            await self._handle_link_access(update, context, link_code)
-            return
+    async def shutdown(self) -> None:
+        """Nothing to tear down"""
 
-        # Check authorization for bot usage
-        if not is_user_authorized(user.id):
-            keyboard = [[InlineKeyboardButton("Contact Admin 👨‍💻", url=f"https://t.me/{ADMIN_CONTACT.replace('@', '')}")]]
-            await update.message.reply_text(
-                f"Access Denied 🚫\n\n"
-                f"You need permission to use this bot.\n\n"
-                f"Contact Admin: {ADMIN_CONTACT}\n"
-                f"Your User ID: {user.id}\n\n"
-                f"Note: Anyone can access files through shared links! 🔗",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+###############################################################################
+# 4B — SHARED SESSION STORE (POSTGRES + IN-PROCESS CACHE + LISTEN/NOTIFY)
+###############################################################################
+class PgNotificationListener:
+    """Background LISTEN connection that dispatches NOTIFY payloads to callbacks.
+
+    Callbacks run on the listener thread and must only touch thread-safe state.
+    Reconnect callbacks run every time the connection is (re)established, so
+    caches can drop anything that may have missed a notification.
+    """
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self._callbacks = {}  # channel -> [callback(payload)]
+        self._reconnect_callbacks = []
+        self._thread = None
+
+    def subscribe(self, channel: str, callback):
+        """Register a callback for NOTIFY messages on a channel"""
+        self._callbacks.setdefault(channel, []).append(callback)
+
+    def on_reconnect(self, callback):
+        """Register a callback to run whenever the LISTEN connection is established"""
+        self._reconnect_callbacks.append(callback)
+
+    def start(self):
+        """Start the listener thread (idempotent)"""
+        if self._thread:
             return
+        self._thread = threading.Thread(target=self._run, name="pg-listener", daemon=True)
+        self._thread.start()
 
-        # Show main menu
-        await self._show_main_menu(update.message, user)
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cursor = conn.cursor()
+                for channel in self._callbacks:
+                    cursor.execute(f'LISTEN "{channel}"')
+                for callback in self._reconnect_callbacks:
+                    callback()
+                logger.info(f"Listening for notifications on: {', '.join(self._callbacks)}")
+
+                while True:
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        cursor.execute("SELECT 1")  # Keepalive, detects dead connections
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        for callback in self._callbacks.get(notify.channel, []):
+                            try:
+                                callback(notify.payload)
+                            except Exception as e:
+                                logger.error(f"Notification callback error on {notify.channel}: {e}")
+            except Exception as e:
+                logger.error(f"Notification listener error: {e}")
+            finally:
+                if conn:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            time.sleep(5)
+
+class SessionStore:
+    """Per-user session state stored in the bot_sessions table.
+
+    Reads are served from an in-process cache; writes go to Postgres and
+    NOTIFY the other replicas so they drop their cached copy. The public
+    methods are coroutines that run the database I/O in a worker thread.
+    """
+
+    NOTIFY_CHANNEL = "filestore_sessions"
+
+    def __init__(self, dsn: str, listener: PgNotificationListener):
+        self.dsn = dsn
+        self.instance_id = generate_id()
+        self._cache = {}  # (kind, user_id) -> (data or None, monotonic deadline)
+        self._lock = threading.Lock()
+        listener.subscribe(self.NOTIFY_CHANNEL, self._on_notify)
+        listener.on_reconnect(self.clear_cache)
+
+    async def get(self, kind: str, user_id: int) -> Optional[dict]:
+        """Return the session data, or None if there is no live session"""
+        with self._lock:
+            cached = self._cache.get((kind, user_id))
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        return await asyncio.to_thread(self._load, kind, user_id)
+
+    async def set(self, kind: str, user_id: int, data: dict, ttl: int = SESSION_TTL):
+        """Create or replace a session and refresh its expiry"""
+        await asyncio.to_thread(self._store, kind, user_id, data, ttl)
+
+    async def append(self, kind: str, user_id: int, key: str, item, ttl: int = SESSION_TTL) -> Optional[dict]:
+        """Append item to the list data[key] in one statement and refresh the expiry.
+
+        Concurrent appends (parallel updates, other replicas) cannot overwrite each
+        other. Returns the updated data, or None if there is no live session.
+        """
+        return await asyncio.to_thread(self._append, kind, user_id, key, item, ttl)
 
-    async def clear_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle /clear command - Admin only."""
-        if not is_admin(update.effective_user.id):
-            await update.message.reply_text("Unauthorized: Admin access required 🚫")
-            return
+    async def delete(self, kind: str, user_id: int) -> Optional[dict]:
+        """Remove a session and return the data it held"""
+        return await asyncio.to_thread(self._remove, kind, user_id)
 
-        clear_console()
-        logger.info("Console cleared by user command")
-        await update.message.reply_text("Console Cleared ✅\n\nAll console logs have been cleared.")
+    def _load(self, kind: str, user_id: int) -> Optional[dict]:
+        conn = db_pool(self.dsn).connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT data, EXTRACT(EPOCH FROM expires_at - NOW())
+                FROM bot_sessions
+                WHERE kind = %s AND user_id = %s AND (expires_at IS NULL OR expires_at > NOW())
+            """, (kind, user_id))
+            row = cursor.fetchone()
+        finally:
+            conn.close()
 
-    async def upload_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle /upload command"""
-        if not is_user_authorized(update.effective_user.id):
-            await update.message.reply_text(f"Unauthorized. Contact admin: {ADMIN_CONTACT} 🚫")
-            return
+        data, remaining = (row[0], row[1]) if row else (None, None)
+        self._cache_put((kind, user_id), data, remaining)
+        return data
 
-        if not context.args:
-            await update.message.reply_text(
-                "Usage Error ❌\n\n"
-                "Correct usage: /upload <group_name>\n"
-                "Example: /upload MyDocuments"
-            )
-            return
+    def _store(self, kind: str, user_id: int, data: dict, ttl: int):
+        conn = db_pool(self.dsn).connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO bot_sessions (kind, user_id, data, updated_at, expires_at)
+                VALUES (%s, %s, %s, NOW(), NOW() + %s * INTERVAL '1 second')
+                ON CONFLICT (kind, user_id) DO UPDATE
+                SET data = EXCLUDED.data, updated_at = EXCLUDED.updated_at, expires_at = EXCLUDED.expires_at
+            """, (kind, user_id, json.dumps(data), ttl))
+            self._notify(cursor, kind, user_id)
+            conn.commit()
+        finally:
+            conn.close()
+        self._cache_put((kind, user_id), data, ttl)
 
-        group_name = " ".join(context.args)
-        context.user_data['upload_mode'] = 'single'
-        context.user_data['group_name'] = group_name
+    def _append(self, kind: str, user_id: int, key: str, item, ttl: int) -> Optional[dict]:
+        conn = db_pool(self.dsn).connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE bot_sessions
+                SET data = jsonb_set(data, ARRAY[%s], COALESCE(data -> %s, '[]'::jsonb) || jsonb_build_array(%s::jsonb)),
+                    updated_at = NOW(), expires_at = NOW() + %s * INTERVAL '1 second'
+                WHERE kind = %s AND user_id = %s AND (expires_at IS NULL OR expires_at > NOW())
+                RETURNING data
+            """, (key, key, json.dumps(item), ttl, kind, user_id))
+            row = cursor.fetchone()
+            self._notify(cursor, kind, user_id)
+            conn.commit()
+        finally:
+            conn.close()
+        data = row[0] if row else None
+        self._cache_put((kind, user_id), data, ttl if row else None)
+        return data
 
-        keyboard = [[InlineKeyboardButton("Cancel Upload ❌", callback_data="cancel_upload")]]
+    def _remove(self, kind: str, user_id: int) -> Optional[dict]:
+        conn = db_pool(self.dsn).connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                DELETE FROM bot_sessions
+                WHERE kind = %s AND user_id = %s
+                RETURNING data, expires_at IS NULL OR expires_at > NOW()
+            """, (kind, user_id))
+            row = cursor.fetchone()
+            self._notify(cursor, kind, user_id)
+            conn.commit()
+        finally:
+            conn.close()
+        self._cache_put((kind, user_id), None, None)
+        return row[0] if row and row[1] else None
 
-        await update.message.reply_text(
-            f"Single Upload Mode ⬆️\n\n"
-            f"Group: {group_name} 📁\n"
-            "Send me the file you want to upload.\n"
-            "Supported: Photos 📸, Videos 🎬, Documents 📄, Audio 🎵, Voice \n"
-            f"Max Size: {format_size(MAX_FILE_SIZE)}",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+    def sweep_expired(self) -> int:
+        """Delete expired sessions from the database, return how many were removed"""
+        conn = db_pool(self.dsn).connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM bot_sessions WHERE expires_at < NOW()")
+            removed = cursor.rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        return removed
 
-    async def bulkupload_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle /bulkupload command"""
-        if not is_user_authorized(update.effective_user.id):
-            await update.message.reply_text(f"Unauthorized. Contact admin: {ADMIN_CONTACT} 🚫")
+    def clear_cache(self):
+        """Forget every cached session"""
+        with self._lock:
+            self._cache.clear()
+
+    def _cache_put(self, key, data, remaining_seconds):
+        ttl = SESSION_CACHE_SECONDS if remaining_seconds is None else min(float(remaining_seconds), SESSION_CACHE_SECONDS)
+        with self._lock:
+            self._cache[key] = (data, time.monotonic() + ttl)
+
+    def _notify(self, cursor, kind: str, user_id: int):
+        cursor.execute("SELECT pg_notify(%s, %s)", (self.NOTIFY_CHANNEL, f"{self.instance_id}:{kind}:{user_id}"))
+
+    def _on_notify(self, payload: str):
+        instance_id, kind, user_id = payload.split(":", 2)
+        if instance_id == self.instance_id:
             return
+        with self._lock:
+            self._cache.pop((kind, int(user_id)), None)
 
-        if not context.args:
+###############################################################################
+# 4C — STORAGE CHANNEL SHARDS
+###############################################################################
+class StorageShards:
+    """Picks the storage channel for each upload.
+
+    round_robin cycles through the channels; least_load picks the channel with the
+    fewest uploads in flight and in the last minute. A channel that answered with
+    RetryAfter is skipped until its cooldown ends. State is per process.
+    """
+
+    LOAD_WINDOW_SECONDS = 60
+
+    def __init__(self, channel_ids: list, placement: str = "round_robin"):
+        self.channel_ids = list(channel_ids)
+        self.placement = placement
+        self.in_flight = {channel_id: 0 for channel_id in self.channel_ids}
+        self.recent = {channel_id: [] for channel_id in self.channel_ids}  # monotonic send times
+        self.cooldown_until = {channel_id: 0.0 for channel_id in self.channel_ids}
+        self._next = 0
+
+    def choose(self, exclude: Iterable[int] = ()) -> Optional[int]:
+        """Return the channel for the next upload, or None if every candidate is excluded"""
+        now = time.monotonic()
+        candidates = [channel_id for channel_id in self.channel_ids if channel_id not in exclude]
+        if not candidates:
+            return None
+        ready = [channel_id for channel_id in candidates if self.cooldown_until[channel_id] <= now]
+        if not ready:
+            # Everything is cooling down: use the channel that is free first
+            return min(candidates, key=lambda channel_id: self.cooldown_until[channel_id])
+
+        if self.placement == "least_load":
+            return min(ready, key=lambda channel_id: (self.in_flight[channel_id] + self._recent_count(channel_id, now),
+                                                      self.channel_ids.index(channel_id)))
+
+        for _ in range(len(self.channel_ids)):
+            channel_id = self.channel_ids[self._next % len(self.channel_ids)]
+            self._next += 1
+            if channel_id in ready:
+                return channel_id
+        return ready[0]
+
+    def started(self, channel_id: int):
+        self.in_flight[channel_id] += 1
+        self.recent[channel_id].append(time.monotonic())
+
+    def finished(self, channel_id: int):
+        self.in_flight[channel_id] -= 1
+
+    def cool_down(self, channel_id: int, seconds: float):
+        self.cooldown_until[channel_id] = time.monotonic() + seconds
+
+    def _recent_count(self, channel_id: int, now: float) -> int:
+        recent = self.recent[channel_id]
+        while recent and recent[0] < now - self.LOAD_WINDOW_SECONDS:
+            recent.pop(0)
+        return len(recent)
+
+###############################################################################
+# 4D — TELETHON (MTPROTO): STORAGE RECONCILIATION AND CHANNEL IMPORTS
+###############################################################################
+class MTProtoClient:
+    """Shared Telethon client logged in with the bot token.
+
+    Bots cannot read channel history, but they can fetch up to 100 messages by
+    id per request, which is what reconciliation and imports are built on.
+    """
+
+    SESSION_KEY = "telethon_session"
+
+    def __init__(self):
+        self.client = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(API_ID and API_HASH)
+
+    async def get(self) -> TelegramClient:
+        """Connect (once) and return the client"""
+        async with self._lock:
+            if self.client is None or not self.client.is_connected():
+                session = TELETHON_SESSION or await asyncio.to_thread(get_bot_setting, self.SESSION_KEY) or ""
+                client = TelegramClient(StringSession(session), API_ID, API_HASH, receive_updates=False)
+                await client.start(bot_token=BOT_TOKEN)
+                if not TELETHON_SESSION:
+                    # Reusing the auth key avoids a bot login (and its flood limits) on every restart
+                    await asyncio.to_thread(set_bot_setting, self.SESSION_KEY, client.session.save())
+                self.client = client
+            return self.client
+
+    async def call(self, method, *args, **kwargs):
+        """Call a Telethon method, waiting out flood limits"""
+        while True:
+            try:
+                return await method(*args, **kwargs)
+            except FloodWaitError as e:
+                logger.warning(f"Telegram flood wait of {e.seconds}s on {method.__name__}")
+                await asyncio.sleep(e.seconds + 1)
+
+    async def get_messages_by_id(self, channel, ids: list) -> dict:
+        """Return {message_id: message} for the ids that exist in the channel"""
+        client = await self.get()
+        messages = await self.call(client.get_messages, channel, ids=ids)
+        return {message.id: message for message in messages if message is not None}
+
+def lock_storage_post(cursor, channel_id: int, message_id: int):
+    """Lock a storage post until the transaction ends; orders its reuse against its deletion"""
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtextextended(%s, 0))", (f"storage_post:{channel_id}:{message_id}",))
+
+class StorageReconciler:
+    """Keeps the storage channel and the files table in agreement.
+
+    A pass walks the channel id range in batches: posts no file row points at
+    are deleted, rows whose post is gone are re-uploaded. Progress is
+    checkpointed in bot_settings, so an interrupted pass resumes.
+    """
+
+    CHECKPOINT_KEY = "storage_reconcile_last_id"  # One key per channel: <key>:<channel_id>
+    FINISHED_KEY = "storage_reconcile_finished_at"
+    ADVISORY_LOCK_ID = 720_033  # Only one replica reconciles at a time
+    GC_CLAIM_TIMEOUT = 3600  # Seconds after which a GC claim is considered abandoned
+    EMPTY_BATCHES_TO_STOP = 3  # Past the highest known post, stop after this many empty batches
+
+    def __init__(self, bot: "FileStoreBot", mtproto: MTProtoClient):
+        self.bot = bot
+        self.mtproto = mtproto
+        self.running = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.mtproto.enabled
+
+    async def run(self) -> dict:
+        """Run one full pass (GC queue, channel walk, re-uploads) and return its counters"""
+        stats = {"scanned": 0, "orphans_deleted": 0, "missing": 0, "recopied": 0, "failed": 0, "gc_deleted": 0}
+        lock_conn = await asyncio.to_thread(get_db_connection, direct=True)
+        try:
+            cursor = lock_conn.cursor()
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", (self.ADVISORY_LOCK_ID,))
+            if not cursor.fetchone()[0]:
+                raise RuntimeError("a reconciliation pass is already running")
+
+            self.running = True
+            stats["gc_deleted"] = await self.drain_gc_queue()
+            for channel_id in STORAGE_CHANNEL_IDS:
+                await self._walk_channel(channel_id, stats)
+            # Orphans found by the walk were queued; delete them now
+            await self.drain_gc_queue()
+            await self._recopy_unstored(stats)
+            await asyncio.to_thread(set_bot_setting, self.FINISHED_KEY, datetime.now().isoformat())
+            logger.info(f"Storage reconciliation finished: {stats}")
+            return stats
+        finally:
+            self.running = False
+            lock_conn.close()  # Releases the advisory lock
+
+    async def drain_gc_queue(self) -> int:
+        """Delete the storage posts of deleted files, return how many were removed.
+
+        Each batch is claimed in a short transaction (see _claim_gc_batch), so no
+        connection or row lock is held while Telegram deletes the posts.
+        """
+        deleted = 0
+        while True:
+            try:
+                claimed = await asyncio.to_thread(self._claim_gc_batch)
+            except Exception as e:
+                logger.error(f"Storage GC error: {e}")
+                return deleted
+            if not claimed:
+                return deleted
+
+            by_channel = defaultdict(set)
+            for _, channel_id, message_id in claimed:
+                by_channel[channel_id].add(message_id)
+            queue_ids = [row[0] for row in claimed]
+            try:
+                for channel_id, message_ids in by_channel.items():
+                    await self._delete_messages(channel_id, sorted(message_ids))
+                    deleted += len(message_ids)
+            except Exception as e:
+                logger.error(f"Storage GC error: {e}")
+                await asyncio.to_thread(self._settle_gc_batch, queue_ids, False)
+                return deleted
+            await asyncio.to_thread(self._settle_gc_batch, queue_ids, True)
+            await asyncio.sleep(RECONCILE_BATCH_DELAY)
+
+    def _claim_gc_batch(self) -> list:
+        """Claim a batch of queued posts no file uses any more; returns their (id, channel_id, message_id).
+
+        Under each post's lock (taken by deduplicating uploads too), queue rows of
+        posts that are still used are dropped and the others get claimed_at set,
+        which stops uploads from reusing them. A claim older than
+        GC_CLAIM_TIMEOUT (a crashed pass) is taken over.
+        """
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, channel_id, message_id FROM storage_gc_queue
+                WHERE claimed_at IS NULL OR claimed_at < NOW() - %s * INTERVAL '1 second'
+                ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+            """, (self.GC_CLAIM_TIMEOUT, RECONCILE_BATCH_SIZE))
+            rows = cursor.fetchall()
+            if not rows:
+                return []
+
+            posts = sorted({(channel_id, message_id) for _, channel_id, message_id in rows})
+            for channel_id, message_id in posts:
+                lock_storage_post(cursor, channel_id, message_id)
+            # A post shared by deduplicated files stays until its last row is gone
+            cursor.execute("""
+                SELECT DISTINCT f.storage_channel_id, f.storage_message_id
+                FROM files f
+                JOIN unnest(%s::bigint[], %s::bigint[]) AS q(channel_id, message_id)
+                  ON f.storage_channel_id = q.channel_id AND f.storage_message_id = q.message_id
+            """, ([post[0] for post in posts], [post[1] for post in posts]))
+            still_used = set(cursor.fetchall())
+
+            claimed = [row for row in rows if (row[1], row[2]) not in still_used]
+            cursor.execute("DELETE FROM storage_gc_queue WHERE id = ANY(%s)",
+                           ([row[0] for row in rows if (row[1], row[2]) in still_used],))
+            cursor.execute("UPDATE storage_gc_queue SET claimed_at = NOW() WHERE id = ANY(%s)",
+                           ([row[0] for row in claimed],))
+            conn.commit()
+            return claimed
+        finally:
+            conn.close()
+
+    def _settle_gc_batch(self, queue_ids: list, done: bool):
+        """Remove a claimed batch from the queue, or release the claim to retry it later"""
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            if done:
+                cursor.execute("DELETE FROM storage_gc_queue WHERE id = ANY(%s)", (queue_ids,))
+            else:
+                cursor.execute("UPDATE storage_gc_queue SET claimed_at = NULL WHERE id = ANY(%s)", (queue_ids,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    async def _walk_channel(self, channel_id: int, stats: dict):
+        client = await self.mtproto.get()
+        channel = await client.get_input_entity(channel_id)
+        checkpoint_key = f"{self.CHECKPOINT_KEY}:{channel_id}"
+        last_id = int(await asyncio.to_thread(get_bot_setting, checkpoint_key, "0"))
+        if last_id:
+            logger.info(f"Resuming storage reconciliation of {channel_id} after message {last_id}")
+
+        max_known_id = await asyncio.to_thread(self._max_known_id, channel_id)
+
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=RECONCILE_GRACE_SECONDS)
+        empty_batches = 0
+        while empty_batches < self.EMPTY_BATCHES_TO_STOP:
+            ids = list(range(last_id + 1, last_id + 1 + RECONCILE_BATCH_SIZE))
+            present = await self.mtproto.get_messages_by_id(channel, ids)
+            stats["scanned"] += len(present)
+            empty_batches = empty_batches + 1 if not present and ids[0] > max_known_id else 0
+
+            # Only media posts are ours; notes or service messages in the channel are kept
+            old_media = [message_id for message_id, message in present.items()
+                         if message.media and message.date < cutoff]
+            missing, orphans = await asyncio.to_thread(self._check_batch, channel_id, ids, set(present), old_media)
+            stats["missing"] += missing
+            stats["orphans_deleted"] += orphans
+
+            last_id = ids[-1]
+            await asyncio.to_thread(set_bot_setting, checkpoint_key, last_id)
+            await asyncio.sleep(RECONCILE_BATCH_DELAY)
+
+        await asyncio.to_thread(set_bot_setting, checkpoint_key, 0)
+
+    def _max_known_id(self, channel_id: int) -> int:
+        """Highest storage post id a file row points at in the channel"""
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT COALESCE(MAX(storage_message_id), 0) FROM files WHERE storage_channel_id = %s
+            """, (channel_id,))
+            return cursor.fetchone()[0]
+        finally:
+            conn.close()
+
+    def _check_batch(self, channel_id: int, ids: list, present: set, old_media: list) -> Tuple[int, int]:
+        """Compare a batch of post ids with the files table, return (rows missing their post, orphans queued).
+
+        Rows pointing at a vanished post are reset (re-uploaded by _recopy_unstored);
+        old media posts no row points at go to the storage GC queue.
+        """
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT DISTINCT storage_message_id FROM files
+                WHERE storage_channel_id = %s AND storage_message_id = ANY(%s)
+            """, (channel_id, ids))
+            referenced = {row[0] for row in cursor.fetchall()}
+
+            missing = [message_id for message_id in referenced if message_id not in present]
+            reset = 0
+            if missing:
+                cursor.execute("""
+                    UPDATE files SET storage_channel_id = NULL, storage_message_id = NULL
+                    WHERE storage_channel_id = %s AND storage_message_id = ANY(%s)
+                """, (channel_id, missing))
+                reset = cursor.rowcount
+
+            orphans = [message_id for message_id in old_media if message_id not in referenced]
+            if orphans:
+                cursor.execute("""
+                    INSERT INTO storage_gc_queue (channel_id, message_id)
+                    SELECT %s, message_id FROM unnest(%s::bigint[]) AS message_id
+                """, (channel_id, orphans))
+            conn.commit()
+            return reset, len(orphans)
+        finally:
+            conn.close()
+
+    async def _recopy_unstored(self, stats: dict):
+        """Upload rows without a storage post (failed uploads, vanished posts) again"""
+        def load_batch(after_id: int) -> list:
+            conn = get_db_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT id, telegram_file_id, file_type, file_name, serial_number, uploader_id
+                    FROM files
+                    WHERE storage_message_id IS NULL AND id > %s AND telegram_file_id NOT LIKE 'mtproto:%%'
+                      AND uploaded_at < NOW() - %s * INTERVAL '1 second'
+                    ORDER BY id LIMIT %s
+                """, (after_id, RECONCILE_GRACE_SECONDS, RECONCILE_BATCH_SIZE))
+                return cursor.fetchall()
+            finally:
+                conn.close()
+
+        last_file_id = 0
+        while True:
+            rows = await asyncio.to_thread(load_batch, last_file_id)
+            if not rows:
+                return
+
+            caption_context = await asyncio.to_thread(get_caption_context, [row[5] for row in rows])
+            for file_id, telegram_file_id, file_type, file_name, serial_number, uploader_id in rows:
+                last_file_id = file_id
+                caption = build_file_caption(file_name, serial_number, uploader_id, caption_context)
+                try:
+                    try:
+                        storage_msg = await self.bot._send_to_storage(telegram_file_id, file_type, caption)
+                    except RetryAfter as e:
+                        await asyncio.sleep(e.retry_after + 1)
+                        storage_msg = await self.bot._send_to_storage(telegram_file_id, file_type, caption)
+
+                    await asyncio.to_thread(self.bot._set_storage_message, file_id, storage_msg.chat_id, storage_msg.message_id)
+                    stats["recopied"] += 1
+                except Exception as e:
+                    logger.error(f"Storage re-upload failed for file {file_id}: {e}")
+                    stats["failed"] += 1
+                await asyncio.sleep(BULK_UPLOAD_DELAY)
+
+    async def _delete_messages(self, channel_id: int, message_ids: list):
+        if self.enabled:
+            client = await self.mtproto.get()
+            await self.mtproto.call(client.delete_messages, channel_id, message_ids)
+            return
+
+        # Without Telethon fall back to one Bot API call per post
+        for message_id in message_ids:
+            try:
+                await self.bot.app.bot.delete_message(channel_id, message_id)
+            except BadRequest:
+                pass  # Already gone, or older than 48h for non-admin bots
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after + 1)
+                await self.bot.app.bot.delete_message(channel_id, message_id)
+
+# Telethon's file ids carry no file reference and are not accepted by the Bot API, so
+# imported files are stored with this prefix and delivered by copying their source post
+IMPORTED_FILE_ID_PREFIX = "mtproto:"
+
+def is_imported_file_id(telegram_file_id: str) -> bool:
+    return telegram_file_id.startswith(IMPORTED_FILE_ID_PREFIX)
+
+class ChannelImporter:
+    """Imports the media posts of an existing channel as files, groups and links.
+
+    The source channel stays the storage for imported files (storage_channel_id),
+    nothing is re-uploaded: deliveries copy the source post. Each batch of up to 100 messages is written in one
+    transaction together with the job checkpoint, so a resumed import never
+    duplicates files.
+    """
+
+    EMPTY_BATCHES_TO_STOP = 20  # Tolerates gaps of deleted posts up to ~2000 ids
+
+    def __init__(self, mtproto: MTProtoClient):
+        self.mtproto = mtproto
+        self.running = set()  # job ids
+
+    @staticmethod
+    def parse_mapping(spec: str) -> str:
+        """Turn the /importchannel argument into a stored mapping.
+
+        '#' -> group per first hashtag, '/regex/' -> group from the first capture
+        group (or the whole match), anything else -> one fixed group name.
+        """
+        spec = spec.strip()
+        if spec == "#":
+            return "hashtag"
+        if len(spec) > 2 and spec.startswith("/") and spec.endswith("/"):
+            re.compile(spec[1:-1])  # Raises re.error for an invalid pattern
+            return f"regex:{spec[1:-1]}"
+        return f"group:{spec}"
+
+    @staticmethod
+    def group_for(mapping: str, text: str, file_name: str) -> Optional[str]:
+        """Return the target group of a message, or None to skip it"""
+        kind, _, arg = mapping.partition(":")
+        if kind == "group":
+            return arg
+        if kind == "hashtag":
+            match = re.search(r"#(\w+)", text)
+            return match.group(1) if match else None
+        match = re.search(arg, text) or re.search(arg, file_name)
+        if not match:
+            return None
+        name = match.group(1) if match.groups() else match.group(0)
+        return name.strip() or None
+
+    @staticmethod
+    def media_info(message) -> Optional[Tuple[str, str, int, str]]:
+        """Return (file_type, file_name, file_size, prefixed MTProto file id) of a media post"""
+        if message.photo:
+            file_type = "photo"
+        elif message.video_note:
+            file_type = "video_note"
+        elif message.voice:
+            file_type = "voice"
+        elif message.audio:
+            file_type = "audio"
+        elif message.video:
+            file_type = "video"
+        elif message.document and not message.sticker:
+            file_type = "document"
+        else:
+            return None
+        file = message.file
+        file_name = file.name or f"{file_type}_{message.id}{file.ext or ''}"
+        return file_type, file_name, file.size or 0, IMPORTED_FILE_ID_PREFIX + file.id
+
+    def start_job(self, source_channel_id: int, owner_id: int, mapping: str) -> Tuple[int, int, int]:
+        """Resume the unfinished job for this channel/mapping or create a new one.
+
+        A new job starts after the last message of earlier finished jobs, so re-running
+        an import only picks up posts added since. Returns (job_id, last_message_id, imported_files).
+        """
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, last_message_id, imported_files FROM import_jobs
+                WHERE source_channel_id = %s AND owner_id = %s AND mapping = %s AND status <> 'done'
+                ORDER BY id DESC LIMIT 1
+            """, (source_channel_id, owner_id, mapping))
+            job = cursor.fetchone()
+            if job:
+                cursor.execute("UPDATE import_jobs SET status = 'running', updated_at = NOW() WHERE id = %s", (job[0],))
+            else:
+                cursor.execute("""
+                    INSERT INTO import_jobs (source_channel_id, owner_id, mapping, last_message_id)
+                    SELECT %s, %s, %s, COALESCE(MAX(last_message_id), 0) FROM import_jobs
+                    WHERE source_channel_id = %s AND owner_id = %s AND mapping = %s
+                    RETURNING id, last_message_id, imported_files
+                """, (source_channel_id, owner_id, mapping, source_channel_id, owner_id, mapping))
+                job = cursor.fetchone()
+            conn.commit()
+            return job
+        finally:
+            conn.close()
+
+    async def run(self, job_id: int, progress=None) -> dict:
+        """Import a job to the end of the channel; progress(stats) is awaited every few batches"""
+        source_channel_id, owner_id, mapping, last_id, imported = await asyncio.to_thread(self._load_job, job_id)
+
+        stats = {"job_id": job_id, "scanned": 0, "imported": imported, "skipped": 0, "last_message_id": last_id}
+        self.running.add(job_id)
+        try:
+            client = await self.mtproto.get()
+            channel = await client.get_input_entity(source_channel_id)
+            empty_batches = 0
+            batches = 0
+            while empty_batches < self.EMPTY_BATCHES_TO_STOP:
+                ids = list(range(last_id + 1, last_id + 1 + RECONCILE_BATCH_SIZE))
+                present = await self.mtproto.get_messages_by_id(channel, ids)
+                empty_batches = 0 if present else empty_batches + 1
+                stats["scanned"] += len(present)
+
+                rows = []
+                for message_id in sorted(present):
+                    message = present[message_id]
+                    info = self.media_info(message)
+                    group_name = info and self.group_for(mapping, message.message or "", info[1])
+                    if not group_name:
+                        stats["skipped"] += 1
+                        continue
+                    rows.append((message_id, group_name[:100]) + info)
+
+                # Only advance the checkpoint up to the last existing post, so posts
+                # published during the import are picked up by the next run
+                if present:
+                    last_id = max(present)
+                    await asyncio.to_thread(self._write_batch, job_id, source_channel_id, owner_id, rows, last_id)
+                    stats["imported"] += len(rows)
+                    stats["last_message_id"] = last_id
+                else:
+                    last_id = ids[-1]
+
+                batches += 1
+                if progress and batches % 10 == 0:
+                    await progress(stats)
+                await asyncio.sleep(IMPORT_BATCH_DELAY)
+
+            stats["group_links"] = await asyncio.to_thread(self._finish_job, job_id, source_channel_id, owner_id)
+            return stats
+        except Exception:
+            await asyncio.to_thread(self._set_status, job_id, "failed")
+            raise
+        finally:
+            self.running.discard(job_id)
+
+    def _load_job(self, job_id: int) -> tuple:
+        """(source_channel_id, owner_id, mapping, last_message_id, imported_files) of a job"""
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT source_channel_id, owner_id, mapping, last_message_id, imported_files FROM import_jobs WHERE id = %s
+            """, (job_id,))
+            return cursor.fetchone()
+        finally:
+            conn.close()
+
+    def _write_batch(self, job_id: int, source_channel_id: int, owner_id: int, rows: list, last_message_id: int):
+        """Insert one batch of files with their links and advance the checkpoint, atomically"""
+        conn = get_db_connection(user_id=owner_id)
+        try:
+            cursor = conn.cursor()
+            if rows:
+                group_names = sorted({row[1] for row in rows})
+                psycopg2.extras.execute_values(cursor, """
+                    INSERT INTO groups (name, owner_id) VALUES %s ON CONFLICT (name, owner_id) DO NOTHING
+                """, [(name, owner_id) for name in group_names])
+                # Row locks keep serial numbers consistent with concurrent uploads; the files
+                # triggers advance last_serial and the group counters for the inserted rows
+                cursor.execute("""
+                    SELECT name, id, last_serial FROM groups WHERE owner_id = %s AND name = ANY(%s) FOR UPDATE
+                """, (owner_id, group_names))
+                groups = {name: [group_id, last_serial] for name, group_id, last_serial in cursor.fetchall()}
+
+                file_rows = []
+                for message_id, group_name, file_type, file_name, file_size, telegram_file_id in rows:
+                    group = groups[group_name]
+                    group[1] += 1
+                    file_rows.append((group[0], group[1], generate_id(), file_name, file_type, file_size,
+                                      telegram_file_id, owner_id, source_channel_id, message_id))
+
+                file_ids = psycopg2.extras.execute_values(cursor, """
+                    INSERT INTO files (group_id, serial_number, unique_id, file_name, file_type, file_size,
+                                       telegram_file_id, uploader_id, storage_channel_id, storage_message_id)
+                    VALUES %s RETURNING id
+                """, file_rows, fetch=True)
+                psycopg2.extras.execute_values(cursor, """
+                    INSERT INTO file_links (link_code, link_type, file_id, owner_id) VALUES %s
+                """, [(generate_id(), "file", file_id, owner_id) for (file_id,) in file_ids])
+
+            cursor.execute("""
+                UPDATE import_jobs SET last_message_id = %s, imported_files = imported_files + %s, updated_at = NOW()
+                WHERE id = %s
+            """, (last_message_id, len(rows), job_id))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _finish_job(self, job_id: int, source_channel_id: int, owner_id: int) -> int:
+        """Give every imported group an active group link, mark the job done, return links created"""
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT DISTINCT f.group_id FROM files f
+                JOIN groups g ON g.id = f.group_id
+                WHERE f.storage_channel_id = %s AND g.owner_id = %s
+                  AND NOT EXISTS (
+                      SELECT 1 FROM file_links fl
+                      WHERE fl.group_id = f.group_id AND fl.link_type = 'group' AND fl.is_active = 1
+                  )
+            """, (source_channel_id, owner_id))
+            group_ids = [row[0] for row in cursor.fetchall()]
+            if group_ids:
+                psycopg2.extras.execute_values(cursor, """
+                    INSERT INTO file_links (link_code, link_type, group_id, owner_id) VALUES %s
+                """, [(generate_id(), "group", group_id, owner_id) for group_id in group_ids])
+            cursor.execute("UPDATE import_jobs SET status = 'done', updated_at = NOW() WHERE id = %s", (job_id,))
+            conn.commit()
+            return len(group_ids)
+        finally:
+            conn.close()
+
+    def _set_status(self, job_id: int, status: str):
+        try:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute("UPDATE import_jobs SET status = %s, updated_at = NOW() WHERE id = %s", (status, job_id))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.error(f"Error updating import job {job_id}: {e}")
+
+###############################################################################
+# 4E — DELIVERY BOT POOL (HELPER TOKENS)
+###############################################################################
+class DeliveryBot:
+    """One bot of the delivery pool with its own token-bucket send budget"""
+
+    def __init__(self, index: int, bot: Bot, rate: float, is_main: bool = False):
+        self.index = index
+        self.bot = bot
+        self.is_main = is_main
+        self.rate = rate
+        self.capacity = max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.cooldown_until = 0.0
+        self.unusable_channels = set()  # Storage channels this helper cannot copy from
+        self.initialized = is_main
+
+    def available(self) -> float:
+        """Refill and return the current budget"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens if now >= self.cooldown_until else 0.0
+
+    def wait_time(self) -> float:
+        """Seconds until one send is allowed"""
+        now = time.monotonic()
+        return max(self.cooldown_until - now, (1 - self.available()) / self.rate, 0.0)
+
+class DeliveryPool:
+    """Spreads file deliveries over the main bot and optional helper bots.
+
+    file_ids only work for the bot that saw the upload, so helpers deliver with
+    copy_message from the storage post. A helper can only message users who have
+    started it: a Forbidden answer marks the user unreachable for that helper for
+    a day. Helpers are picked by reachability first, then by remaining budget; a
+    flood-limited bot is put on cooldown and the next one is tried.
+    """
+
+    REACHABILITY_TTL = 24 * 3600
+    REACHABILITY_MAX_ENTRIES = 100_000
+
+    def __init__(self, main_bot: Bot, helper_tokens: list, rate: float):
+        self.members = [DeliveryBot(0, main_bot, rate, is_main=True)]
+        # Helpers talk to the same Bot API server as the main bot
+        base_url = main_bot.base_url[:-len(main_bot.token)]
+        base_file_url = main_bot.base_file_url[:-len(main_bot.token)]
+        for index, token in enumerate(helper_tokens, start=1):
+            self.members.append(DeliveryBot(index, Bot(token, base_url=base_url, base_file_url=base_file_url), rate))
+        self.reachability = OrderedDict()  # (member index, user_id) -> (reachable, monotonic expiry)
+
+    @property
+    def helpers(self) -> list:
+        return self.members[1:]
+
+    async def send(self, user_id: int, storage_post: Optional[Tuple[int, int]], send_with_file_id, caption: Optional[str]):
+        """Deliver one file and return (message, member).
+
+        send_with_file_id(bot) sends through the main bot's file_id; helpers copy
+        storage_post (channel_id, message_id) with the given caption instead, and so
+        does the main bot when send_with_file_id is None (imported files).
+        """
+        tried = set()
+        last_error = None
+        while True:
+            member = self._choose(user_id, storage_post, tried)
+            if member is None:
+                raise last_error or RuntimeError("no delivery bot available")
+            delay = member.wait_time()
+            if delay:
+                await asyncio.sleep(delay)
+            member.available()
+            member.tokens -= 1
+
+            try:
+                if member.is_main and send_with_file_id:
+                    message = await send_with_file_id(member.bot)
+                else:
+                    if not member.initialized:
+                        await member.bot.initialize()
+                        member.initialized = True
+                    message = await member.bot.copy_message(user_id, storage_post[0], storage_post[1], caption=caption)
+                self._remember(member, user_id, True)
+                return message, member
+            except RetryAfter as e:
+                member.cooldown_until = time.monotonic() + e.retry_after
+                logger.warning(f"Delivery bot #{member.index} rate limited for {e.retry_after}s, failing over")
+                last_error = e
+            except Forbidden as e:
+                if member.is_main:
+                    raise  # The user blocked the bot itself
+                self._remember(member, user_id, False)
+                last_error = e
+            except BadRequest as e:
+                if member.is_main:
+                    raise
+                # Usually the helper is not a member of that storage channel
+                logger.warning(f"Delivery bot #{member.index} cannot copy from {storage_post[0]}: {e}")
+                member.unusable_channels.add(storage_post[0])
+                last_error = e
+            tried.add(member.index)
+
+    def _choose(self, user_id: int, storage_post: Optional[Tuple[int, int]], tried: set) -> Optional[DeliveryBot]:
+        candidates = []
+        for member in self.members:
+            if member.index in tried:
+                continue
+            if not member.is_main:
+                if not storage_post or storage_post[0] in member.unusable_channels:
+                    continue
+                reachable = self._reachable(member, user_id)
+                if reachable is False:
+                    continue
+            else:
+                reachable = True  # The user is talking to the main bot
+            candidates.append((member, 2 if reachable else 1))
+        if not candidates:
+            return None
+
+        ready = [(member, rank) for member, rank in candidates if member.available() >= 1]
+        if ready:
+            # Known-reachable bots first, then the most remaining budget
+            return max(ready, key=lambda item: (item[1], item[0].tokens))[0]
+        return min(candidates, key=lambda item: (item[0].wait_time(), -item[1]))[0]
+
+    def _reachable(self, member: DeliveryBot, user_id: int) -> Optional[bool]:
+        entry = self.reachability.get((member.index, user_id))
+        if not entry or entry[1] < time.monotonic():
+            return None
+        return entry[0]
+
+    def _remember(self, member: DeliveryBot, user_id: int, reachable: bool):
+        if member.is_main:
+            return
+        key = (member.index, user_id)
+        self.reachability[key] = (reachable, time.monotonic() + self.REACHABILITY_TTL)
+        self.reachability.move_to_end(key)
+        while len(self.reachability) > self.REACHABILITY_MAX_ENTRIES:
+            self.reachability.popitem(last=False)
+
+###############################################################################
+# 4F — DEEP-LINK ACCESS LIMITS
+###############################################################################
+def parse_rate_limit(value: str) -> Tuple[int, float]:
+    """Parse "<requests>/<seconds>" into (requests, seconds)"""
+    requests, _, seconds = value.partition("/")
+    return int(requests), float(seconds or 60)
+
+class SlidingWindowLimiter:
+    """At most `limit` hits per key within the last `window` seconds (in-process)"""
+
+    def __init__(self, limit: int, window: float, max_keys: int = 100_000):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self.hits = OrderedDict()  # key -> deque of monotonic timestamps
+
+    def allows(self, key, now: float) -> bool:
+        hits = self.hits.get(key)
+        if not hits:
+            return True
+        while hits and hits[0] <= now - self.window:
+            hits.popleft()
+        return len(hits) < self.limit
+
+    def record(self, key, now: float):
+        hits = self.hits.get(key)
+        if hits is None:
+            hits = self.hits[key] = deque()
+        else:
+            self.hits.move_to_end(key)
+        hits.append(now)
+        while len(self.hits) > self.max_keys:
+            self.hits.popitem(last=False)
+
+class LinkAccessGuard:
+    """Decides, without touching the database, whether a deep link may be served.
+
+    Limits are checked per user, per link code and globally, and a hit is only
+    counted when every limit allows it. Codes the link filter rejects only count
+    against the user, so scanners cannot use up the per-link and global budgets.
+    Repeats of a link the user is receiving, or received within
+    LINK_DUPLICATE_WINDOW, are coalesced into that delivery; a request that
+    delivered nothing (error, invalid link) does not block a retry.
+    """
+
+    NOTIFY_INTERVAL = 60  # A throttled user is told at most once per interval
+
+    def __init__(self):
+        self.per_user = SlidingWindowLimiter(*parse_rate_limit(LINK_LIMIT_PER_USER))
+        self.per_link = SlidingWindowLimiter(*parse_rate_limit(LINK_LIMIT_PER_LINK))
+        self.global_limit = SlidingWindowLimiter(*parse_rate_limit(LINK_LIMIT_GLOBAL))
+        self.in_flight = set()  # (user_id, link_code) being handled
+        self.recent = OrderedDict()  # (user_id, link_code) -> monotonic expiry, after a delivery
+        self.notified = OrderedDict()  # user_id -> monotonic time of the last rejection notice
+
+    def check(self, user_id: int, link_code: str, might_exist: bool = True) -> Optional[str]:
+        """Return why the request is rejected ('duplicate', 'user', 'link', 'global') or None and count it.
+
+        An accepted request is in flight until finish() is called for it.
+        """
+        now = time.monotonic()
+        self._expire(self.recent, now)
+        key = (user_id, link_code)
+        if key in self.in_flight or key in self.recent:
+            return "duplicate"
+        if not self.per_user.allows(user_id, now):
+            return "user"
+        if might_exist:
+            if not self.per_link.allows(link_code, now):
+                return "link"
+            if not self.global_limit.allows(None, now):
+                return "global"
+
+        self.per_user.record(user_id, now)
+        if might_exist:
+            self.per_link.record(link_code, now)
+            self.global_limit.record(None, now)
+        self.in_flight.add(key)
+        return None
+
+    def finish(self, user_id: int, link_code: str, delivered: bool):
+        """End an accepted request; only a delivery suppresses repeats for LINK_DUPLICATE_WINDOW"""
+        key = (user_id, link_code)
+        self.in_flight.discard(key)
+        if delivered:
+            self.recent[key] = time.monotonic() + LINK_DUPLICATE_WINDOW
+            self.recent.move_to_end(key)
+
+    def should_notify(self, user_id: int) -> bool:
+        """True for the first rejection of a user per NOTIFY_INTERVAL (later ones are dropped silently)"""
+        now = time.monotonic()
+        last = self.notified.get(user_id)
+        if last is not None and now - last < self.NOTIFY_INTERVAL:
+            return False
+        self.notified[user_id] = now
+        self.notified.move_to_end(user_id)
+        while len(self.notified) > 100_000:
+            self.notified.popitem(last=False)
+        return True
+
+    @staticmethod
+    def _expire(entries: OrderedDict, now: float):
+        # Entries are inserted with the same window, so the oldest expire first
+        while entries:
+            key, expiry = next(iter(entries.items()))
+            if expiry > now:
+                break
+            entries.popitem(last=False)
+
+###############################################################################
+# 4G — LINK CODE FILTER (BLOOM FILTER + NEGATIVE CACHE)
+###############################################################################
+class LinkCodeFilter:
+    """Answers "can this link code exist?" without a database round trip.
+
+    Active codes are kept in a Bloom filter (no false negatives, about 1% false
+    positives); revoked and unknown codes sit in a negative cache, since a Bloom
+    filter cannot forget. The filter is built every time the LISTEN connection
+    is (re)established, so no file_links notification can fall into a gap, and
+    rebuilt periodically to shed revoked codes. Until the first build finishes
+    every code is a "maybe".
+    """
+
+    NOTIFY_CHANNEL = "filestore_links"
+    FALSE_POSITIVE_RATE = 0.01
+    NEGATIVE_TTL = 2 * LINK_FILTER_REBUILD_INTERVAL
+    NEGATIVE_MAX_ENTRIES = 100_000
+
+    def __init__(self, dsn: str, listener: PgNotificationListener):
+        self.dsn = dsn
+        self._bits = None
+        self._size = 0
+        self._hashes = 0
+        self._pending = None  # Codes added while a rebuild is reading the table
+        self._negative = OrderedDict()  # link_code -> monotonic expiry
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        listener.subscribe(self.NOTIFY_CHANNEL, self._on_notify)
+        listener.on_reconnect(self._on_reconnect)
+
+    @property
+    def ready(self) -> bool:
+        return self._bits is not None
+
+    def might_exist(self, link_code: str) -> bool:
+        """False only if the code is certainly not an active link"""
+        with self._lock:
+            expiry = self._negative.get(link_code)
+            if expiry is not None:
+                if expiry > time.monotonic():
+                    return False
+                del self._negative[link_code]
+            if self._bits is None:
+                return True
+            bits = self._bits
+            return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(link_code, self._size, self._hashes))
+
+    def add(self, link_code: str):
+        """Record a new (or reactivated) link; call before committing it"""
+        with self._lock:
+            self._negative.pop(link_code, None)
+            if self._pending is not None:
+                self._pending.append(link_code)
+            if self._bits is not None:
+                self._set(self._bits, link_code, self._size, self._hashes)
+
+    def forget(self, link_code: str):
+        """Reject a revoked or unknown code until the next rebuild has dropped it"""
+        with self._lock:
+            self._negative[link_code] = time.monotonic() + self.NEGATIVE_TTL
+            self._negative.move_to_end(link_code)
+            while len(self._negative) > self.NEGATIVE_MAX_ENTRIES:
+                self._negative.popitem(last=False)
+
+    def rebuild(self) -> int:
+        """Rebuild the filter from the active links, return how many were loaded"""
+        with self._rebuild_lock:
+            with self._lock:
+                self._pending = []
+            try:
+                conn = db_pool(self.dsn).connect()
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT COUNT(*) FROM file_links WHERE is_active = 1")
+                    count = cursor.fetchone()[0]
+                    # Leave room for the links created before the next rebuild
+                    size, hashes = self._dimensions(max(2 * count, 10_000))
+                    bits = bytearray((size + 7) // 8)
+
+                    cursor = conn.cursor(name="link_filter_rebuild")
+                    cursor.itersize = 10_000
+                    cursor.execute("SELECT link_code FROM file_links WHERE is_active = 1")
+                    for (link_code,) in cursor:
+                        self._set(bits, link_code, size, hashes)
+                finally:
+                    conn.close()
+            except Exception:
+                with self._lock:
+                    self._pending = None
+                raise
+
+            with self._lock:
+                for link_code in self._pending:
+                    self._set(bits, link_code, size, hashes)
+                self._bits, self._size, self._hashes = bits, size, hashes
+                self._pending = None
+            return count
+
+    @classmethod
+    def _dimensions(cls, capacity: int) -> Tuple[int, int]:
+        size = math.ceil(-capacity * math.log(cls.FALSE_POSITIVE_RATE) / math.log(2) ** 2)
+        return size, max(1, round(size / capacity * math.log(2)))
+
+    @staticmethod
+    def _positions(link_code: str, size: int, hashes: int) -> list:
+        # Double hashing: two 64-bit halves of one blake2b digest give every probe
+        digest = hashlib.blake2b(link_code.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % size for i in range(hashes)]
+
+    @classmethod
+    def _set(cls, bits: bytearray, link_code: str, size: int, hashes: int):
+        for p in cls._positions(link_code, size, hashes):
+            bits[p >> 3] |= 1 << (p & 7)
+
+    def _on_notify(self, payload: str):
+        action, link_codes = payload.split(":", 1)
+        for link_code in link_codes.split(","):
+            if action == "add":
+                self.add(link_code)
+            else:
+                self.forget(link_code)
+
+    def _on_reconnect(self):
+        # Notifications may have been missed while disconnected; rebuild off the listener thread
+        threading.Thread(target=self.rebuild_and_log, name="link-filter-rebuild", daemon=True).start()
+
+    def rebuild_and_log(self):
+        try:
+            started = time.monotonic()
+            count = self.rebuild()
+            logger.info(f"Link filter built with {count} active link(s) in {time.monotonic() - started:.1f}s")
+        except Exception as e:
+            logger.error(f"Link filter rebuild error: {e}")
+
+###############################################################################
+# 4H — GROUP DELIVERY MANIFESTS
+###############################################################################
+class GroupManifestCache:
+    """Versioned, precomputed delivery lists for group links.
+
+    A manifest is the ordered list of [telegram_file_id, file_type, file_name,
+    caption, storage_channel_id, storage_message_id] a group link sends. It is
+    keyed on (groups.manifest_version, caption_epoch): triggers bump the first
+    whenever the group's files change, caption setting changes bump the second,
+    and the link lookup already reads both. A cached manifest with the same key
+    is therefore current and delivery needs no query. Manifests live in an LRU
+    and, with GROUP_MANIFEST_PERSIST, in group_manifests for other replicas.
+    """
+
+    def __init__(self, dsn: str, max_entries: int = GROUP_MANIFEST_CACHE_SIZE, persist: bool = GROUP_MANIFEST_PERSIST):
+        self.dsn = dsn
+        self.max_entries = max_entries
+        self.persist = persist
+        self._cache = OrderedDict()  # group_id -> ((version, caption_epoch), manifest)
+        self._lock = threading.Lock()
+
+    def get(self, group_id: int, key: Optional[Tuple[int, int]] = None) -> list:
+        """Return the group's manifest; key is (manifest_version, caption_epoch) if already known"""
+        if key is not None:
+            with self._lock:
+                entry = self._cache.get(group_id)
+                if entry and entry[0] == key:
+                    self._cache.move_to_end(group_id)
+                    return entry[1]
+
+        key, manifest = self._load(group_id, key)
+        with self._lock:
+            current = self._cache.get(group_id)
+            if not current or current[0] < key:
+                self._cache[group_id] = (key, manifest)
+                self._cache.move_to_end(group_id)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return manifest
+
+    def _load(self, group_id: int, key: Optional[Tuple[int, int]]) -> Tuple[Tuple[int, int], list]:
+        conn = db_pool(self.dsn).connect()
+        try:
+            cursor = conn.cursor()
+            if self.persist and key is not None:
+                cursor.execute("""
+                    SELECT manifest FROM group_manifests WHERE group_id = %s AND version = %s AND caption_epoch = %s
+                """, (group_id, key[0], key[1]))
+                row = cursor.fetchone()
+                if row:
+                    return key, row[0]
+
+            # Version, caption epoch and files from one snapshot
+            cursor.execute("""
+                SELECT g.manifest_version,
+                       (SELECT value::BIGINT FROM bot_settings WHERE key = 'caption_epoch'),
+                       f.telegram_file_id, f.file_type, f.file_name, f.serial_number, f.uploader_id,
+                       f.storage_channel_id, f.storage_message_id
+                FROM groups g
+                LEFT JOIN files f ON f.group_id = g.id
+                WHERE g.id = %s
+                ORDER BY f.serial_number ASC
+            """, (group_id,))
+            rows = cursor.fetchall()
+            if not rows:
+                return key or (0, 0), []
+            key = (rows[0][0] or 0, rows[0][1] or 0)
+            rows = [row for row in rows if row[2] is not None]
+
+            caption_context = get_caption_context(row[6] for row in rows)
+            manifest = [
+                [telegram_file_id, file_type, file_name,
+                 build_file_caption(file_name, serial_number, uploader_id, caption_context),
+                 storage_channel_id, storage_message_id]
+                for _, _, telegram_file_id, file_type, file_name, serial_number, uploader_id, storage_channel_id, storage_message_id in rows
+            ]
+
+            if self.persist:
+                cursor.execute("""
+                    INSERT INTO group_manifests (group_id, version, caption_epoch, manifest) VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (group_id) DO UPDATE
+                    SET version = EXCLUDED.version, caption_epoch = EXCLUDED.caption_epoch,
+                        manifest = EXCLUDED.manifest, built_at = CURRENT_TIMESTAMP
+                    WHERE (group_manifests.version, group_manifests.caption_epoch)
+                          < (EXCLUDED.version, EXCLUDED.caption_epoch)
+                """, (group_id, key[0], key[1], json.dumps(manifest)))
+                conn.commit()
+            return key, manifest
+        finally:
+            conn.close()
+
+###############################################################################
+# 4I — OFFLINE LINK SERVING (CIRCUIT BREAKER + LOCAL SNAPSHOT)
+###############################################################################
+class CircuitBreaker:
+    """Stops calling a failing dependency for a while.
+
+    After `threshold` consecutive failures the breaker opens and allow() refuses
+    calls; once `cooldown` seconds have passed a single trial call is let
+    through, whose success closes the breaker again.
+    """
+
+    def __init__(self, name: str, threshold: int, cooldown: float):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None  # monotonic time the breaker opened, None while closed
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_running or time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info(f"{self.name} circuit closed, back to normal operation")
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None:
+                self.opened_at = time.monotonic()  # Failed trial: wait another cooldown
+            elif self.failures >= self.threshold:
+                logger.warning(f"{self.name} circuit opened after {self.failures} consecutive failures")
+                self.opened_at = time.monotonic()
+
+class LinkSnapshot:
+    """On-disk SQLite copy of everything needed to serve links without Postgres.
+
+    Holds the servable links (active, no click limit, not expired, group not
+    deleted), the files and names of non-deleted groups and the caption
+    settings. A full build copies them in one database snapshot; afterwards the
+    link_snapshot_changes log filled by triggers is replayed incrementally: every
+    transaction whose id is at least the xmin recorded by the previous refresh
+    may not have been seen yet, and replaying an entry just re-copies the current
+    rows. Clicks served offline are counted here and written back once the
+    database answers again.
+    """
+
+    BATCH_SIZE = 1000
+    CHANGE_LOG_RETENTION = "1 day"
+
+    def __init__(self, path: str, dsn: str):
+        self.path = path
+        self.dsn = dsn
+        self.pending_clicks = defaultdict(int)  # link_code -> clicks served offline
+        self._clicks_lock = threading.Lock()  # Guards pending_clicks only, never held across I/O
+        self._local = threading.local()
+        self._caption_context = None
+        self._lock = threading.Lock()  # One refresh at a time
+        conn = sqlite3.connect(self.path)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS links (code TEXT PRIMARY KEY, link_type TEXT NOT NULL,
+                                                  file_id INTEGER, group_id INTEGER, expires_at REAL);
+                CREATE INDEX IF NOT EXISTS links_file ON links (file_id);
+                CREATE INDEX IF NOT EXISTS links_group ON links (group_id);
+                CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, group_id INTEGER NOT NULL,
+                                                  serial_number INTEGER, telegram_file_id TEXT, file_type TEXT,
+                                                  file_name TEXT, uploader_id INTEGER,
+                                                  storage_channel_id INTEGER, storage_message_id INTEGER);
+                CREATE INDEX IF NOT EXISTS files_group ON files (group_id, serial_number);
+                CREATE TABLE IF NOT EXISTS groups (id INTEGER PRIMARY KEY, name TEXT, manifest_version INTEGER);
+                CREATE TABLE IF NOT EXISTS caption_disabled (user_id INTEGER PRIMARY KEY);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            """)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _db(self) -> sqlite3.Connection:
+        """This thread's SQLite connection"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path)
+        return conn
+
+    # ---------------- serving ----------------
+
+    def lookup(self, link_code: str) -> Optional[tuple]:
+        """Return the link in the shape of FileStoreBot._fetch_link, or None if it cannot be served offline"""
+        row = self._db().execute("""
+            SELECT l.link_type, l.file_id, l.group_id, l.expires_at,
+                   f.telegram_file_id, f.file_type, f.file_name, f.uploader_id, f.id,
+                   f.storage_channel_id, f.storage_message_id, g.name, g.id, g.manifest_version
+            FROM links l
+            LEFT JOIN files f ON l.file_id = f.id
+            LEFT JOIN groups g ON l.group_id = g.id
+            WHERE l.code = ?
+        """, (link_code,)).fetchone()
+        if not row:
+            return None
+        (link_type, file_id, group_id, expires_at, telegram_file_id, file_type, file_name, uploader_id, file_db_id,
+         storage_channel_id, storage_message_id, group_name, group_db_id, manifest_version) = row
+        expired = expires_at is not None and expires_at <= time.time()
+        return (link_type, file_id, group_id, 1, telegram_file_id, file_type, file_name, uploader_id, group_name,
+                file_db_id, group_db_id, storage_channel_id, storage_message_id, expired,
+                manifest_version, None, False, False)
+
+    def group_manifest(self, group_id: int) -> list:
+        """The group's delivery list, in GroupManifestCache's format"""
+        caption_context = self.caption_context()
+        rows = self._db().execute("""
+            SELECT telegram_file_id, file_type, file_name, serial_number, uploader_id, storage_channel_id, storage_message_id
+            FROM files WHERE group_id = ? ORDER BY serial_number
+        """, (group_id,)).fetchall()
+        return [
+            [telegram_file_id, file_type, file_name,
+             build_file_caption(file_name, serial_number, uploader_id, caption_context),
+             storage_channel_id, storage_message_id]
+            for telegram_file_id, file_type, file_name, serial_number, uploader_id, storage_channel_id, storage_message_id in rows
+        ]
+
+    def caption_context(self) -> Tuple[bool, str, set]:
+        """Caption settings as of the last refresh, like get_caption_context"""
+        if self._caption_context is None:
+            db = self._db()
+            meta = dict(db.execute("SELECT key, value FROM meta WHERE key IN ('caption_enabled', 'custom_caption')"))
+            disabled = {row[0] for row in db.execute("SELECT user_id FROM caption_disabled")}
+            self._caption_context = (meta.get("caption_enabled", "1") == "1",
+                                     meta.get("custom_caption", CUSTOM_CAPTION), disabled)
+        return self._caption_context
+
+    def record_click(self, link_code: str):
+        """Count a click served offline (called on the event loop, so it must never wait for a refresh)"""
+        with self._clicks_lock:
+            self.pending_clicks[link_code] += 1
+
+    # ---------------- refreshing ----------------
+
+    def refresh(self) -> str:
+        """Bring the snapshot up to date, return what was done"""
+        with self._lock:
+            db = self._db()
+            meta = dict(db.execute("SELECT key, value FROM meta WHERE key IN ('watermark', 'refreshed_at')"))
+            conn = db_pool(self.dsn).connect()
+            try:
+                cursor = conn.cursor()
+                self._flush_clicks(conn)
+                if "watermark" not in meta or time.time() - float(meta["refreshed_at"]) > LINK_SNAPSHOT_MAX_AGE:
+                    summary = self._full_build(conn, db)
+                else:
+                    self._limit_statements(cursor)
+                    summary = self._apply_changes(cursor, db, meta["watermark"])
+                    conn.commit()
+                self._limit_statements(cursor)
+                cursor.execute(f"""
+                    DELETE FROM link_snapshot_changes WHERE changed_at < NOW() - INTERVAL '{self.CHANGE_LOG_RETENTION}'
+                """)
+                conn.commit()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                conn.close()
+            self._caption_context = None
+            return summary
+
+    @staticmethod
+    def _limit_statements(cursor):
+        """Statement timeout for the current transaction only (safe behind a transaction pooler)"""
+        cursor.execute("SET LOCAL statement_timeout = %s", (LINK_SNAPSHOT_STATEMENT_TIMEOUT,))
+
+    def _flush_clicks(self, conn):
+        """Write clicks served offline back to file_links; they are put back if that fails"""
+        with self._clicks_lock:
+            pending, self.pending_clicks = self.pending_clicks, defaultdict(int)
+        if not pending:
+            return
+        try:
+            cursor = conn.cursor()
+            self._limit_statements(cursor)
+            psycopg2.extras.execute_values(cursor, """
+                UPDATE file_links fl SET clicks = fl.clicks + v.clicks
+                FROM (VALUES %s) AS v(link_code, clicks) WHERE fl.link_code = v.link_code
+            """, list(pending.items()))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            with self._clicks_lock:
+                for code, clicks in pending.items():
+                    self.pending_clicks[code] += clicks
+            raise
+
+    def _full_build(self, conn, db: sqlite3.Connection) -> str:
+        cursor = conn.cursor()
+        # One consistent database snapshot; its xmin is where change replay starts
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        self._limit_statements(cursor)
+        cursor.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::TEXT")
+        watermark = cursor.fetchone()[0]
+
+        db.execute("DELETE FROM links")
+        db.execute("DELETE FROM files")
+        db.execute("DELETE FROM groups")
+        cursor.execute("SELECT id, name, manifest_version FROM groups WHERE deleted_at IS NULL")
+        db.executemany("INSERT INTO groups VALUES (?, ?, ?)", cursor.fetchall())
+        counts = {}
+        for table, query in (("files", self._files_query("")), ("links", self._links_query(""))):
+            stream = conn.cursor(name=f"link_snapshot_{table}")
+            stream.itersize = 10_000
+            stream.execute(query)
+            counts[table] = 0
+            while True:
+                rows = stream.fetchmany(10_000)
+                if not rows:
+                    break
+                self._insert(db, table, rows)
+                counts[table] += len(rows)
+            stream.close()
+        self._copy_caption_settings(cursor, db)
+        self._set_meta(db, watermark)
+        db.commit()
+        conn.commit()
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return f"rebuilt with {counts['links']} link(s) and {counts['files']} file(s)"
+
+    def _apply_changes(self, cursor, db: sqlite3.Connection, watermark: str) -> str:
+        cursor.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::TEXT")
+        new_watermark = cursor.fetchone()[0]
+        cursor.execute("""
+            SELECT entity, entity_id FROM link_snapshot_changes WHERE xid >= %s::XID8 GROUP BY entity, entity_id
+        """, (watermark,))
+        changes = cursor.fetchall()
+        group_ids = [int(entity_id) for entity, entity_id in changes if entity == "group"]
+        link_codes = [entity_id for entity, entity_id in changes if entity == "link"]
+
+        # Groups first: a deleted group takes its links along, which the link pass must not restore
+        for start in range(0, len(group_ids), self.BATCH_SIZE):
+            self._sync_groups(cursor, db, group_ids[start:start + self.BATCH_SIZE])
+        for start in range(0, len(link_codes), self.BATCH_SIZE):
+            self._sync_links(cursor, db, link_codes[start:start + self.BATCH_SIZE])
+        self._copy_caption_settings(cursor, db)
+        self._set_meta(db, new_watermark)
+        db.commit()
+        return f"{len(link_codes)} link(s) and {len(group_ids)} group(s) refreshed"
+
+    def _sync_groups(self, cursor, db: sqlite3.Connection, group_ids: list):
+        cursor.execute("""
+            SELECT id, name, manifest_version FROM groups WHERE id = ANY(%s) AND deleted_at IS NULL
+        """, (group_ids,))
+        current = {row[0]: row for row in cursor.fetchall()}
+        marks = ",".join("?" * len(group_ids))
+        known = dict(db.execute(f"SELECT id, manifest_version FROM groups WHERE id IN ({marks})", group_ids))
+
+        gone = [group_id for group_id in group_ids if group_id not in current]
+        if gone:
+            gone_marks = ",".join("?" * len(gone))
+            db.execute(f"""
+                DELETE FROM links WHERE group_id IN ({gone_marks})
+                   OR file_id IN (SELECT id FROM files WHERE group_id IN ({gone_marks}))
+            """, gone + gone)
+            db.execute(f"DELETE FROM files WHERE group_id IN ({gone_marks})", gone)
+            db.execute(f"DELETE FROM groups WHERE id IN ({gone_marks})", gone)
+
+        db.executemany("INSERT OR REPLACE INTO groups VALUES (?, ?, ?)", list(current.values()))
+        stale = [group_id for group_id, row in current.items() if known.get(group_id) != row[2]]
+        if stale:
+            db.execute(f"DELETE FROM files WHERE group_id IN ({','.join('?' * len(stale))})", stale)
+            cursor.execute(self._files_query("AND f.group_id = ANY(%s)"), (stale,))
+            self._insert(db, "files", cursor.fetchall())
+
+    def _sync_links(self, cursor, db: sqlite3.Connection, link_codes: list):
+        cursor.execute(self._links_query("AND fl.link_code = ANY(%s)"), (link_codes,))
+        rows = cursor.fetchall()
+        db.executemany("DELETE FROM links WHERE code = ?", [(code,) for code in link_codes])
+        self._insert(db, "links", rows)
+
+        # A link can point at a group that never changed since the last full build (an empty one)
+        group_ids = {group_id for group_id in (row[3] for row in rows) if group_id is not None}
+        known = {row[0] for row in db.execute(
+            f"SELECT id FROM groups WHERE id IN ({','.join('?' * len(group_ids))})", list(group_ids))} if group_ids else set()
+        missing = sorted(group_ids - known)
+        if missing:
+            self._sync_groups(cursor, db, missing)
+
+    @staticmethod
+    def _files_query(condition: str) -> str:
+        return f"""
+            SELECT f.id, f.group_id, f.serial_number, f.telegram_file_id, f.file_type, f.file_name, f.uploader_id,
+                   f.storage_channel_id, f.storage_message_id
+            FROM files f JOIN groups g ON g.id = f.group_id
+            WHERE g.deleted_at IS NULL {condition}
+        """
+
+    @staticmethod
+    def _links_query(condition: str) -> str:
+        # Click-limited links need the database to count clicks, so they are never served offline
+        return f"""
+            SELECT fl.link_code, fl.link_type, fl.file_id, fl.group_id,
+                   EXTRACT(EPOCH FROM fl.expires_at - NOW())::FLOAT8
+            FROM file_links fl
+            LEFT JOIN files f ON f.id = fl.file_id
+            JOIN groups g ON g.id = COALESCE(fl.group_id, f.group_id)
+            WHERE fl.is_active = 1 AND fl.max_clicks IS NULL
+              AND (fl.expires_at IS NULL OR fl.expires_at > NOW()) AND g.deleted_at IS NULL {condition}
+        """
+
+    @staticmethod
+    def _insert(db: sqlite3.Connection, table: str, rows: list):
+        if table == "links":
+            now = time.time()
+            rows = [(code, link_type, file_id, group_id, None if remaining is None else now + remaining)
+                    for code, link_type, file_id, group_id, remaining in rows]
+            db.executemany("INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?, ?)", rows)
+        else:
+            db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    @staticmethod
+    def _copy_caption_settings(cursor, db: sqlite3.Connection):
+        cursor.execute("SELECT key, value FROM bot_settings WHERE key IN ('caption_enabled', 'custom_caption')")
+        db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", cursor.fetchall())
+        cursor.execute("SELECT user_id FROM authorized_users WHERE caption_disabled <> 0")
+        db.execute("DELETE FROM caption_disabled")
+        db.executemany("INSERT INTO caption_disabled VALUES (?)",
+                       [row for row in cursor.fetchall() if not is_admin(row[0])])
+
+    @staticmethod
+    def _set_meta(db: sqlite3.Connection, watermark: str):
+        db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                       [("watermark", watermark), ("refreshed_at", str(time.time()))])
+
+###############################################################################
+# 4J — STARTUP READINESS
+###############################################################################
+class StartupTracker:
+    """Progress of the background warm-up, reported by /readyz.
+
+    Times are seconds since this module was imported. Each warm-up step is
+    retried with backoff until it succeeds; the bot is ready once every
+    registered step is done. Updates are only held back until the schema
+    check has finished (schema_ready).
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.steps = {}  # name -> "pending", "done" or "retrying: <error>"
+        self.durations = {}  # name -> seconds the step took, retries included
+        self.ready_after = None
+        self.first_update_after = None
+        self.first_update_held = None  # Seconds the first update waited for the schema check
+        self.schema_ready = asyncio.Event()
+
+    @property
+    def ready(self) -> bool:
+        return self.ready_after is not None
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def expect(self, *names: str):
+        for name in names:
+            self.steps.setdefault(name, "pending")
+
+    async def run(self, name: str, step):
+        """Await step() until it succeeds"""
+        self.expect(name)
+        started = time.monotonic()
+        delay = 2
+        while True:
+            try:
+                await step()
+                break
+            except Exception as e:
+                self.steps[name] = f"retrying: {e}"
+                logger.warning(f"Startup step '{name}' failed, retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+        self.steps[name] = "done"
+        self.durations[name] = time.monotonic() - started
+        logger.info(f"Startup step '{name}' done in {self.durations[name]:.2f}s")
+
+    def mark_ready(self):
+        if all(status == "done" for status in self.steps.values()):
+            self.ready_after = self.elapsed()
+            logger.info(f"Bot ready {self.ready_after:.2f}s after start")
+
+    def update_received(self) -> bool:
+        """Note an incoming update; True for the first one"""
+        if self.first_update_after is not None:
+            return False
+        self.first_update_after = self.elapsed()
+        return True
+
+    def report(self) -> dict:
+        return {
+            "ready": self.ready,
+            "uptime_s": round(self.elapsed(), 2),
+            "ready_after_s": None if self.ready_after is None else round(self.ready_after, 2),
+            "first_update_after_s": None if self.first_update_after is None else round(self.first_update_after, 2),
+            "first_update_held_s": None if self.first_update_held is None else round(self.first_update_held, 2),
+            "steps": {name: {"status": status, "seconds": round(self.durations[name], 2) if name in self.durations else None}
+                      for name, status in self.steps.items()},
+        }
+
+startup = StartupTracker()
+
+###############################################################################
+# 4K — PAGINATED LISTINGS
+###############################################################################
+def telegram_length(text: str) -> int:
+    """Message length as Telegram counts it (UTF-16 code units, so most emoji count twice)"""
+    return len(text.encode("utf-16-le")) // 2
+
+def render_pages(title: str, records: list, footer_rows: list, page_callback) -> list:
+    """Split a listing into messages at record boundaries.
+
+    records are (text, button rows) pairs. A page takes whole records while its
+    text stays within MESSAGE_TEXT_LIMIT and its keyboard within
+    MESSAGE_BUTTON_LIMIT, counting the title, page number, navigation row and
+    footer_rows. page_callback(page) gives the navigation buttons' callback data.
+    Returns [(text, keyboard rows)], at least one page.
+    """
+    text_room = MESSAGE_TEXT_LIMIT - telegram_length(f"{title} (page 9999/9999)\n\n")
+    button_room = MESSAGE_BUTTON_LIMIT - 2 - sum(len(row) for row in footer_rows)
+    chunks = [[]]
+    used_text = used_buttons = 0
+    for text, rows in records:
+        length = telegram_length(text)
+        if length > text_room:
+            text = text[:text_room // 2 - 1] + "…"  # Halved: a worst case of two units per character
+            length = telegram_length(text)
+        buttons = sum(len(row) for row in rows)
+        if chunks[-1] and (used_text + length > text_room or used_buttons + buttons > button_room):
+            chunks.append([])
+            used_text = used_buttons = 0
+        chunks[-1].append((text, rows))
+        used_text += length
+        used_buttons += buttons
+
+    pages = []
+    for index, chunk in enumerate(chunks):
+        heading = title if len(chunks) == 1 else f"{title} (page {index + 1}/{len(chunks)})"
+        text = "".join([heading, "\n\n", *(text for text, _ in chunk)]).rstrip()
+        keyboard = [row for _, rows in chunk for row in rows]
+        navigation = []
+        if index > 0:
+            navigation.append(InlineKeyboardButton("⬅️ Prev", callback_data=page_callback(index - 1)))
+        if index < len(chunks) - 1:
+            navigation.append(InlineKeyboardButton("Next ➡️", callback_data=page_callback(index + 1)))
+        if navigation:
+            keyboard.append(navigation)
+        keyboard.extend(footer_rows)
+        pages.append((text, keyboard))
+    return pages
+
+class PageCache:
+    """Rendered listing pages per listing, valid for one data version.
+
+    A changed version simply misses and the listing is rendered again, so the
+    cache never has to be invalidated.
+    """
+
+    def __init__(self, max_entries: int = PAGE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._cache = OrderedDict()  # listing -> (version, pages)
+        self._lock = threading.Lock()
+
+    def get(self, listing, version) -> Optional[list]:
+        with self._lock:
+            entry = self._cache.get(listing)
+            if not entry or entry[0] != version:
+                return None
+            self._cache.move_to_end(listing)
+            return entry[1]
+
+    def put(self, listing, version, pages: list):
+        with self._lock:
+            self._cache[listing] = (version, pages)
+            self._cache.move_to_end(listing)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+###############################################################################
+# 4L — CALLBACK STATE TOKENS
+###############################################################################
+class CallbackState:
+    """Button callback data that can carry more than Telegram's 64 bytes.
+
+    pack() signs a small state inline ("!action:json:signature"), which needs no
+    server memory and stays valid across restarts and replicas. A state too big
+    for that is kept in memory under a short random key ("~action:key") for
+    CALLBACK_STATE_TTL seconds, least recently used first out. Either way the
+    token only works for the user it was made for; unpack() returns
+    (action, state), or None for a forged, foreign or expired token.
+    """
+
+    INLINE = "!"
+    STORED = "~"
+    MAX_BYTES = 64
+
+    def __init__(self, secret: bytes, ttl: int = CALLBACK_STATE_TTL, max_entries: int = CALLBACK_STATE_MAX_ENTRIES):
+        self.secret = secret
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._store = OrderedDict()  # key -> (user_id, action, json payload, monotonic expiry)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def is_token(cls, data: str) -> bool:
+        return data[:1] in (cls.INLINE, cls.STORED)
+
+    def pack(self, user_id: int, action: str, state) -> str:
+        payload = json.dumps(state, separators=(",", ":"), ensure_ascii=False)
+        data = f"{self.INLINE}{action}:{payload}:{self._sign(user_id, action, payload)}"
+        if len(data.encode()) <= self.MAX_BYTES:
+            return data
+
+        key = generate_id()[:10]
+        with self._lock:
+            self._store[key] = (user_id, action, payload, time.monotonic() + self.ttl)
+            while len(self._store) > self.max_entries:
+                self._store.popitem(last=False)
+        return f"{self.STORED}{action}:{key}"
+
+    def unpack(self, user_id: int, data: str) -> Optional[Tuple[str, Any]]:
+        if data.startswith(self.INLINE):
+            try:
+                action, rest = data[1:].split(":", 1)
+                payload, signature = rest.rsplit(":", 1)
+            except ValueError:
+                return None
+            if not hmac.compare_digest(signature, self._sign(user_id, action, payload)):
+                return None
+            return action, json.loads(payload)
+
+        action, _, key = data[1:].partition(":")
+        with self._lock:
+            entry = self._store.get(key)
+            if not entry or entry[3] < time.monotonic():
+                self._store.pop(key, None)
+                return None
+            self._store.move_to_end(key)
+        if entry[0] != user_id or entry[1] != action:
+            return None
+        return action, json.loads(entry[2])
+
+    def _sign(self, user_id: int, action: str, payload: str) -> str:
+        digest = hmac.new(self.secret, f"{user_id}:{action}:{payload}".encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest[:9]).decode()
+
+###############################################################################
+# 4M — ADMIN BROADCASTS
+###############################################################################
+BROADCAST_LOCK_ID = 720_050  # With the broadcast id: only one replica sends a broadcast
+
+class Broadcaster:
+    """Sends an admin's message to every active authorized user in the background.
+
+    Recipients are read in user_id order, BROADCAST_BATCH_SIZE at a time, and the
+    broadcasts row is checkpointed after each batch: a restart resumes after the
+    last finished batch, so nobody is skipped and at most one batch is sent
+    twice. Sends are paced by BROADCAST_RATE and also spend the main bot's
+    delivery budget, only while half of it is left, so link deliveries keep
+    priority. A flood-wait pauses the broadcast and puts the main bot on
+    cooldown; users who blocked the bot or deleted their account are deactivated.
+    """
+
+    MAX_ATTEMPTS = 5
+    BLOCKED_REASONS = ("bot was blocked by the user", "user is deactivated")
+
+    def __init__(self, delivery: DeliveryPool, rate: float = BROADCAST_RATE):
+        self.main = delivery.members[0]
+        self.rate = rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.running = set()  # broadcast ids
+
+    def create(self, admin_id: int, text: Optional[str], source: Optional[Tuple[int, int]],
+               progress: Tuple[int, int]) -> Tuple[int, int]:
+        """Store a new broadcast of text or of the source (chat_id, message_id), return (id, recipients)"""
+        conn = get_db_connection(user_id=admin_id)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO broadcasts (admin_id, message_text, source_chat_id, source_message_id,
+                                        progress_chat_id, progress_message_id, total)
+                SELECT %s, %s, %s, %s, %s, %s, COUNT(*) FROM authorized_users WHERE is_active = 1 AND user_id <> %s
+                RETURNING id, total
+            """, (admin_id, text, *(source or (None, None)), *progress, admin_id))
+            row = cursor.fetchone()
+            conn.commit()
+            return row
+        finally:
+            conn.close()
+
+    def pending(self) -> list:
+        """(id, progress_chat_id, progress_message_id) of unfinished broadcasts, oldest first"""
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, progress_chat_id, progress_message_id FROM broadcasts WHERE status = 'running' ORDER BY id
+            """)
+            return cursor.fetchall()
+        finally:
+            conn.close()
+
+    def cancel(self, broadcast_id: Optional[int] = None) -> list:
+        """Stop one running broadcast, or all of them; the sender notices at its next checkpoint"""
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE broadcasts SET status = 'cancelled', updated_at = NOW()
+                WHERE status = 'running' AND (%s IS NULL OR id = %s)
+                RETURNING id
+            """, (broadcast_id, broadcast_id))
+            cancelled = [row[0] for row in cursor.fetchall()]
+            conn.commit()
+            return cancelled
+        finally:
+            conn.close()
+
+    async def run(self, broadcast_id: int, progress=None) -> Optional[dict]:
+        """Send a broadcast to the end of the recipient list, None if another replica is sending it.
+
+        progress(stats) is awaited at most every BROADCAST_PROGRESS_INTERVAL seconds.
+        """
+        lock_conn = await asyncio.to_thread(self._lock, broadcast_id)
+        if lock_conn is None:
+            return None
+        self.running.add(broadcast_id)
+        try:
+            admin_id, text, source, last_user_id, total, sent, failed, blocked, status = \
+                await asyncio.to_thread(self._load, broadcast_id)
+            stats = {"broadcast_id": broadcast_id, "total": total, "sent": sent, "failed": failed,
+                     "blocked": blocked, "status": status, "rate": 0.0}
+            started = last_report = time.monotonic()
+            semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+            async def send(user_id):
+                async with semaphore:
+                    return await self._send(user_id, text, source)
+
+            done = 0
+            while stats["status"] == "running":
+                recipients = await asyncio.to_thread(self._next_batch, admin_id, last_user_id)
+                if not recipients:
+                    stats["status"] = await asyncio.to_thread(self._finish, broadcast_id)
+                    break
+                results = await asyncio.gather(*(send(user_id) for user_id in recipients))
+                blocked_ids = [user_id for user_id, result in zip(recipients, results) if result == "blocked"]
+                last_user_id = recipients[-1]
+                stats["status"] = await asyncio.to_thread(
+                    self._checkpoint, broadcast_id, last_user_id, results.count("sent"), results.count("failed"),
+                    blocked_ids)
+                stats["sent"] += results.count("sent")
+                stats["failed"] += results.count("failed")
+                stats["blocked"] += len(blocked_ids)
+                done += len(recipients)
+                now = time.monotonic()
+                stats["rate"] = done / max(now - started, 0.001)
+                if progress and stats["status"] == "running" and now - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                    last_report = now
+                    await progress(stats)
+            return stats
+        finally:
+            self.running.discard(broadcast_id)
+            lock_conn.close()  # Ends the session and its advisory lock
+
+    async def _send(self, user_id: int, text: Optional[str], source: Optional[Tuple[int, int]]) -> str:
+        """Deliver to one user, return 'sent', 'blocked' or 'failed'"""
+        for attempt in range(self.MAX_ATTEMPTS):
+            await self._acquire()
+            try:
+                if source:
+                    await self.main.bot.copy_message(user_id, source[0], source[1])
+                else:
+                    await self.main.bot.send_message(user_id, text)
+                return "sent"
+            except RetryAfter as e:
+                until = time.monotonic() + e.retry_after
+                self.paused_until = max(self.paused_until, until)
+                self.main.cooldown_until = max(self.main.cooldown_until, until)
+                logger.warning(f"Broadcast rate limited for {e.retry_after}s, pausing")
+            except Forbidden as e:
+                # Only a block or a deleted account deactivates; "can't initiate conversation"
+                # just means the user has not opened the bot yet and keeps their access
+                if any(reason in str(e).lower() for reason in self.BLOCKED_REASONS):
+                    return "blocked"
+                logger.warning(f"Broadcast to {user_id} failed: {e}")
+                return "failed"
+            except BadRequest as e:
+                logger.warning(f"Broadcast to {user_id} failed: {e}")
+                return "failed"
+            except NetworkError as e:
+                logger.warning(f"Broadcast to {user_id} failed (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+        return "failed"
+
+    async def _acquire(self):
+        """Wait for a send slot: our own rate, no flood-wait, and half of the main bot's budget left"""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(1.0, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            needed = max(1.0, self.main.capacity / 2)
+            main_tokens = self.main.available()
+            if now >= self.paused_until and self.tokens >= 1 and main_tokens >= needed:
+                self.tokens -= 1
+                self.main.tokens -= 1
+                return
+            await asyncio.sleep(max(self.paused_until - now, (1 - self.tokens) / self.rate,
+                                    self.main.cooldown_until - now, (needed - main_tokens) / self.main.rate, 0.01))
+
+    def _lock(self, broadcast_id: int):
+        """Return a connection holding the broadcast's advisory lock, or None if another replica has it"""
+        conn = get_db_connection(direct=True)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", (BROADCAST_LOCK_ID, broadcast_id))
+            locked = cursor.fetchone()[0]
+            conn.commit()
+        except Exception:
+            conn.close()
+            raise
+        if not locked:
+            conn.close()
+            return None
+        return conn
+
+    def _load(self, broadcast_id: int) -> tuple:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT admin_id, message_text, source_chat_id, source_message_id, last_user_id,
+                       total, sent, failed, blocked, status
+                FROM broadcasts WHERE id = %s
+            """, (broadcast_id,))
+            admin_id, text, source_chat_id, source_message_id, *rest = cursor.fetchone()
+            source = (source_chat_id, source_message_id) if source_message_id else None
+            return (admin_id, text, source, *rest)
+        finally:
+            conn.close()
+
+    def _next_batch(self, admin_id: int, last_user_id: int) -> list:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT user_id FROM authorized_users
+                WHERE is_active = 1 AND user_id > %s AND user_id <> %s
+                ORDER BY user_id LIMIT %s
+            """, (last_user_id, admin_id, BROADCAST_BATCH_SIZE))
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            conn.close()
+
+    def _checkpoint(self, broadcast_id: int, last_user_id: int, sent: int, failed: int, blocked_ids: list) -> str:
+        """Deactivate blocked users and advance the checkpoint in one transaction, return the status"""
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            if blocked_ids:
+                cursor.execute("""
+                    UPDATE authorized_users SET is_active = 0 WHERE user_id = ANY(%s) AND user_id <> ALL(%s)
+                """, (blocked_ids, ADMIN_IDS))
+            cursor.execute("""
+                UPDATE broadcasts SET last_user_id = %s, sent = sent + %s, failed = failed + %s,
+                                      blocked = blocked + %s, updated_at = NOW()
+                WHERE id = %s
+                RETURNING status
+            """, (last_user_id, sent, failed, len(blocked_ids), broadcast_id))
+            status = cursor.fetchone()[0]
+            conn.commit()
+            return status
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _finish(self, broadcast_id: int) -> str:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE broadcasts SET status = CASE WHEN status = 'running' THEN 'done' ELSE status END,
+                                      updated_at = NOW()
+                WHERE id = %s
+                RETURNING status
+            """, (broadcast_id,))
+            status = cursor.fetchone()[0]
+            conn.commit()
+            return status
+        finally:
+            conn.close()
+
+###############################################################################
+# 5 — MAIN BOT CLASS WITH COMPLETE WORKING FUNCTIONS
+###############################################################################
+class FileStoreBot:
+    def __init__(self, application: Application):
+        self.app = application
+        # Nothing here touches the database; warm_up() does that once the health server is up
+
+        # Bulk uploads, single uploads and caption edits are shared across replicas
+        self.listener = PgNotificationListener(SUPABASE_DIRECT_URL)
+        self.sessions = SessionStore(SUPABASE_URL, self.listener)
+        # Bogus /start codes are rejected from memory; the filter is built during warm-up
+        self.link_filter = LinkCodeFilter(SUPABASE_URL, self.listener)
+        # Group deletions run in the background; pick up any a restart interrupted
+        self.deleting_groups = set()
+
+        # Storage channel upkeep: delete posts of deleted files, periodically reconcile
+        self.shards = StorageShards(STORAGE_CHANNEL_IDS, STORAGE_PLACEMENT)
+        self.mtproto = MTProtoClient()
+        self.reconciler = StorageReconciler(self, self.mtproto)
+        self.importer = ChannelImporter(self.mtproto)
+
+        # Link deliveries are spread over the main bot and any helper bots
+        self.delivery = DeliveryPool(self.app.bot, HELPER_BOT_TOKENS, DELIVERY_RATE_PER_BOT)
+        # Broadcasts share the main bot's budget with deliveries, which keep priority
+        self.broadcaster = Broadcaster(self.delivery)
+        self.link_guard = LinkAccessGuard()
+        self.manifests = GroupManifestCache(SUPABASE_URL)
+        # Links keep working from a local snapshot while the database is failing
+        self.db_breaker = CircuitBreaker("Database", DB_BREAKER_FAILURES, DB_BREAKER_COOLDOWN)
+        self.link_snapshot = LinkSnapshot(LINK_SNAPSHOT_PATH, SUPABASE_URL) if LINK_SNAPSHOT_PATH else None
+
+        # Inline mode: per-query answer cache and the newest query id per user (debouncing)
+        self.inline_cache = OrderedDict()
+        self.inline_latest = {}
+        # Rendered pages of long listings, keyed by the version of the data they show
+        self.pages = PageCache()
+        # Buttons with more state than fits in callback_data; signed with a key derived from the token
+        self.callback_state = CallbackState(hashlib.sha256(b"callback-state:" + (BOT_TOKEN or "").encode()).digest())
+        self.warm_up_task = None
+
+    # ================= STARTUP =================
+
+    async def post_init(self, application: Application):
+        """Start warming up in the background so updates are fetched right away"""
+        self.warm_up_task = asyncio.create_task(self.warm_up())
+
+    async def warm_up(self):
+        """Schema check, connection pool and caches, concurrently where they do not depend on each other"""
+        startup.expect("schema", "database_pool", "link_filter")
+        if self.link_snapshot:
+            startup.expect("link_snapshot")
+        if db_router.enabled:
+            startup.expect("read_replica")
+
+        async def open_connections():
+            pool = db_pool(SUPABASE_URL)
+            connections = await asyncio.gather(*(asyncio.to_thread(pool.connect) for _ in range(min(DB_POOL_SIZE, 4))))
+            for conn in connections:
+                conn.close()
+
+        async def schema_then_caches():
+            await startup.run("schema", lambda: asyncio.to_thread(init_database))
+            startup.schema_ready.set()
+            self.listener.start()
+            self._schedule_jobs()
+            caches = [startup.run("link_filter", lambda: asyncio.to_thread(self.link_filter.rebuild))]
+            if self.link_snapshot:
+                caches.append(startup.run("link_snapshot", lambda: asyncio.to_thread(self.link_snapshot.refresh)))
+            await asyncio.gather(*caches)
+
+        steps = [schema_then_caches(), startup.run("database_pool", open_connections)]
+        if db_router.enabled:
+            steps.append(startup.run("read_replica", lambda: asyncio.to_thread(db_router.check)))
+        await asyncio.gather(*steps)
+        startup.mark_ready()
+
+    def _schedule_jobs(self):
+        """Periodic database jobs, started once the schema is in place"""
+        self.app.job_queue.run_repeating(self._rebuild_link_filter, interval=LINK_FILTER_REBUILD_INTERVAL,
+                                         first=LINK_FILTER_REBUILD_INTERVAL)
+        self.app.job_queue.run_repeating(self._sweep_expired_links, interval=LINK_SWEEP_INTERVAL, first=90)
+        self.app.job_queue.run_repeating(self._resume_group_deletions, interval=3600, first=30)
+        self.app.job_queue.run_repeating(self._resume_broadcasts, interval=600, first=20)
+        self.app.job_queue.run_repeating(self._sweep_expired_sessions, interval=600, first=60)
+        self.app.job_queue.run_repeating(self._reconcile_group_counters, interval=GROUP_RECONCILE_INTERVAL, first=600)
+        # Reads move to the read replica only after a lag check has passed
+        if db_router.enabled:
+            self.app.job_queue.run_repeating(self._check_read_replica, interval=READ_REPLICA_CHECK_INTERVAL,
+                                             first=READ_REPLICA_CHECK_INTERVAL)
+        if self.link_snapshot:
+            self.app.job_queue.run_repeating(self._refresh_link_snapshot, interval=LINK_SNAPSHOT_REFRESH_INTERVAL,
+                                             first=LINK_SNAPSHOT_REFRESH_INTERVAL)
+        self.app.job_queue.run_repeating(self._drain_storage_gc, interval=STORAGE_GC_INTERVAL, first=120)
+        if RECONCILE_INTERVAL and self.reconciler.enabled:
+            self.app.job_queue.run_repeating(self._scheduled_reconcile, interval=RECONCILE_INTERVAL, first=RECONCILE_INTERVAL)
+
+    async def wait_for_schema(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Hold updates until the schema check has finished (runs before every other handler)"""
+        first = startup.update_received()
+        if not startup.schema_ready.is_set():
+            waited = time.monotonic()
+            await startup.schema_ready.wait()
+            if first:
+                startup.first_update_held = time.monotonic() - waited
+        elif first:
+            startup.first_update_held = 0.0
+        if first:
+            logger.info(f"First update received {startup.first_update_after:.2f}s after start, "
+                        f"held {startup.first_update_held:.2f}s for the schema check")
+
+    # ================= COMMAND HANDLERS =================
+
+    async def start_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /start command with authorization check"""
+        user = update.effective_user
+
+        # Handle deep-link access (anyone can access files)
+        link_code = None
+        if context.args:
+            link_code = context.args[0]
+        elif update.message and " " in update.message.text:
+            link_code = update.message.text.split(maxsplit=1)[1]
+
+        if link_code:
+            # Throttle before any database work; abusers get at most one cheap reply per minute.
+            # Codes the link filter rejects are not charged to the per-link and global budgets.
+            guarded = not is_admin(user.id)
+            rejection = self.link_guard.check(user.id, link_code, self.link_filter.might_exist(link_code)) if guarded else None
+            if rejection:
+                logger.debug(f"Link {link_code} request from {user.id} rejected: {rejection}")
+                if self.link_guard.should_notify(user.id):
+                    if rejection == "duplicate":
+                        await update.message.reply_text("This link is already being sent to you ⬆️")
+                    else:
+                        await update.message.reply_text("Too many requests ⏳\n\nPlease wait a minute and open the link again.")
+                return
+
+            delivered = False
+            try:
+                delivered = await self._handle_link_access(update, context, link_code)
+            finally:
+                if guarded:
+                    self.link_guard.finish(user.id, link_code, delivered)
+            return
+
+        # Check authorization for bot usage
+        if not await asyncio.to_thread(is_user_authorized, user.id):
+            keyboard = [[InlineKeyboardButton("Contact Admin 👨‍💻", url=f"https://t.me/{ADMIN_CONTACT.replace('@', '')}")]]
+            await update.message.reply_text(
+                f"Access Denied 🚫\n\n"
+                f"You need permission to use this bot.\n\n"
+                f"Contact Admin: {ADMIN_CONTACT}\n"
+                f"Your User ID: {user.id}\n\n"
+                f"Note: Anyone can access files through shared links! 🔗",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+            return
+
+        # Show main menu
+        await self._show_main_menu(update.message, user)
+
+    async def clear_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /clear command - Admin only."""
+        if not is_admin(update.effective_user.id):
+            await update.message.reply_text("Unauthorized: Admin access required 🚫")
+            return
+
+        clear_console()
+        logger.info("Console cleared by user command")
+        await update.message.reply_text("Console Cleared ✅\n\nAll console logs have been cleared.")
+
+    async def upload_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /upload command"""
+        if not await asyncio.to_thread(is_user_authorized, update.effective_user.id):
+            await update.message.reply_text(f"Unauthorized. Contact admin: {ADMIN_CONTACT} 🚫")
+            return
+
+        if not context.args:
+            await update.message.reply_text(
+                "Usage Error ❌\n\n"
+                "Correct usage: /upload <group_name>\n"
+                "Example: /upload MyDocuments"
+            )
+            return
+
+        group_name = " ".join(context.args)
+        await self.sessions.set('upload', update.effective_user.id, {'mode': 'single', 'group_name': group_name})
+
+        keyboard = [[InlineKeyboardButton("Cancel Upload ❌", callback_data="cancel_upload")]]
+
+        await update.message.reply_text(
+            f"Single Upload Mode ⬆️\n\n"
+            f"Group: {group_name} 📁\n"
+            "Send me the file you want to upload.\n"
+            "Supported: Photos 📸, Videos 🎬, Documents 📄, Audio 🎵, Voice \n"
+            f"Max Size: {format_size(MAX_FILE_SIZE)}",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+
+    async def bulkupload_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /bulkupload command"""
+        if not await asyncio.to_thread(is_user_authorized, update.effective_user.id):
+            await update.message.reply_text(f"Unauthorized. Contact admin: {ADMIN_CONTACT} 🚫")
+            return
+
+        if not context.args:
             await update.message.reply_text(
                 "Usage Error ❌\n\n"
                 "Correct usage: /bulkupload <group_name>\n"
@@ -435,12 +3666,12 @@ class FileStoreBot:
         session_id = generate_id()
 
         # Create bulk session
-        self.bulk_sessions[user_id] = {
+        await self.sessions.set('bulk', user_id, {
             'session_id': session_id,
             'group_name': group_name,
             'files': [],
-            'started_at': datetime.now()
-        }
+            'started_at': datetime.now().isoformat()
+        })
 
         keyboard = [
             [
@@ -464,20 +3695,25 @@ class FileStoreBot:
         message_to_send = update.message if update.message else update.callback_query.message
         user_id = update.effective_user.id
 
-        if not is_user_authorized(user_id):
+        if not await asyncio.to_thread(is_user_authorized, user_id):
             await message_to_send.reply_text(f"Unauthorized. Contact admin: {ADMIN_CONTACT} 🚫")
             return
 
+        def load_groups():
+            conn = get_db_connection(read_only=True, user_id=user_id)
+            try:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT id, name, total_files, total_size, created_at
+                    FROM groups WHERE owner_id = %s AND deleted_at IS NULL
+                    ORDER BY created_at DESC LIMIT 20
+                """, (user_id,))
+                return cursor.fetchall()
+            finally:
+                conn.close()
+
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT id, name, total_files, total_size, created_at
-                FROM groups WHERE owner_id = %s
-                ORDER BY created_at DESC LIMIT 20
-            """, (user_id,))
-            groups = cursor.fetchall()
-            conn.close()
+            groups = await asyncio.to_thread(load_groups)
 
             text = ""
             keyboard = []
@@ -514,9 +3750,90 @@ class FileStoreBot:
             else:
                 await update.message.reply_text("Error loading groups. Please try again. 😔")
 
+    async def search_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /search command to find files by name across the user's groups."""
+        user_id = update.effective_user.id
+        if not await asyncio.to_thread(is_user_authorized, user_id):
+            await update.message.reply_text(f"Unauthorized. Contact admin: {ADMIN_CONTACT} 🚫")
+            return
+
+        search_text = " ".join(context.args).strip() if context.args else ""
+        if len(search_text) < 3:
+            await update.message.reply_text(
+                "Usage Error ❌\n\n"
+                "Correct usage: /search <text> (at least 3 characters)\n"
+                "Example: /search avengers"
+            )
+            return
+
+        await self._show_search_results(update.message, None, user_id, search_text, 0)
+
+    async def inline_query_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle @bot <text> inline queries with cached file results from the user's groups."""
+        inline_query = update.inline_query
+        user_id = inline_query.from_user.id
+        search_text = inline_query.query.strip()
+        offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+
+        if len(search_text) < 3:
+            await inline_query.answer([], cache_time=INLINE_CACHE_SECONDS, is_personal=True)
+            return
+
+        cache_key = (user_id, search_text.lower(), offset)
+        cached = self.inline_cache.get(cache_key)
+        if cached and cached[0] > time.monotonic():
+            self.inline_cache.move_to_end(cache_key)
+            await inline_query.answer(cached[1], cache_time=INLINE_CACHE_SECONDS, is_personal=True, next_offset=cached[2])
+            return
+
+        # Queries arrive on every keystroke: only the newest one after a short pause hits the database
+        self.inline_latest[user_id] = inline_query.id
+        await asyncio.sleep(INLINE_DEBOUNCE_SECONDS)
+        if self.inline_latest.get(user_id) != inline_query.id:
+            return
+        del self.inline_latest[user_id]
+
+        try:
+            if not await asyncio.to_thread(is_user_authorized, user_id):
+                await inline_query.answer([], cache_time=INLINE_CACHE_SECONDS, is_personal=True)
+                return
+
+            rows = await asyncio.to_thread(self._search_files, user_id, search_text, INLINE_PAGE_SIZE + 1, offset)
+            next_offset = str(offset + INLINE_PAGE_SIZE) if len(rows) > INLINE_PAGE_SIZE else ""
+            rows = rows[:INLINE_PAGE_SIZE]
+            caption_context = await asyncio.to_thread(get_caption_context, [row[6] for row in rows])
+
+            results = []
+            for file_id, serial_number, file_name, file_type, _, telegram_file_id, uploader_id, group_name in rows:
+                if is_imported_file_id(telegram_file_id):
+                    continue  # Cached inline results need a Bot API file_id
+                result_id = str(file_id)
+                caption = build_file_caption(file_name, serial_number, uploader_id, caption_context)
+                if file_type == "photo":
+                    results.append(InlineQueryResultCachedPhoto(result_id, telegram_file_id, title=file_name, caption=caption))
+                elif file_type == "video":
+                    results.append(InlineQueryResultCachedVideo(result_id, telegram_file_id, file_name, caption=caption))
+                elif file_type == "audio":
+                    results.append(InlineQueryResultCachedAudio(result_id, telegram_file_id, caption=caption))
+                elif file_type == "voice":
+                    results.append(InlineQueryResultCachedVoice(result_id, telegram_file_id, file_name, caption=caption))
+                elif file_type == "document":
+                    results.append(InlineQueryResultCachedDocument(result_id, file_name, telegram_file_id,
+                                                                   description=group_name, caption=caption))
+                # Video notes have no inline result type and are skipped
+
+            self.inline_cache[cache_key] = (time.monotonic() + INLINE_CACHE_SECONDS, results, next_offset)
+            while len(self.inline_cache) > INLINE_CACHE_MAX_ENTRIES:
+                self.inline_cache.popitem(last=False)
+
+            await inline_query.answer(results, cache_time=INLINE_CACHE_SECONDS, is_personal=True, next_offset=next_offset)
+
+        except Exception as e:
+            logger.error(f"Inline query error for user {user_id}: {e}")
+
     async def help_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /help command"""
-        _, custom_caption = get_caption_setting()
+        _, custom_caption = await asyncio.to_thread(get_caption_setting)
 
         help_text = f"""Complete Command Reference 📚
 
@@ -525,16 +3842,17 @@ Upload Commands:
 /bulkupload <group> - Upload multiple files 📦
 
 Delete Commands:
-/deletefile <group> <file_no> - Delete specific file 🗑️
+/deletefile <group> <file_no|3-40,52> - Delete files 🗑️
 /deletegroup <group> - Delete entire group 💥
 
 Link Commands:
-/getlink <group> <file_no> - Get file link 🔗
-/getgrouplink <group> - Get group link 🔗
+/getlink <group> <file_no> [ttl=2h] [clicks=50] - Get file link 🔗
+/getgrouplink <group> [ttl=2h] [clicks=50] - Get group link 🔗
 /revokelink <link_code> - Revoke a specific link 🚫 (NEW!)
 
 Info Commands:
 /groups - List all your groups 📂
+/search <text> - Find files across your groups 🔍
 /clear - Clear console logs ✨
 /start - Show main menu 🏠"""
 
@@ -546,7 +3864,11 @@ Admin Commands 👑:
 /adduser <user_id> [username] - Add user ➕
 /removeuser <user_id> - Remove user ➖
 /listusers - List all users 👥
-/botstats - Bot statistics 📊"""
+/botstats - Bot statistics 📊
+/reconcile - Sync storage channel with database 🔄
+/importchannel <channel_id> <group|#|/regex/> - Import a channel into groups 📥
+/broadcast <text> - Message all users (or reply to a message) 📣
+/broadcast stop [id] - Stop a running broadcast ⏹️"""
 
         help_text += f"""
 
@@ -588,26 +3910,44 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
             username = context.args[1] if len(context.args) > 1 else None
             first_name = update.message.from_user.first_name # Capture invoker's first name
 
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
+            admin_id = update.effective_user.id
+
+            def add_user() -> str:
+                conn = get_db_connection(user_id=admin_id)
+                try:
+                    cursor = conn.cursor()
 
-            # Check if user already exists
-            cursor.execute("SELECT user_id FROM authorized_users WHERE user_id = %s", (user_id,))
-            existing = cursor.fetchone()
+                    # Check if user already exists
+                    cursor.execute("SELECT is_active FROM authorized_users WHERE user_id = %s", (user_id,))
+                    existing = cursor.fetchone()
 
-            if existing:
-                conn.close()
+                    if existing and existing[0] != 1:
+                        # Deactivated, e.g. after blocking the bot during a broadcast
+                        cursor.execute("UPDATE authorized_users SET is_active = 1 WHERE user_id = %s", (user_id,))
+                        conn.commit()
+                        return "reactivated"
+
+                    if existing:
+                        return "exists"
+
+                    # Add user
+                    cursor.execute("""
+                        INSERT INTO authorized_users (user_id, username, first_name, added_by, is_active)
+                        VALUES (%s, %s, %s, %s, 1)
+                    """, (user_id, username, first_name, admin_id))
+                    conn.commit()
+                    return "added"
+                finally:
+                    conn.close()
+
+            outcome = await asyncio.to_thread(add_user)
+            if outcome == "reactivated":
+                await update.message.reply_text(f"User {user_id} reactivated! ✅")
+                return
+            if outcome == "exists":
                 await update.message.reply_text(f"User {user_id} is already authorized! 👥")
                 return
 
-            # Add user
-            cursor.execute("""
-                INSERT INTO authorized_users (user_id, username, first_name, added_by, is_active)
-                VALUES (%s, %s, %s, %s, 1)
-            """, (user_id, username, first_name, update.effective_user.id))
-            conn.commit()
-            conn.close()
-
             await update.message.reply_text(
                 f"User Added Successfully! ✅\n\n"
                 f"User ID: {user_id}\n"
@@ -638,98 +3978,198 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
                 await update.message.reply_text("Cannot remove admin users! 👑")
                 return
 
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM authorized_users WHERE user_id = %s", (user_id,))
-            rowcount = cursor.rowcount
-            conn.commit()
+            admin_id = update.effective_user.id
 
-            if rowcount > 0:
+            def remove_user() -> int:
+                conn = get_db_connection(user_id=admin_id)
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("DELETE FROM authorized_users WHERE user_id = %s", (user_id,))
+                    conn.commit()
+                    return cursor.rowcount
+                finally:
+                    conn.close()
+
+            if await asyncio.to_thread(remove_user) > 0:
                 await update.message.reply_text(f"User {user_id} removed successfully! ➖")
             else:
                 await update.message.reply_text(f"User {user_id} not found 🤷‍♂️")
 
-            conn.close()
-
         except ValueError:
             await update.message.reply_text("Invalid user ID format 🔢")
         except Exception as e:
             logger.error(f"Remove user error: {e}")
             await update.message.reply_text("Error removing user 😔")
 
-    async def list_users_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """List users command"""
+    async def list_users_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """List users command"""
+        if not is_admin(update.effective_user.id):
+            await update.message.reply_text("Unauthorized: Admin access required 🚫")
+            return
+
+        try:
+            pages = await asyncio.to_thread(self._user_listing_pages, update.effective_user.id, "users")
+            if not pages:
+                await update.message.reply_text("No regular users found 👥")
+                return
+
+            text, keyboard = pages[0]
+            await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None)
+
+        except Exception as e:
+            logger.error(f"List users error: {e}")
+            await update.message.reply_text("Error loading users 😔")
+
+    async def bot_stats_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Bot statistics command"""
+        if not is_admin(update.effective_user.id):
+            await update.message.reply_text("Unauthorized: Admin access required 🚫")
+            return
+
+        await self._show_detailed_stats(update.message)
+
+    async def reconcile_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /reconcile command - Admin only. Sync the storage channel with the database."""
         if not is_admin(update.effective_user.id):
             await update.message.reply_text("Unauthorized: Admin access required 🚫")
             return
 
-        try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT user_id, username, first_name, added_at, is_active, caption_disabled
-                FROM authorized_users WHERE user_id NOT IN (%s, %s)
-                ORDER BY added_at DESC
-            """, (ADMIN_IDS[0], ADMIN_IDS[1]))
-            users = cursor.fetchall()
-            conn.close()
+        if not self.reconciler.enabled:
+            await update.message.reply_text("Reconciliation needs API_ID and API_HASH to be set ⚙️")
+            return
 
-            if not users:
-                await update.message.reply_text("No regular users found 👥")
-                return
+        if self.reconciler.running:
+            await update.message.reply_text("A reconciliation pass is already running ⏳")
+            return
 
-            text = "Authorized Users 👥\n\n"
+        progress_msg = await update.message.reply_text("Storage reconciliation started... ⏳\nThis can take a while for large channels.")
+        context.application.create_task(self._run_reconcile(progress_msg))
 
-            for user_id, username, first_name, added_at, is_active, caption_disabled in users:
-                status = "Active ✅" if is_active else "Inactive ❌"
-                caption_status = "No Caption 🚫" if caption_disabled else "With Caption ✅"
+    async def importchannel_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /importchannel command - Admin only. Import a channel's media posts into groups."""
+        user_id = update.effective_user.id
+        if not is_admin(user_id):
+            await update.message.reply_text("Unauthorized: Admin access required 🚫")
+            return
 
-                added_at_str = added_at.strftime("%Y-%m-%d") if added_at else "N/A"  # Format datetime to string
+        if not self.importer.mtproto.enabled:
+            await update.message.reply_text("Channel import needs API_ID and API_HASH to be set ⚙️")
+            return
 
-                text += f"{first_name or 'Unknown'}\n"
-                text += f"ID: {user_id}\n"
-                text += f"@{username or 'None'}\n"
-                text += f"Status: {status}\n"
-                text += f"Caption: {caption_status}\n"
-                text += f"Added: {added_at_str}\n\n"
+        if len(context.args) < 2:
+            await update.message.reply_text(
+                "Usage Error ❌\n\n"
+                "Correct usage: /importchannel <channel_id> <mapping>\n\n"
+                "Mappings:\n"
+                "<group_name> - everything into one group 📁\n"
+                "# - one group per first hashtag in the caption #️⃣\n"
+                "/regex/ - group from the regex's first capture group (caption, then file name) 🔍\n\n"
+                "Example: /importchannel -1001234567890 #\n"
+                "The bot must be an admin of the source channel. Running the same import again resumes it "
+                "or picks up new posts."
+            )
+            return
 
-            # Split message if too long
-            if len(text) > 4000:
-                messages = [text[i:i+4000] for i in range(0, len(text), 4000)]
-                for msg in messages:
-                    await update.message.reply_text(msg)
-            else:
-                await update.message.reply_text(text)
+        try:
+            source_channel_id = int(context.args[0])
+            mapping = ChannelImporter.parse_mapping(" ".join(context.args[1:]))
+        except ValueError:
+            await update.message.reply_text("Invalid channel ID. Use the numeric -100... ID of the channel ❌")
+            return
+        except re.error as e:
+            await update.message.reply_text(f"Invalid regex: {e} ❌")
+            return
 
+        try:
+            job_id, last_message_id, imported_files = await asyncio.to_thread(self.importer.start_job, source_channel_id, user_id, mapping)
         except Exception as e:
-            logger.error(f"List users error: {e}")
-            await update.message.reply_text("Error loading users 😔")
+            logger.error(f"Error creating import job: {e}")
+            await update.message.reply_text("Error creating import job. 😔")
+            return
 
-    async def bot_stats_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Bot statistics command"""
-        if not is_admin(update.effective_user.id):
+        if job_id in self.importer.running:
+            await update.message.reply_text(f"Import job #{job_id} is already running ⏳")
+            return
+
+        resumed = f"\nResuming after message {last_message_id} ({imported_files} files so far)" if last_message_id else ""
+        progress_msg = await update.message.reply_text(f"Import job #{job_id} started... ⏳{resumed}")
+        context.application.create_task(self._run_import(job_id, progress_msg))
+
+    async def broadcast_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /broadcast command - Admin only. Message every active user in the background."""
+        user_id = update.effective_user.id
+        if not is_admin(user_id):
             await update.message.reply_text("Unauthorized: Admin access required 🚫")
             return
 
-        await self._show_detailed_stats(update.message)
+        args = context.args or []
+        if args and args[0].lower() == "stop" and len(args) <= 2:
+            try:
+                broadcast_id = int(args[1]) if len(args) > 1 else None
+                cancelled = await asyncio.to_thread(self.broadcaster.cancel, broadcast_id)
+            except ValueError:
+                await update.message.reply_text("Usage: /broadcast stop [broadcast_id]")
+                return
+            except Exception as e:
+                logger.error(f"Error stopping broadcast: {e}")
+                await update.message.reply_text("Error stopping broadcast 😔")
+                return
+            if cancelled:
+                await update.message.reply_text(f"Stopping broadcast {', '.join(f'#{i}' for i in cancelled)} ⏹️")
+            else:
+                await update.message.reply_text("No running broadcast found 🤷‍♂️")
+            return
+
+        reply = update.message.reply_to_message
+        if reply:
+            text, source = None, (reply.chat_id, reply.message_id)
+        elif args:
+            text, source = update.message.text.split(maxsplit=1)[1], None  # Keeps line breaks
+        else:
+            await update.message.reply_text(
+                "Usage Error ❌\n\n"
+                "Correct usage: /broadcast <text>\n"
+                "Or reply /broadcast to any message to send a copy of it (media included).\n\n"
+                "/broadcast stop [id] - stop a running broadcast\n\n"
+                f"Messages go out at about {BROADCAST_RATE:g} per second; users who blocked the bot are deactivated."
+            )
+            return
+
+        progress_msg = await update.message.reply_text("Broadcast starting... ⏳")
+        try:
+            broadcast_id, total = await asyncio.to_thread(
+                self.broadcaster.create, user_id, text, source, (progress_msg.chat_id, progress_msg.message_id))
+        except Exception as e:
+            logger.error(f"Error creating broadcast: {e}")
+            await progress_msg.edit_text("Error creating broadcast 😔")
+            return
+
+        logger.info(f"Broadcast #{broadcast_id} to {total} users started by {user_id}")
+        context.application.create_task(self._run_broadcast(broadcast_id, progress_msg.chat_id, progress_msg.message_id))
 
     async def getlink_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /getlink command to get a specific file link."""
-        if not is_user_authorized(update.effective_user.id):
+        if not await asyncio.to_thread(is_user_authorized, update.effective_user.id):
             await update.message.reply_text(f"Unauthorized. Contact admin: {ADMIN_CONTACT} 🚫")
             return
 
-        if len(context.args) < 2:
+        try:
+            args, ttl, max_clicks = parse_link_options(context.args)
+        except ValueError as e:
+            await update.message.reply_text(f"Invalid link option: {e} ❌\n\nExample: ttl=2h clicks=50")
+            return
+
+        if len(args) < 2:
             await update.message.reply_text(
                 "Usage Error ❌\n\n"
-                "Correct usage: /getlink <group_name> <file_number>\n"
+                "Correct usage: /getlink <group_name> <file_number> [ttl=2h] [clicks=50]\n"
                 "Example: /getlink MyDocuments 001"
             )
             return
 
-        group_name = context.args[0]
+        group_name = args[0]
         try:
-            file_serial_number = int(context.args[1])
+            file_serial_number = int(args[1])
             if file_serial_number <= 0:
                 await update.message.reply_text("File number must be positive. 🔢")
                 return
@@ -740,39 +4180,48 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
         user_id = update.effective_user.id
 
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
+            def get_file_link() -> Optional[tuple]:
+                conn = get_db_connection(user_id=user_id)
+                try:
+                    cursor = conn.cursor()
 
-            # Find the group and file
-            cursor.execute("""
-                SELECT f.id, f.file_name, fl.link_code
-                FROM files f
-                JOIN groups g ON f.group_id = g.id
-                LEFT JOIN file_links fl ON f.id = fl.file_id AND fl.link_type = 'file' AND fl.owner_id = %s AND fl.is_active = 1
-                WHERE g.name = %s AND f.serial_number = %s AND g.owner_id = %s
-            """, (user_id, group_name, file_serial_number, user_id))
-            file_info = cursor.fetchone()
+                    # Find the group and file
+                    cursor.execute("""
+                        SELECT f.id, f.file_name, fl.link_code
+                        FROM files f
+                        JOIN groups g ON f.group_id = g.id
+                        LEFT JOIN file_links fl ON f.id = fl.file_id AND fl.link_type = 'file' AND fl.owner_id = %s AND fl.is_active = 1
+                                                AND fl.expires_at IS NULL AND fl.max_clicks IS NULL
+                        WHERE g.name = %s AND f.serial_number = %s AND g.owner_id = %s
+                    """, (user_id, group_name, file_serial_number, user_id))
+                    file_info = cursor.fetchone()
+                    if not file_info:
+                        return None
+
+                    file_id, file_name, existing_link_code = file_info
+                    # A link with limits is always new; plain links are reused
+                    link_code = existing_link_code if not (ttl or max_clicks) else None
+
+                    if not link_code:
+                        # Generate new link if it doesn't exist
+                        link_code = generate_id()
+                        cursor.execute("""
+                            INSERT INTO file_links (link_code, link_type, file_id, owner_id, is_active, expires_at, max_clicks)
+                            VALUES (%s, 'file', %s, %s, 1, NOW() + %s * INTERVAL '1 second', %s)
+                        """, (link_code, file_id, user_id, ttl, max_clicks))
+                        self.link_filter.add(link_code)
+                        conn.commit()
+                    return file_name, link_code
+                finally:
+                    conn.close()
 
-            if not file_info:
+            file_link = await asyncio.to_thread(get_file_link)
+            if not file_link:
                 await update.message.reply_text(
                     f"File #{file_serial_number:03d} not found in group '{group_name}' or you don't own it. 🤷‍♂️"
                 )
-                conn.close()
                 return
-
-            file_id, file_name, existing_link_code = file_info
-            link_code = existing_link_code
-
-            if not link_code:
-                # Generate new link if it doesn't exist
-                link_code = generate_id()
-                cursor.execute("""
-                    INSERT INTO file_links (link_code, link_type, file_id, owner_id, is_active)
-                    VALUES (%s, 'file', %s, %s, 1)
-                """, (link_code, file_id, user_id))
-                conn.commit()
-
-            conn.close()
+            file_name, link_code = file_link
 
             share_link = f"https://t.me/{BOT_USERNAME.replace('@', '')}?start={link_code}"
             keyboard = [
@@ -782,7 +4231,7 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
 
             await update.message.reply_text(
                 f"Link for '{file_name}' (Group: {group_name} 📁, #{file_serial_number:03d}):\n\n"
-                f"{share_link}",
+                f"{share_link}{format_link_limits(ttl, max_clicks)}",
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
 
@@ -794,48 +4243,53 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
 
     async def deletefile_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /deletefile command to delete a specific file."""
-        if not is_user_authorized(update.effective_user.id):
+        if not await asyncio.to_thread(is_user_authorized, update.effective_user.id):
             await update.message.reply_text(f"Unauthorized. Contact admin: {ADMIN_CONTACT} 🚫")
             return
 
         if len(context.args) < 2:
             await update.message.reply_text(
                 "Usage Error ❌\n\n"
-                "Correct usage: /deletefile <group_name> <file_number>\n"
-                "Example: /deletefile MyDocuments 001"
+                "Correct usage: /deletefile <group_name> <file_numbers>\n"
+                "Example: /deletefile MyDocuments 001\n"
+                "Several files: /deletefile MyDocuments 3-40,52 (or 3-40 52)"
             )
             return
 
         group_name = context.args[0]
         try:
-            file_serial_number = int(context.args[1])
-            if file_serial_number <= 0:
-                await update.message.reply_text("File number must be positive. 🔢")
-                return
-        except ValueError:
-            await update.message.reply_text("Invalid file number. Please provide a positive integer. 🔢")
+            serials = parse_serial_ranges(",".join(context.args[1:]))
+        except ValueError as e:
+            await update.message.reply_text(f"Invalid file numbers: {e}. 🔢\n\nExample: /deletefile MyDocuments 3-40,52")
             return
 
         user_id = update.effective_user.id
+        if len(serials) > 1:
+            await self._prepare_range_delete(update, user_id, group_name, serials)
+            return
+        file_serial_number = serials[0]
 
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-
-            # Find the file to delete
-            cursor.execute("""
-                SELECT f.id, f.file_name, f.file_size, f.group_id
-                FROM files f
-                JOIN groups g ON f.group_id = g.id
-                WHERE g.name = %s AND f.serial_number = %s AND g.owner_id = %s
-            """, (group_name, file_serial_number, user_id))
-            file_info = cursor.fetchone()
+            def find_file() -> Optional[tuple]:
+                conn = get_db_connection()
+                try:
+                    cursor = conn.cursor()
+                    # Find the file to delete
+                    cursor.execute("""
+                        SELECT f.id, f.file_name, f.file_size, f.group_id
+                        FROM files f
+                        JOIN groups g ON f.group_id = g.id
+                        WHERE g.name = %s AND f.serial_number = %s AND g.owner_id = %s
+                    """, (group_name, file_serial_number, user_id))
+                    return cursor.fetchone()
+                finally:
+                    conn.close()
 
+            file_info = await asyncio.to_thread(find_file)
             if not file_info:
                 await update.message.reply_text(
                     f"File #{file_serial_number:03d} not found in group '{group_name}' or you don't own it. 🤷‍♂️"
                 )
-                conn.close()
                 return
 
             file_id, file_name, file_size, group_id = file_info
@@ -850,15 +4304,50 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
                 "This action cannot be undone. All associated links will also be removed.",
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
-            conn.close() # Close connection after query
 
         except Exception as e:
             logger.error(f"Error handling deletefile command: {e}")
             await update.message.reply_text("An error occurred while trying to delete the file. Please try again. 😔")
 
+    async def _prepare_range_delete(self, update: Update, user_id: int, group_name: str, serials: list):
+        """Select the files of a /deletefile range and ask for confirmation"""
+        try:
+            def find_files() -> list:
+                conn = get_db_connection()
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("""
+                        SELECT g.id, f.id
+                        FROM groups g
+                        LEFT JOIN files f ON f.group_id = g.id AND f.serial_number = ANY(%s)
+                        WHERE g.name = %s AND g.owner_id = %s
+                    """, (serials, group_name, user_id))
+                    return cursor.fetchall()
+                finally:
+                    conn.close()
+
+            rows = await asyncio.to_thread(find_files)
+
+            if not rows:
+                await update.message.reply_text(f"Group '{group_name}' not found or you don't own it. 🤷‍♂️")
+                return
+            file_ids = [file_id for _, file_id in rows if file_id is not None]
+            if not file_ids:
+                await update.message.reply_text(f"None of {format_serial_ranges(serials)} exist in group '{group_name}'. 🤷‍♂️")
+                return
+
+            selection = {'group_id': rows[0][0], 'selected': file_ids}
+            await self.sessions.set('file_select', user_id, selection)
+            text, keyboard = await asyncio.to_thread(self._delete_selection_prompt, user_id, selection)
+            await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+        except Exception as e:
+            logger.error(f"Error preparing range deletion: {e}")
+            await update.message.reply_text("An error occurred while trying to delete the files. Please try again. 😔")
+
     async def deletegroup_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /deletegroup command to delete an entire group."""
-        if not is_user_authorized(update.effective_user.id):
+        if not await asyncio.to_thread(is_user_authorized, update.effective_user.id):
             await update.message.reply_text(f"Unauthorized. Contact admin: {ADMIN_CONTACT} 🚫")
             return
 
@@ -874,16 +4363,20 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
         user_id = update.effective_user.id
 
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-            cursor.execute("SELECT id FROM groups WHERE name = %s AND owner_id = %s", (group_name, user_id))
-            group_info = cursor.fetchone()
+            def find_group() -> Optional[tuple]:
+                conn = get_db_connection()
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT id FROM groups WHERE name = %s AND owner_id = %s", (group_name, user_id))
+                    return cursor.fetchone()
+                finally:
+                    conn.close()
 
+            group_info = await asyncio.to_thread(find_group)
             if not group_info:
                 await update.message.reply_text(
                     f"Group '{group_name}' not found or you don't own it. 🤷‍♂️"
                 )
-                conn.close()
                 return
 
             group_id = group_info[0]
@@ -899,7 +4392,6 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
                 "This action cannot be undone. ⚠️",
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
-            conn.close() # Close connection after query
 
         except Exception as e:
             logger.error(f"Error handling deletegroup command: {e}")
@@ -907,60 +4399,74 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
 
     async def getgrouplink_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /getgrouplink command to get a link for an entire group."""
-        if not is_user_authorized(update.effective_user.id):
+        if not await asyncio.to_thread(is_user_authorized, update.effective_user.id):
             await update.message.reply_text(f"Unauthorized. Contact admin: {ADMIN_CONTACT} 🚫")
             return
 
-        if not context.args:
+        try:
+            args, ttl, max_clicks = parse_link_options(context.args)
+        except ValueError as e:
+            await update.message.reply_text(f"Invalid link option: {e} ❌\n\nExample: ttl=2h clicks=50")
+            return
+
+        if not args:
             await update.message.reply_text(
                 "Usage Error ❌\n\n"
-                "Correct usage: /getgrouplink <group_name>\n"
+                "Correct usage: /getgrouplink <group_name> [ttl=2h] [clicks=50]\n"
                 "Example: /getgrouplink MyWebSeries"
             )
             return
 
-        group_name = " ".join(context.args)
+        group_name = " ".join(args)
         user_id = update.effective_user.id
 
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
+            def get_group_link() -> Optional[str]:
+                conn = get_db_connection(user_id=user_id)
+                try:
+                    cursor = conn.cursor()
 
-            # Find the group
-            cursor.execute("""
-                SELECT id FROM groups WHERE name = %s AND owner_id = %s
-            """, (group_name, user_id))
-            group_info = cursor.fetchone()
+                    # Find the group
+                    cursor.execute("""
+                        SELECT id FROM groups WHERE name = %s AND owner_id = %s
+                    """, (group_name, user_id))
+                    group_info = cursor.fetchone()
+                    if not group_info:
+                        return None
+
+                    group_id = group_info[0]
+
+                    # Check if group link already exists and is active (a link with limits is always new)
+                    link_code = None
+                    if not (ttl or max_clicks):
+                        cursor.execute("""
+                            SELECT link_code FROM file_links
+                            WHERE group_id = %s AND owner_id = %s AND link_type = 'group' AND is_active = 1
+                              AND expires_at IS NULL AND max_clicks IS NULL
+                        """, (group_id, user_id))
+                        link_info = cursor.fetchone()
+                        link_code = link_info[0] if link_info else None
+
+                    if not link_code:
+                        # Generate new link if it doesn't exist
+                        link_code = generate_id()
+                        cursor.execute("""
+                            INSERT INTO file_links (link_code, link_type, group_id, owner_id, is_active, expires_at, max_clicks)
+                            VALUES (%s, 'group', %s, %s, 1, NOW() + %s * INTERVAL '1 second', %s)
+                        """, (link_code, group_id, user_id, ttl, max_clicks))
+                        self.link_filter.add(link_code)
+                        conn.commit()
+                    return link_code
+                finally:
+                    conn.close()
 
-            if not group_info:
+            link_code = await asyncio.to_thread(get_group_link)
+            if not link_code:
                 await update.message.reply_text(
                     f"Group '{group_name}' not found or you don't own it. 🤷‍♂️"
                 )
-                conn.close()
                 return
 
-            group_id = group_info[0]
-
-            # Check if group link already exists and is active
-            cursor.execute("""
-                SELECT link_code FROM file_links
-                WHERE group_id = %s AND owner_id = %s AND link_type = 'group' AND is_active = 1
-            """, (group_id, user_id))
-            link_info = cursor.fetchone()
-
-            link_code = link_info[0] if link_info else None
-
-            if not link_code:
-                # Generate new link if it doesn't exist
-                link_code = generate_id()
-                cursor.execute("""
-                    INSERT INTO file_links (link_code, link_type, group_id, owner_id, is_active)
-                    VALUES (%s, 'group', %s, %s, 1)
-                """, (link_code, group_id, user_id))
-                conn.commit()
-
-            conn.close()
-
             share_link = f"https://t.me/{BOT_USERNAME.replace('@', '')}?start={link_code}"
             keyboard = [
                 [InlineKeyboardButton("Share Group 🔗", url=share_link)],
@@ -969,7 +4475,7 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
 
             await update.message.reply_text(
                 f"Link for group '{group_name}' 📁:\n\n"
-                f"{share_link}",
+                f"{share_link}{format_link_limits(ttl, max_clicks)}",
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
 
@@ -980,37 +4486,45 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
     async def _execute_revoke_link(self, message: Message, link_code: str, user_id: int):
         """Helper to execute link revocation logic."""
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-            # Check if the link exists and belongs to the user or is an admin revoking any link
-            cursor.execute("""
-                SELECT id, link_type, file_id, group_id, owner_id FROM file_links
-                WHERE link_code = %s AND is_active = 1
-            """, (link_code,))
-            link_info = cursor.fetchone()
+            def revoke() -> Tuple[str, Optional[tuple]]:
+                conn = get_db_connection(user_id=user_id)
+                try:
+                    cursor = conn.cursor()
+                    # Check if the link exists and belongs to the user or is an admin revoking any link
+                    cursor.execute("""
+                        SELECT id, link_type, file_id, group_id, owner_id FROM file_links
+                        WHERE link_code = %s AND is_active = 1
+                    """, (link_code,))
+                    link_info = cursor.fetchone()
+                    if not link_info:
+                        return "missing", None
+
+                    # Only allow owner or admin to revoke
+                    if link_info[4] != user_id and not is_admin(user_id):
+                        return "forbidden", link_info
+
+                    # Invalidate the link
+                    cursor.execute("""
+                        UPDATE file_links SET is_active = 0 WHERE id = %s
+                    """, (link_info[0],))
+                    conn.commit()
+                    self.link_filter.forget(link_code)
+                    return "revoked", link_info
+                finally:
+                    conn.close()
 
-            if not link_info:
+            outcome, link_info = await asyncio.to_thread(revoke)
+            if outcome == "missing":
                 logger.info(f"Revocation failed: Link '{link_code}' not found or already inactive.")
                 await message.reply_text(f"Link '{link_code}' not found or already inactive. 🤷‍♂️")
-                conn.close()
                 return
 
             link_db_id, link_type, file_id, group_id, link_owner_id = link_info
-
-            # Only allow owner or admin to revoke
-            if link_owner_id != user_id and not is_admin(user_id):
+            if outcome == "forbidden":
                 logger.warning(f"Unauthorized revocation attempt: User {user_id} tried to revoke link {link_code} owned by {link_owner_id}.")
                 await message.reply_text("You can only revoke your own links unless you are an admin. 🚫")
-                conn.close()
                 return
 
-            # Invalidate the link
-            cursor.execute("""
-                UPDATE file_links SET is_active = 0 WHERE id = %s
-            """, (link_db_id,))
-            conn.commit()
-            conn.close()
-
             logger.info(f"Link '{link_code}' (ID: {link_db_id}) successfully revoked by user {user_id}.")
             await message.reply_text(
                 f"Link '{link_code}' has been successfully revoked. ✅\n"
@@ -1023,7 +4537,7 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
     async def revoke_link_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /revokelink command to invalidate a specific link."""
         # Check if user is authorized for bot usage (not just link access)
-        if not is_user_authorized(update.effective_user.id):
+        if not await asyncio.to_thread(is_user_authorized, update.effective_user.id):
             await update.message.reply_text(f"Unauthorized. Contact admin: {ADMIN_CONTACT} 🚫")
             return
 
@@ -1047,7 +4561,8 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
         user_id = update.effective_user.id
 
         # Check for pending caption edit
-        if user_id in self.caption_edit_pending and self.caption_edit_pending[user_id]['state'] == 'waiting_for_caption':
+        caption_edit = await self.sessions.get('caption_edit', user_id)
+        if caption_edit and caption_edit['state'] == 'waiting_for_caption':
             new_caption = update.message.text
             if new_caption:
                 await self._update_custom_caption(update, new_caption)
@@ -1056,11 +4571,11 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
                 await update.message.reply_text("Please send the new custom caption text. To cancel, use /start. ✍️")
                 return
 
-        if not is_user_authorized(user_id):
+        if not await asyncio.to_thread(is_user_authorized, user_id):
             await update.message.reply_text(f"Unauthorized. Contact admin: {ADMIN_CONTACT} 🚫")
             return
 
-        file_obj, file_type, file_name, file_size = extract_file_data(update.message)
+        file_obj, file_type, file_name, file_size, file_unique_id = extract_file_data(update.message)
 
         if not file_obj:
             await update.message.reply_text("Unsupported File Type 🚫\n\nSupported: Photos 📸, Videos 🎬, Documents 📄, Audio 🎵, Voice 🎤")
@@ -1075,10 +4590,12 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
             return
 
         # Check upload mode
-        if user_id in self.bulk_sessions:
-            await self._handle_bulk_file(update, context, file_obj, file_type, file_name, file_size)
-        elif context.user_data.get('upload_mode') == 'single':
-            await self._handle_single_file(update, context, file_obj, file_type, file_name, file_size)
+        bulk_session = await self.sessions.get('bulk', user_id)
+        upload_session = await self.sessions.get('upload', user_id) if not bulk_session else None
+        if bulk_session:
+            await self._handle_bulk_file(update, context, bulk_session, file_obj, file_type, file_name, file_size, file_unique_id)
+        elif upload_session and upload_session.get('mode') == 'single':
+            await self._handle_single_file(update, context, upload_session, file_obj, file_type, file_name, file_size, file_unique_id)
         else:
             keyboard = [[InlineKeyboardButton("Start Upload ⬆️", callback_data="cmd_upload")]]
             await update.message.reply_text(
@@ -1102,6 +4619,7 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
             admin_callbacks = ["admin_panel", "user_management", "caption_settings", "bot_stats", "advanced_settings",
                                "toggle_global_caption", "edit_caption_text", "user_caption_control", "toggle_user_caption_",
                                "user_info_", "remove_user_", "confirm_remove_", "help_adduser", "list_all_users",
+                               "all_users_page_", "users_page_",
                                "full_stats", "export_stats", "usage_report"]
 
             if any(data.startswith(cb) for cb in admin_callbacks):
@@ -1109,6 +4627,18 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
                     await query.edit_message_text("Unauthorized: Admin access required 🚫")
                     return
 
+            # Buttons whose state travels in a callback state token
+            if CallbackState.is_token(data):
+                token = self.callback_state.unpack(user_id, data)
+                if token is None:
+                    await query.edit_message_text(
+                        "This button has expired. Please open the menu again. ⌛",
+                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Main Menu 🏠", callback_data="main_menu")]])
+                    )
+                    return
+                await self._handle_callback_token(query, user_id, *token)
+                return
+
             # Handle all callbacks with complete implementations
             if data == "main_menu":
                 await self._show_main_menu_callback(query, user_id)
@@ -1151,7 +4681,7 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
                 )
 
             elif data == "cancel_upload":
-                context.user_data.clear()
+                await self.sessions.delete('upload', user_id)
                 await query.edit_message_text(
                     "Upload Cancelled ❌\n\nYour upload session has been cancelled.",
                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Main Menu 🏠", callback_data="main_menu")]])
@@ -1159,8 +4689,7 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
 
             elif data == "cancel":
                 # If a caption edit was pending, clear that state
-                if user_id in self.caption_edit_pending:
-                    del self.caption_edit_pending[user_id]
+                await self.sessions.delete('caption_edit', user_id)
                 await query.edit_message_text(
                     "Action Cancelled ❌",
                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Main Menu 🏠", callback_data="main_menu")]])
@@ -1233,6 +4762,17 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
             elif data == "list_all_users":
                 await self._list_all_users_callback(query)
 
+            elif data.startswith("all_users_page_"):
+                await self._list_all_users_callback(query, int(data.split("_")[-1]))
+
+            elif data.startswith("users_page_"):
+                pages = await asyncio.to_thread(self._user_listing_pages, user_id, "users")
+                if not pages:
+                    await query.edit_message_text("No regular users found 👥")
+                else:
+                    text, keyboard = pages[min(int(data.split("_")[-1]), len(pages) - 1)]
+                    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
             # Group callbacks
             elif data.startswith("view_group_id_"):
                 await self._handle_view_group(query, data)
@@ -1246,9 +4786,24 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
             elif data.startswith("list_files_group_"):
                 await self._list_group_files(query, data)
 
+            elif data.startswith("files_page_"):
+                _, _, group_id, page = data.split("_")
+                await self._list_group_files(query, f"list_files_group_{group_id}", int(page))
+
             elif data.startswith("view_file_id_"):
                 await self._view_file_details(query, data)
 
+            # Search page buttons on messages sent before the query moved into the button itself
+            elif data.startswith("search_page_"):
+                search = await self.sessions.get('search', user_id)
+                if not search:
+                    await query.edit_message_text(
+                        "Search expired. Please run /search again. 🔍",
+                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Main Menu 🏠", callback_data="main_menu")]])
+                    )
+                else:
+                    await self._show_search_results(None, query, user_id, search['text'], int(data.split("_")[-1]))
+
             elif data.startswith("add_files_to_group_"):
                 await self._prepare_add_files_to_group(query, context, data)
 
@@ -1258,20 +4813,39 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
             elif data.startswith("confirm_delete_file_"):
                 await self._execute_delete_file(query, data)
 
+            # Multi-select file deletion
+            elif data.startswith("select_files_group_"):
+                await self.sessions.set('file_select', user_id, {'group_id': int(data.split("_")[-1]), 'selected': []})
+                await self._show_file_selection(query, user_id, 0)
+
+            elif data.startswith("sel_page_"):
+                await self._show_file_selection(query, user_id, int(data.split("_")[-1]))
+
+            elif data.startswith("sel_toggle_"):
+                _, _, file_id, page = data.split("_")
+                await self._toggle_file_selection(query, user_id, [int(file_id)], int(page))
+
+            elif data.startswith("sel_all_"):
+                await self._toggle_file_selection(query, user_id, None, int(data.split("_")[-1]))
+
+            elif data == "sel_delete":
+                selection = await self.sessions.get('file_select', user_id)
+                text, keyboard = await asyncio.to_thread(self._delete_selection_prompt, user_id, selection)
+                await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+            elif data == "sel_confirm_delete":
+                await self._execute_delete_selection(query, user_id)
+
             elif data.startswith("delete_group_id_"):
                 await self._confirm_delete_group(query, data)
 
             elif data.startswith("confirm_delete_group_"):
                 await self._execute_delete_group(query, data)
 
-            # Handle revoke group link from button
-            elif data.startswith("revoke_group_link_"):
-                link_code = data.split("_")[-1]
-                # Pass query.message directly as it's the message associated with the callback
-                await self._execute_revoke_link(query.message, link_code, user_id)
-            # Handle revoke file link from button
-            elif data.startswith("revoke_file_link_"):
-                link_code = data.split("_")[-1]
+            # Revoke buttons on messages sent before they moved to callback state tokens.
+            # Link codes may contain "_", so the code is everything after the prefix.
+            elif data.startswith(("revoke_group_link_", "revoke_file_link_")):
+                link_code = data.split("_link_", 1)[1]
                 # Pass query.message directly as it's the message associated with the callback
                 await self._execute_revoke_link(query.message, link_code, user_id)
 
@@ -1293,6 +4867,18 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
                 # Fallback if query.message is also None (highly unlikely for a callback)
                 logger.error("Failed to send error message for callback as query.message is None.")
 
+    async def _handle_callback_token(self, query, user_id: int, action: str, state):
+        """Dispatch a button that carries its state in a callback state token"""
+        if action == "revoke_link":
+            await self._execute_revoke_link(query.message, state["c"], user_id)
+        elif action == "search":
+            await self._show_search_results(None, query, user_id, state["q"], state["p"])
+        else:
+            await query.edit_message_text(
+                "Unknown action. Please try again. 😔",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Main Menu 🏠", callback_data="main_menu")]])
+            )
+
     # ================= COMPLETE HELPER METHODS - ALL WORKING =================
 
     async def _show_main_menu(self, message, user):
@@ -1328,7 +4914,7 @@ Contact Admin: {ADMIN_CONTACT} 👨‍💻"""
 
         keyboard = [row for row in keyboard if row]  # Remove None rows
 
-        _, custom_caption = get_caption_setting()
+        _, custom_caption = await asyncio.to_thread(get_caption_setting)
         role = "Admin 👑" if is_admin(user.id) else "User"
 
         welcome_text = f"""Welcome to Enhanced FileStore Bot! 👋
@@ -1340,7 +4926,7 @@ Features:
 - Generate shareable links 🔗
 - Auto-captioned uploads with serial numbers #️⃣
 - Bulk upload support 🚀
-- Files auto-delete after 10 minutes when shared ⏳
+- Files auto-delete after {format_duration(AUTO_DELETE_SECONDS)} when shared ⏳
 - Custom branding: {custom_caption}
 
 File Size Limit: {format_size(MAX_FILE_SIZE)}
@@ -1349,6 +4935,7 @@ Quick Commands:
 /upload <group> - Upload single file ⬆️
 /bulkupload <group> - Upload multiple files 📦
 /groups - View your groups 📂
+/search <text> - Find files by name 🔍
 /getlink <group> <file_no> - Get specific file link 📄🔗
 /clear - Clear console logs ✨
 
@@ -1402,11 +4989,11 @@ Choose an option below to get started! 👇"""
 
     # ================= ACTUAL FILE PROCESSING METHODS =================
 
-    async def _handle_single_file(self, update: Update, context: ContextTypes.DEFAULT_TYPE, file_obj, file_type: str, file_name: str, file_size: int):
+    async def _handle_single_file(self, update: Update, context: ContextTypes.DEFAULT_TYPE, session: dict, file_obj, file_type: str, file_name: str, file_size: int, file_unique_id: str):
         """Handle single file upload with actual processing and link generation"""
         try:
             user_id = update.effective_user.id # Fixed: Get user_id here directly
-            group_name = context.user_data['group_name']
+            group_name = session['group_name']
 
             # Show progress message
             try:
@@ -1415,43 +5002,32 @@ Choose an option below to get started! 👇"""
                 logger.error(f"Error sending progress message: {e}")
                 processing_msg = None
 
+            # Same content already in the storage channel? Reuse it instead of re-sending.
+            stored_copy = await self._find_stored_copy(file_unique_id)
+
             # Save to database
-            file_id, serial_number = await self._save_file_to_db(
-                user_id, group_name, file_obj, file_type, file_name, file_size
+            file_id, serial_number, stored_copy = await self._save_file_to_db(
+                user_id, group_name, file_obj, file_type, file_name, file_size, file_unique_id, stored_copy
             )
 
-            # Generate caption
-            caption = get_file_caption(file_name, serial_number, user_id)
-
             # Upload to storage channel
-            try:
-                storage_msg = await self._send_to_storage(file_obj, file_type, caption)
+            if not stored_copy:
+                try:
+                    # Generate caption
+                    caption = await asyncio.to_thread(get_file_caption, file_name, serial_number, user_id)
+                    storage_msg = await self._send_to_storage(file_obj.file_id, file_type, caption)
 
-                # Update storage message ID
-                conn = psycopg2.connect(SUPABASE_URL)
-                cursor = conn.cursor()
-                cursor.execute("""
-                    UPDATE files SET storage_message_id = %s WHERE id = %s
-                """, (storage_msg.message_id, file_id))
-                conn.commit()
-                conn.close()
+                    # Update storage message ID
+                    await asyncio.to_thread(self._set_storage_message, file_id, storage_msg.chat_id, storage_msg.message_id)
 
-            except Exception as e:
-                logger.error(f"Storage upload error: {e}")
-                if processing_msg:
-                    await processing_msg.edit_text("Error uploading to storage channel. Please check channel permissions. ❌")
-                return
+                except Exception as e:
+                    logger.error(f"Storage upload error: {e}")
+                    if processing_msg:
+                        await processing_msg.edit_text("Error uploading to storage channel. Please check channel permissions. ❌")
+                    return
 
             # Generate share link
-            link_code = generate_id()
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO file_links (link_code, link_type, file_id, owner_id, is_active)
-                VALUES (%s, 'file', %s, %s, 1)
-            """, (link_code, file_id, user_id))
-            conn.commit()
-            conn.close()
+            link_code = await asyncio.to_thread(self._create_file_link, file_id, user_id)
 
             # Delete processing message
             if processing_msg:
@@ -1479,47 +5055,48 @@ Choose an option below to get started! 👇"""
             )
 
             # Clear upload mode
-            context.user_data.clear()
+            await self.sessions.delete('upload', user_id)
 
         except Exception as e:
             logger.error(f"Single file upload error: {e}")
             await update.message.reply_text("Error uploading file. 😔")
 
-    async def _handle_bulk_file(self, update: Update, context: ContextTypes.DEFAULT_TYPE, file_obj, file_type: str, file_name: str, file_size: int):
+    async def _handle_bulk_file(self, update: Update, context: ContextTypes.DEFAULT_TYPE, session: dict, file_obj, file_type: str, file_name: str, file_size: int, file_unique_id: str):
         """Handle bulk file upload with actual processing."""
         user_id = update.effective_user.id
-        session = self.bulk_sessions[user_id]
         group_name = session['group_name']
 
         try:
+            # Same content already in the storage channel? Reuse it instead of re-sending.
+            stored_copy = await self._find_stored_copy(file_unique_id)
+
             # Save to database
-            file_id, serial_number = await self._save_file_to_db(
-                user_id, group_name, file_obj, file_type, file_name, file_size
+            file_id, serial_number, stored_copy = await self._save_file_to_db(
+                user_id, group_name, file_obj, file_type, file_name, file_size, file_unique_id, stored_copy
             )
 
-            # Generate caption
-            caption = get_file_caption(file_name, serial_number, user_id)
-
             # Upload to storage channel
-            try:
-                storage_msg = await self._send_to_storage(file_obj, file_type, caption)
+            if not stored_copy:
+                try:
+                    # Generate caption
+                    caption = await asyncio.to_thread(get_file_caption, file_name, serial_number, user_id)
+                    storage_msg = await self._send_to_storage(file_obj.file_id, file_type, caption)
 
-                # Update storage message ID
-                conn = psycopg2.connect(SUPABASE_URL)
-                cursor = conn.cursor()
-                cursor.execute("""
-                    UPDATE files SET storage_message_id = %s WHERE id = %s
-                """, (storage_msg.message_id, file_id))
-                conn.commit()
-                conn.close()
+                    # Update storage message ID
+                    await asyncio.to_thread(self._set_storage_message, file_id, storage_msg.chat_id, storage_msg.message_id)
 
-            except Exception as e:
-                logger.error(f"Storage upload error in bulk: {e}")
-                await update.message.reply_text("Error uploading to storage channel during bulk upload. ❌")
-                return
+                except Exception as e:
+                    logger.error(f"Storage upload error in bulk: {e}")
+                    await update.message.reply_text("Error uploading to storage channel during bulk upload. ❌")
+                    return
 
-            # Add to session files
-            session['files'].append(file_name)
+            # Add to session files atomically (also refreshes the session expiry)
+            session = await self.sessions.append('bulk', user_id, 'files', file_name)
+            if session is None:
+                await update.message.reply_text(
+                    f"File saved to '{group_name}' as #{serial_number:03d}, but the bulk session has already ended. ✅"
+                )
+                return
 
             # Update user with progress
             keyboard = [
@@ -1536,8 +5113,10 @@ Choose an option below to get started! 👇"""
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
 
-            # Delay to avoid flooding
-            await asyncio.sleep(BULK_UPLOAD_DELAY)
+            # Delay to avoid flooding (only needed when the storage channel was used).
+            # Uploads are spread over the shards, so each channel sees a fraction of the rate.
+            if not stored_copy:
+                await asyncio.sleep(BULK_UPLOAD_DELAY / len(STORAGE_CHANNEL_IDS))
 
         except Exception as e:
             logger.error(f"Bulk file upload error: {e}")
@@ -1546,11 +5125,11 @@ Choose an option below to get started! 👇"""
     async def _finish_bulk_upload(self, query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE):
         """Finish bulk upload session and provide summary."""
         user_id = query.from_user.id
-        if user_id not in self.bulk_sessions:
+        session = await self.sessions.delete('bulk', user_id)
+        if not session:
             await query.edit_message_text("No active bulk session. 🚫")
             return
 
-        session = self.bulk_sessions.pop(user_id)
         group_name = session['group_name']
         files = session['files']
         total_files = len(files)
@@ -1565,11 +5144,16 @@ Choose an option below to get started! 👇"""
             text += f"\n...and {total_files - 10} more."
 
         # Get group_id for callback
-        conn = psycopg2.connect(SUPABASE_URL)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM groups WHERE name = %s AND owner_id = %s", (group_name, user_id))
-        group_info = cursor.fetchone()
-        conn.close()
+        def find_group() -> Optional[tuple]:
+            conn = get_db_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT id FROM groups WHERE name = %s AND owner_id = %s", (group_name, user_id))
+                return cursor.fetchone()
+            finally:
+                conn.close()
+
+        group_info = await asyncio.to_thread(find_group)
 
         group_id = group_info[0] if group_info else None
 
@@ -1583,76 +5167,160 @@ Choose an option below to get started! 👇"""
     async def _cancel_bulk_upload(self, query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE):
         """Cancel bulk upload session."""
         user_id = query.from_user.id
-        if user_id in self.bulk_sessions:
-            del self.bulk_sessions[user_id]
+        if await self.sessions.delete('bulk', user_id):
             await query.edit_message_text("Bulk upload session cancelled. ❌",
                                           reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Main Menu 🏠", callback_data="main_menu")]]))
         else:
             await query.edit_message_text("No active bulk session to cancel. 🚫")
 
-    async def _save_file_to_db(self, user_id: int, group_name: str, file_obj, file_type: str, file_name: str, file_size: int) -> Tuple[int, int]:
-        """Save file metadata to database and return file_id and serial_number."""
-        conn = psycopg2.connect(SUPABASE_URL)
-        cursor = conn.cursor()
+    async def _find_stored_copy(self, file_unique_id: str) -> Optional[Tuple[str, int, int]]:
+        """Return (telegram_file_id, storage_channel_id, storage_message_id) of an already stored copy of the same content."""
+        if not file_unique_id:
+            return None
+
+        def lookup() -> Optional[tuple]:
+            conn = get_db_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT telegram_file_id, storage_channel_id, storage_message_id FROM files
+                    WHERE file_unique_id = %s AND storage_message_id IS NOT NULL
+                    LIMIT 1
+                """, (file_unique_id,))
+                return cursor.fetchone()
+            finally:
+                conn.close()
 
         try:
-            # Get or create group
-            cursor.execute("SELECT id, total_files, total_size FROM groups WHERE name = %s AND owner_id = %s", (group_name, user_id))
-            group_info = cursor.fetchone()
+            stored_copy = await asyncio.to_thread(lookup)
+        except Exception as e:
+            logger.error(f"Stored copy lookup error for {file_unique_id}: {e}")
+            return None
+
+        if stored_copy:
+            logger.info(f"Reusing storage message {stored_copy[2]} for duplicate content {file_unique_id}")
+        return stored_copy
+
+    async def _save_file_to_db(self, user_id: int, group_name: str, file_obj, file_type: str, file_name: str, file_size: int,
+                               file_unique_id: str = None, stored_copy: Optional[Tuple[str, int, int]] = None) -> Tuple[int, int, Optional[Tuple[str, int, int]]]:
+        """Save file metadata to database and return file_id, serial_number and the stored copy used.
+
+        When stored_copy is given, the row points at that existing storage message
+        and file reference instead of waiting for a new storage-channel upload. The
+        copy is not used (None is returned) if the storage GC is deleting its post.
+        """
+        # Get uploader username (before the transaction, so no row lock is held across the API call)
+        uploader_username = (await self.app.bot.get_chat(user_id)).username
 
-            if group_info:
-                group_id, total_files, total_size = group_info
-                serial_number = total_files + 1
-                new_total_files = total_files + 1
-                new_total_size = total_size + file_size
+        def save() -> Tuple[int, int, Optional[Tuple[str, int, int]]]:
+            conn = get_db_connection(user_id=user_id)
+            cursor = conn.cursor()
+
+            try:
+                # Get or create the group and take the next serial; the row lock orders concurrent uploads.
+                # total_files/total_size are kept by the files triggers
                 cursor.execute("""
-                    UPDATE groups SET total_files = %s, total_size = %s WHERE id = %s
-                """, (new_total_files, new_total_size, group_id))
-            else:
+                    INSERT INTO groups (name, owner_id, last_serial) VALUES (%s, %s, 1)
+                    ON CONFLICT (name, owner_id) DO UPDATE SET last_serial = groups.last_serial + 1
+                    RETURNING id, last_serial
+                """, (group_name, user_id))
+                group_id, serial_number = cursor.fetchone()
+
+                # Generate unique ID
+                unique_id = generate_id()
+
+                # Insert file
+                telegram_file_id, storage_channel_id, storage_message_id = stored_copy if stored_copy else (file_obj.file_id, None, None)
+                if stored_copy:
+                    # A post the storage GC has claimed is being deleted; upload a new one instead
+                    lock_storage_post(cursor, storage_channel_id, storage_message_id)
+                    cursor.execute("""
+                        SELECT 1 FROM storage_gc_queue
+                        WHERE channel_id = %s AND message_id = %s AND claimed_at IS NOT NULL
+                    """, (storage_channel_id, storage_message_id))
+                    if cursor.fetchone():
+                        telegram_file_id, storage_channel_id, storage_message_id = file_obj.file_id, None, None
                 cursor.execute("""
-                    INSERT INTO groups (name, owner_id, total_files, total_size)
-                    VALUES (%s, %s, 1, %s) RETURNING id
-                """, (group_name, user_id, file_size))
-                group_id = cursor.fetchone()[0]
-                serial_number = 1
+                    INSERT INTO files (group_id, serial_number, unique_id, file_name, file_type, file_size, telegram_file_id,
+                                       uploader_id, uploader_username, file_unique_id, storage_channel_id, storage_message_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id
+                """, (group_id, serial_number, unique_id, file_name, file_type, file_size, telegram_file_id,
+                      user_id, uploader_username, file_unique_id, storage_channel_id, storage_message_id))
+                file_id = cursor.fetchone()[0]
+
+                conn.commit()
+                return file_id, serial_number, stored_copy if storage_message_id else None
 
-            # Generate unique ID
-            unique_id = generate_id()
+            except Exception as e:
+                conn.rollback()
+                raise e
+            finally:
+                conn.close()
 
-            # Get uploader username
-            uploader_username = (await self.app.bot.get_chat(user_id)).username
+        return await asyncio.to_thread(save)
 
-            # Insert file
+    def _set_storage_message(self, file_id: int, storage_channel_id: int, storage_message_id: int):
+        """Point a file row at its message in the storage channel"""
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
             cursor.execute("""
-                INSERT INTO files (group_id, serial_number, unique_id, file_name, file_type, file_size, telegram_file_id, uploader_id, uploader_username)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id
-            """, (group_id, serial_number, unique_id, file_name, file_type, file_size, file_obj.file_id, user_id, uploader_username))
-            file_id = cursor.fetchone()[0]
-
+                UPDATE files SET storage_channel_id = %s, storage_message_id = %s WHERE id = %s
+            """, (storage_channel_id, storage_message_id, file_id))
             conn.commit()
-            return file_id, serial_number
+        finally:
+            conn.close()
 
-        except Exception as e:
-            conn.rollback()
-            raise e
+    def _create_file_link(self, file_id: int, owner_id: int) -> str:
+        """Create a plain share link for a file and return its code"""
+        link_code = generate_id()
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO file_links (link_code, link_type, file_id, owner_id, is_active)
+                VALUES (%s, 'file', %s, %s, 1)
+            """, (link_code, file_id, owner_id))
+            self.link_filter.add(link_code)
+            conn.commit()
         finally:
             conn.close()
+        return link_code
 
-    async def _send_to_storage(self, file_obj, file_type: str, caption: str) -> Message:
-        """Send file to storage channel."""
-        bot = self.app.bot
+    async def _send_to_storage(self, telegram_file_id: str, file_type: str, caption: str) -> Message:
+        """Send file to a storage channel shard (the returned message's chat_id is the one used).
+
+        A shard that answers with RetryAfter is put on cooldown and the next one is tried.
+        """
+        tried = []
+        while True:
+            channel_id = self.shards.choose(exclude=tried)
+            self.shards.started(channel_id)
+            try:
+                return await self._send_file(self.app.bot, channel_id, telegram_file_id, file_type, caption)
+            except RetryAfter as e:
+                self.shards.cool_down(channel_id, e.retry_after)
+                tried.append(channel_id)
+                if len(tried) == len(self.shards.channel_ids):
+                    raise
+                logger.warning(f"Storage channel {channel_id} rate limited for {e.retry_after}s, trying another shard")
+            finally:
+                self.shards.finished(channel_id)
+
+    async def _send_file(self, bot: Bot, chat_id: int, telegram_file_id: str, file_type: str, caption: str) -> Message:
+        """Send a stored file to a chat by file_id with the matching send method."""
         if file_type == "photo":
-            return await bot.send_photo(STORAGE_CHANNEL_ID, file_obj.file_id, caption=caption)
+            return await bot.send_photo(chat_id, telegram_file_id, caption=caption)
         elif file_type == "video":
-            return await bot.send_video(STORAGE_CHANNEL_ID, file_obj.file_id, caption=caption)
+            return await bot.send_video(chat_id, telegram_file_id, caption=caption)
         elif file_type == "audio":
-            return await bot.send_audio(STORAGE_CHANNEL_ID, file_obj.file_id, caption=caption)
+            return await bot.send_audio(chat_id, telegram_file_id, caption=caption)
         elif file_type == "voice":
-            return await bot.send_voice(STORAGE_CHANNEL_ID, file_obj.file_id, caption=caption)
+            return await bot.send_voice(chat_id, telegram_file_id, caption=caption)
         elif file_type == "video_note":
-            return await bot.send_video_note(STORAGE_CHANNEL_ID, file_obj.file_id)
+            return await bot.send_video_note(chat_id, telegram_file_id)
         else:  # document
-            return await bot.send_document(STORAGE_CHANNEL_ID, file_obj.file_id, caption=caption)
+            return await bot.send_document(chat_id, telegram_file_id, caption=caption)
 
     async def _show_admin_panel(self, message: Message):
         """Show admin panel."""
@@ -1686,15 +5354,15 @@ Choose an option below to get started! 👇"""
 
         await query.edit_message_text("Admin Panel ⚙️\n\nSelect an option:", reply_markup=InlineKeyboardMarkup(keyboard))
 
-    async def _show_detailed_stats(self, message: Message):
-        """Show detailed bot statistics."""
+    def _load_bot_stats(self) -> tuple:
+        """Counts shown on the statistics screens"""
+        conn = get_db_connection(read_only=True)
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM authorized_users")
             total_users = cursor.fetchone()[0]
 
-            cursor.execute("SELECT COUNT(*) FROM groups")
+            cursor.execute("SELECT COUNT(*) FROM groups WHERE deleted_at IS NULL")
             total_groups = cursor.fetchone()[0]
 
             cursor.execute("SELECT COUNT(*) FROM files")
@@ -1709,8 +5377,16 @@ Choose an option below to get started! 👇"""
             cursor.execute("SELECT value FROM bot_settings WHERE key = 'caption_enabled'")
             caption_enabled = cursor.fetchone()[0] == '1'
 
+            return total_users, total_groups, total_files, total_size, active_links, caption_enabled
+        finally:
             conn.close()
 
+    async def _show_detailed_stats(self, message: Message):
+        """Show detailed bot statistics."""
+        try:
+            total_users, total_groups, total_files, total_size, active_links, caption_enabled = \
+                await asyncio.to_thread(self._load_bot_stats)
+
             text = f"""Bot Statistics 📊
 
 Users: {total_users} 👥
@@ -1746,27 +5422,8 @@ Settings:
     async def _show_bot_stats_callback(self, query):
         """Show bot stats via callback."""
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM authorized_users")
-            total_users = cursor.fetchone()[0]
-
-            cursor.execute("SELECT COUNT(*) FROM groups")
-            total_groups = cursor.fetchone()[0]
-
-            cursor.execute("SELECT COUNT(*) FROM files")
-            total_files = cursor.fetchone()[0]
-
-            cursor.execute("SELECT SUM(file_size) FROM files")
-            total_size = cursor.fetchone()[0] or 0
-
-            cursor.execute("SELECT COUNT(*) FROM file_links WHERE is_active = 1")
-            active_links = cursor.fetchone()[0]
-
-            cursor.execute("SELECT value FROM bot_settings WHERE key = 'caption_enabled'")
-            caption_enabled = cursor.fetchone()[0] == '1'
-
-            conn.close()
+            total_users, total_groups, total_files, total_size, active_links, caption_enabled = \
+                await asyncio.to_thread(self._load_bot_stats)
 
             text = f"""Bot Statistics 📊
 
@@ -1820,17 +5477,24 @@ Settings:
     async def _show_user_management_callback(self, query):
         """Show user management via callback - COMPLETE VERSION"""
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT user_id, username, first_name, is_active, caption_disabled, added_at
-                FROM authorized_users
-                WHERE user_id NOT IN (%s, %s)
-                ORDER BY added_at DESC
-                LIMIT 8
-            """, (ADMIN_IDS[0], ADMIN_IDS[1]))
-            users = cursor.fetchall()
-            conn.close()
+            viewer_id = query.from_user.id
+
+            def load_users() -> list:
+                conn = get_db_connection(read_only=True, user_id=viewer_id)
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("""
+                        SELECT user_id, username, first_name, is_active, caption_disabled, added_at
+                        FROM authorized_users
+                        WHERE user_id NOT IN (%s, %s)
+                        ORDER BY added_at DESC
+                        LIMIT 8
+                    """, (ADMIN_IDS[0], ADMIN_IDS[1]))
+                    return cursor.fetchall()
+                finally:
+                    conn.close()
+
+            users = await asyncio.to_thread(load_users)
 
             text = "User Management 👥\n\n"
             keyboard = [] # Fixed: Initialize keyboard here
@@ -1875,20 +5539,27 @@ Settings:
     async def _show_my_links(self, query, user_id):
         """Show user's links - WORKING VERSION"""
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT fl.link_code, fl.link_type, fl.clicks, fl.created_at,
-                       f.file_name, g.name as group_name
-                FROM file_links fl
-                LEFT JOIN files f ON fl.file_id = f.id
-                LEFT JOIN groups g ON fl.group_id = g.id
-                WHERE fl.owner_id = %s AND fl.is_active = 1
-                ORDER BY fl.created_at DESC
-                LIMIT 10
-            """, (user_id,))
-            links = cursor.fetchall()
-            conn.close()
+            def load_links() -> list:
+                conn = get_db_connection(read_only=True, user_id=user_id)
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("""
+                        SELECT fl.link_code, fl.link_type, fl.clicks, fl.created_at,
+                               f.file_name, g.name as group_name, fl.expires_at, fl.max_clicks
+                        FROM file_links fl
+                        LEFT JOIN files f ON fl.file_id = f.id
+                        LEFT JOIN groups g ON fl.group_id = g.id
+                        LEFT JOIN groups fg ON f.group_id = fg.id
+                        WHERE fl.owner_id = %s AND fl.is_active = 1 AND (fl.expires_at IS NULL OR fl.expires_at > NOW())
+                          AND g.deleted_at IS NULL AND fg.deleted_at IS NULL
+                        ORDER BY fl.created_at DESC
+                        LIMIT 10
+                    """, (user_id,))
+                    return cursor.fetchall()
+                finally:
+                    conn.close()
+
+            links = await asyncio.to_thread(load_links)
 
             if not links:
                 await query.edit_message_text(
@@ -1899,18 +5570,17 @@ Settings:
 
             text = "My Links 🔗\n\n"
             keyboard = [] # Fixed: Initialize keyboard here
-            for link_code, link_type, clicks, created_at, file_name, group_name in links:
+            for link_code, link_type, clicks, created_at, file_name, group_name, expires_at, max_clicks in links:
                 name = file_name if link_type == "file" else group_name
-                # Determine the correct callback prefix based on link_type
-                callback_prefix = "revoke_file_link" if link_type == "file" else "revoke_group_link"
-                
+
                 created_at_str = created_at.strftime("%Y-%m-%d") if created_at else "N/A"  # Format datetime to string
 
                 text += f"{link_type.title()}: {name[:20]}{'...' if len(name or '') > 20 else ''}\n"
-                text += f"Clicks: {clicks} | Created: {created_at_str}\n"
+                text += f"Clicks: {clicks}{f'/{max_clicks}' if max_clicks else ''} | Created: {created_at_str}"
+                text += f" | Expires: {expires_at.strftime('%Y-%m-%d %H:%M')}\n" if expires_at else "\n"
                 text += f"Link: https://t.me/{BOT_USERNAME.replace('@', '')}?start={link_code}\n\n"
                 # Add a revoke button for each link in this view with the correct callback_data
-                keyboard.append([InlineKeyboardButton(f"Revoke {name[:15]} 🚫", callback_data=f"{callback_prefix}_{link_code}")])
+                keyboard.append([InlineKeyboardButton(f"Revoke {name[:15]} 🚫", callback_data=self.callback_state.pack(user_id, "revoke_link", {"c": link_code}))])
 
             keyboard.append([InlineKeyboardButton("Refresh 🔄", callback_data="cmd_links")])
             keyboard.append([InlineKeyboardButton("Main Menu 🏠", callback_data="main_menu")])
@@ -1923,45 +5593,69 @@ Settings:
 
     # ================= LINK HANDLING WITH ACTUAL FORWARDING =================
 
-    async def _handle_link_access(self, update: Update, context: ContextTypes.DEFAULT_TYPE, link_code: str):
-        """Handle link access with actual file forwarding"""
-        try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
+    async def _handle_link_access(self, update: Update, context: ContextTypes.DEFAULT_TYPE, link_code: str) -> bool:
+        """Handle link access with actual file forwarding; True if anything was delivered"""
+        if not self.link_filter.might_exist(link_code):
+            logger.debug(f"Link access failed for {link_code}: rejected by the link filter.")
+            await update.message.reply_text(
+                "Invalid or Expired Link 🚫\n\n"
+                "This link is no longer valid or has been removed."
+            )
+            return False
 
-            # Get link info
-            cursor.execute("""
-                SELECT fl.link_type, fl.file_id, fl.group_id, fl.is_active,
-                       f.telegram_file_id, f.file_type, f.file_name, f.uploader_id,
-                       g.name as group_name, f.id as file_db_id, g.id as group_db_id
-                FROM file_links fl
-                LEFT JOIN files f ON fl.file_id = f.id
-                LEFT JOIN groups g ON fl.group_id = g.id
-                WHERE fl.link_code = %s
-            """, (link_code,))
-            link_info = cursor.fetchone()
+        try:
+            user_id = update.effective_user.id
+            link_info, offline = await self._resolve_link(link_code, user_id)
 
             if not link_info:
+                if offline:
+                    # The snapshot only holds links that can be served without the database
+                    logger.info(f"Link access failed for {link_code}: database unavailable and link not in the snapshot.")
+                    await update.message.reply_text(
+                        "Temporarily Unavailable ⏳\n\n"
+                        "We're having trouble reaching our database. Please try this link again in a few minutes."
+                    )
+                    return False
                 logger.info(f"Link access failed for {link_code}: Link not found in DB.")
+                self.link_filter.forget(link_code)
                 await update.message.reply_text(
                     "Invalid or Expired Link 🚫\n\n"
                     "This link is no longer valid or has been removed."
                 )
-                conn.close()
-                return
+                return False
 
-            link_type, file_id, group_id, is_active, telegram_file_id, file_type, file_name, uploader_id, group_name, file_db_id, group_db_id = link_info
-            logger.info(f"Link {link_code} accessed. Type: {link_type}, Active: {is_active}")
+            (link_type, file_id, group_id, is_active, telegram_file_id, file_type, file_name, uploader_id, group_name,
+             file_db_id, group_db_id, storage_channel_id, storage_message_id, expired,
+             manifest_version, caption_epoch, group_deleted, click_limited) = link_info
+            logger.info(f"Link {link_code} accessed. Type: {link_type}, Active: {is_active}, Offline: {offline}")
 
             # Check if link is active
             if not is_active:
                 logger.info(f"Link access failed for {link_code}: Link is inactive.")
+                self.link_filter.forget(link_code)
                 await update.message.reply_text(
                     "Invalid or Expired Link 🚫\n\n"
                     "This link has been revoked or is no longer active."
                 )
-                conn.close()
-                return
+                return False
+
+            if expired:
+                logger.info(f"Link access failed for {link_code}: Link has expired.")
+                self.link_filter.forget(link_code)
+                await update.message.reply_text(
+                    "Invalid or Expired Link 🚫\n\n"
+                    "This link has expired."
+                )
+                return False
+
+            if group_deleted:
+                logger.info(f"Link access failed for {link_code}: its group is being deleted.")
+                self.link_filter.forget(link_code)
+                await update.message.reply_text(
+                    "Invalid or Expired Link 🚫\n\n"
+                    "The group associated with this link has been deleted."
+                )
+                return False
 
             # Additional check: Ensure the referenced file/group still exists in the database
             # This is a fallback if ON DELETE CASCADE somehow misses an entry or if data integrity is compromised
@@ -1972,8 +5666,7 @@ Settings:
                     "File not found 🚫\n\n"
                     "The file associated with this link may have been deleted."
                 )
-                conn.close()
-                return
+                return False
             elif link_type == "group" and group_db_id is None:
                 logger.warning(f"Link {link_code} (group type) points to a non-existent group_id {group_id}. Marking as invalid.")
                 # Optionally, you could set is_active=0 here to clean up broken links
@@ -1981,121 +5674,213 @@ Settings:
                     "Group not found 🚫\n\n"
                     "The group associated with this link may have been deleted."
                 )
-                conn.close()
-                return
+                return False
+
+            counted = await self._count_link_click(link_code, offline)
+            if counted is None:
+                if click_limited:
+                    # Without the database the click budget cannot be enforced
+                    logger.warning(f"Link access failed for {link_code}: click-limited link while the database is down.")
+                    await update.message.reply_text(
+                        "Temporarily Unavailable ⏳\n\n"
+                        "We're having trouble reaching our database. Please try this link again in a few minutes."
+                    )
+                    return False
+                self.link_snapshot.record_click(link_code)
+                offline = True
+            elif not counted:
+                logger.info(f"Link access failed for {link_code}: click limit reached.")
+                self.link_filter.forget(link_code)
+                await update.message.reply_text(
+                    "Invalid or Expired Link 🚫\n\n"
+                    "This link has reached its click limit."
+                )
+                return False
+            else:
+                logger.info(f"Link {link_code} clicks updated.")
 
-            # Update clicks
-            cursor.execute("""
-                UPDATE file_links SET clicks = clicks + 1 WHERE link_code = %s
-            """, (link_code,))
-            conn.commit()
-            conn.close()
-            logger.info(f"Link {link_code} clicks updated.")
+            if offline:
+                caption_context = await asyncio.to_thread(self.link_snapshot.caption_context)
+                if link_type == "file":
+                    storage_post = (storage_channel_id, storage_message_id) if storage_message_id else None
+                    return await self._forward_single_file(update, telegram_file_id, file_type, file_name, uploader_id,
+                                                           storage_post, caption_context=caption_context)
+                return await self._forward_group_files(update, group_id, group_name,
+                                                       manifest=await asyncio.to_thread(self.link_snapshot.group_manifest, group_db_id))
 
             if link_type == "file":
-                await self._forward_single_file(update, telegram_file_id, file_type, file_name, uploader_id)
+                storage_post = (storage_channel_id, storage_message_id) if storage_message_id else None
+                return await self._forward_single_file(update, telegram_file_id, file_type, file_name, uploader_id, storage_post)
             else: # link_type == "group"
-                await self._forward_group_files(update, group_id, group_name)
+                return await self._forward_group_files(update, group_id, group_name, (manifest_version or 0, caption_epoch or 0))
 
         except Exception as e:
             logger.error(f"Link access error for link code {link_code}: {e}")
             await update.message.reply_text("Error accessing file. Please try again. 😔")
+        return False
+
+    async def _resolve_link(self, link_code: str, user_id: int) -> Tuple[Optional[tuple], bool]:
+        """Look a link up in the database, or in the local snapshot while the database is failing.
+
+        Returns (link_info, offline); link_info is None when the link is unknown
+        to whichever source answered.
+        """
+        if self.db_breaker.allow():
+            def lookup():
+                link_info = self._fetch_link(link_code, read_only=True, user_id=user_id)
+                if not link_info and db_router.enabled:
+                    # The replica may not have the link yet; only the primary can say it does not exist
+                    link_info = self._fetch_link(link_code)
+                return link_info
+
+            try:
+                link_info = await asyncio.wait_for(asyncio.to_thread(lookup), LINK_LOOKUP_TIMEOUT)
+                self.db_breaker.record_success()
+                return link_info, False
+            except (psycopg2.Error, asyncio.TimeoutError) as e:
+                self.db_breaker.record_failure()
+                logger.warning(f"Link lookup for {link_code} failed, using the local snapshot: {e or 'timed out'}")
+        if not self.link_snapshot:
+            raise RuntimeError("database unavailable and no link snapshot configured")
+        return await asyncio.to_thread(self.link_snapshot.lookup, link_code), True
+
+    async def _count_link_click(self, link_code: str, offline: bool) -> Optional[int]:
+        """Count a click on the primary; None if the database cannot be reached"""
+        if offline:
+            return None
+
+        def count():
+            conn = get_db_connection()
+            try:
+                cursor = conn.cursor()
+                # A link with a click budget is deactivated by its last allowed click
+                execute_prepared(cursor, "count_link_click", """
+                    UPDATE file_links
+                    SET clicks = clicks + 1,
+                        is_active = CASE WHEN clicks + 1 >= max_clicks THEN 0 ELSE is_active END
+                    WHERE link_code = %s AND is_active = 1 AND (max_clicks IS NULL OR clicks < max_clicks)
+                """, (link_code,))
+                conn.commit()
+                return cursor.rowcount
+            finally:
+                conn.close()
+
+        try:
+            counted = await asyncio.wait_for(asyncio.to_thread(count), LINK_LOOKUP_TIMEOUT)
+            self.db_breaker.record_success()
+            return counted
+        except (psycopg2.Error, asyncio.TimeoutError) as e:
+            self.db_breaker.record_failure()
+            if not self.link_snapshot:
+                raise
+            logger.warning(f"Counting a click on {link_code} failed, recording it locally: {e or 'timed out'}")
+            return None
+
+    def _fetch_link(self, link_code: str, read_only: bool = False, user_id: Optional[int] = None) -> Optional[tuple]:
+        """Look up everything link access needs about a link code in one query"""
+        conn = get_db_connection(read_only=read_only, user_id=user_id)
+        try:
+            cursor = conn.cursor()
+            execute_prepared(cursor, "fetch_link", """
+                SELECT fl.link_type, fl.file_id, fl.group_id, fl.is_active,
+                       f.telegram_file_id, f.file_type, f.file_name, f.uploader_id,
+                       g.name as group_name, f.id as file_db_id, g.id as group_db_id,
+                       f.storage_channel_id, f.storage_message_id,
+                       fl.expires_at <= NOW() AS expired, g.manifest_version,
+                       (SELECT value::BIGINT FROM bot_settings WHERE key = 'caption_epoch') AS caption_epoch,
+                       COALESCE(g.deleted_at, fg.deleted_at) IS NOT NULL AS group_deleted,
+                       fl.max_clicks IS NOT NULL AS click_limited
+                FROM file_links fl
+                LEFT JOIN files f ON fl.file_id = f.id
+                LEFT JOIN groups g ON fl.group_id = g.id
+                LEFT JOIN groups fg ON f.group_id = fg.id
+                WHERE fl.link_code = %s
+            """, (link_code,))
+            return cursor.fetchone()
+        finally:
+            conn.close()
 
-    async def _forward_single_file(self, update: Update, telegram_file_id: str, file_type: str, file_name: str, uploader_id: int = None):
-        """Forward single file with proper caption"""
-        bot = self.app.bot
+    async def _forward_single_file(self, update: Update, telegram_file_id: str, file_type: str, file_name: str, uploader_id: int = None,
+                                   storage_post: Optional[Tuple[int, int]] = None, caption_context: Optional[Tuple[bool, str, set]] = None):
+        """Forward single file with proper caption (from caption_context instead of the database when given), True if sent"""
         chat_id = update.effective_chat.id
 
         try:
-            caption = get_file_caption(file_name, user_id=uploader_id)
+            if caption_context:
+                caption = build_file_caption(file_name, None, uploader_id, caption_context)
+            else:
+                caption = await asyncio.to_thread(get_file_caption, file_name, user_id=uploader_id)
 
-            if file_type == "photo":
-                sent_msg = await bot.send_photo(chat_id, telegram_file_id, caption=caption)
-            elif file_type == "video":
-                sent_msg = await bot.send_video(chat_id, telegram_file_id, caption=caption)
-            elif file_type == "audio":
-                sent_msg = await bot.send_audio(chat_id, telegram_file_id, caption=caption)
-            elif file_type == "voice":
-                sent_msg = await bot.send_voice(chat_id, telegram_file_id, caption=caption)
-            elif file_type == "video_note":
-                sent_msg = await bot.send_video_note(chat_id, telegram_file_id)
-            else:  # document
-                sent_msg = await bot.send_document(chat_id, telegram_file_id, caption=caption)
+            sent_msg, sender = await self.delivery.send(
+                chat_id, storage_post,
+                None if is_imported_file_id(telegram_file_id) else
+                lambda bot: self._send_file(bot, chat_id, telegram_file_id, file_type, caption),
+                caption if file_type != "video_note" else None
+            )
 
             # Log when auto-delete job is scheduled
             logger.info(f"Scheduling auto-delete for single file msg_id: {sent_msg.message_id} in chat {chat_id}")
             self.app.job_queue.run_once(
                 self._auto_delete,
-                when=600,
-                data={
-                    'chat_id': chat_id,
-                    'message_ids': [sent_msg.message_id, update.message.message_id]
-                }
+                when=AUTO_DELETE_SECONDS,
+                data=self._auto_delete_data(chat_id, [update.message.message_id], [(sender, sent_msg.message_id)])
             )
 
-            _, custom_caption = get_caption_setting()
+            custom_caption = caption_context[1] if caption_context else (await asyncio.to_thread(get_caption_setting))[1]
 
             await update.message.reply_text(
                 f"File Forwarded Successfully! ✅\n\n"
                 f"File: {file_name}\n"
                 f"Branded with: {custom_caption}\n\n"
-                f"This message will auto-delete in 10 minutes. ⏳"
+                f"This message will auto-delete in {format_duration(AUTO_DELETE_SECONDS)}. ⏳"
             )
+            return True
 
         except Exception as e:
             logger.error(f"Forward single file error: {e}. Check bot permissions in chat {chat_id} and if file_id is valid.")
             await update.message.reply_text(f"Error forwarding file: {e}. File might be unavailable or bot lacks permissions. 😔")
+            return False
+
+    async def _forward_group_files(self, update: Update, group_id: int, group_name: str, manifest_key: Optional[Tuple[int, int]] = None,
+                                   manifest: Optional[list] = None):
+        """Forward all files in a group (from its cached manifest when manifest_key is current, or the given manifest).
 
-    async def _forward_group_files(self, update: Update, group_id: int, group_name: str):
-        """Forward all files in a group"""
-        bot = self.app.bot
+        Returns True if at least one file was sent.
+        """
         chat_id = update.effective_chat.id
         message_ids = [update.message.message_id] # Include the user's command message for auto-deletion
 
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT telegram_file_id, file_type, file_name, serial_number, uploader_id
-                FROM files WHERE group_id = %s
-                ORDER BY serial_number ASC
-            """, (group_id,))
-            files = cursor.fetchall()
-            conn.close()
+            files = manifest if manifest is not None else await asyncio.to_thread(self.manifests.get, group_id, manifest_key)
 
             if not files:
                 await update.message.reply_text(f"Group '{group_name}' is empty or files are unavailable. 🤷‍♂️")
-                return
+                return False
 
             # Send header
             header_msg = await update.message.reply_text(
                 f"Forwarding {len(files)} files from '{group_name}' 📦\n\n"
-                f"Auto-delete in 10 minutes... ⏳"
+                f"Auto-delete in {format_duration(AUTO_DELETE_SECONDS)}... ⏳"
             )
             message_ids.append(header_msg.message_id)
 
             forwarded_count = 0
             failed_files = []
+            delivered = []  # (delivery bot, message_id)
 
             # Forward each file
-            for telegram_file_id, file_type, file_name, serial_number, uploader_id in files:
+            for telegram_file_id, file_type, file_name, caption, storage_channel_id, storage_message_id in files:
                 try:
-                    caption = get_file_caption(file_name, serial_number, uploader_id)
-
-                    if file_type == "photo":
-                        sent_msg = await bot.send_photo(chat_id, telegram_file_id, caption=caption)
-                    elif file_type == "video":
-                        sent_msg = await bot.send_video(chat_id, telegram_file_id, caption=caption)
-                    elif file_type == "audio":
-                        sent_msg = await bot.send_audio(chat_id, telegram_file_id, caption=caption)
-                    elif file_type == "voice":
-                        sent_msg = await bot.send_voice(chat_id, telegram_file_id, caption=caption)
-                    elif file_type == "video_note":
-                        sent_msg = await bot.send_video_note(chat_id, telegram_file_id)
-                    else:
-                        sent_msg = await bot.send_document(chat_id, telegram_file_id, caption=caption)
+                    storage_post = (storage_channel_id, storage_message_id) if storage_message_id else None
 
-                    message_ids.append(sent_msg.message_id)
+                    sent_msg, sender = await self.delivery.send(
+                        chat_id, storage_post,
+                        None if is_imported_file_id(telegram_file_id) else
+                        lambda bot: self._send_file(bot, chat_id, telegram_file_id, file_type, caption),
+                        caption if file_type != "video_note" else None
+                    )
+
+                    delivered.append((sender, sent_msg.message_id))
                     forwarded_count += 1
 
                     # Small delay to avoid rate limits
@@ -2117,32 +5902,47 @@ Settings:
             else:
                 await update.message.reply_text(f"All {forwarded_count} files from group '{group_name}' forwarded successfully! ✅")
 
-            # Auto-delete all messages after 10 minutes
+            # Auto-delete all messages after AUTO_DELETE_SECONDS
             if message_ids: # Only schedule if there are messages to delete
-                logger.info(f"Scheduling auto-delete for group files in chat {chat_id}: {message_ids}")
+                logger.info(f"Scheduling auto-delete for group files in chat {chat_id}: {len(message_ids) + len(delivered)} messages")
                 self.app.job_queue.run_once(
                     self._auto_delete,
-                    when=600, # 10 minutes
-                    data={
-                        'chat_id': chat_id,
-                        'message_ids': message_ids
-                    }
+                    when=AUTO_DELETE_SECONDS,
+                    data=self._auto_delete_data(chat_id, message_ids, delivered)
                 )
+            return forwarded_count > 0
 
         except Exception as e:
             logger.error(f"Overall group forward error for group {group_id} ({group_name}): {e}")
             await update.message.reply_text(f"An unexpected error occurred while processing group files: {e}. 😔")
+            return False
+
+    def _auto_delete_data(self, chat_id: int, message_ids: list, delivered: list) -> dict:
+        """Job data for _auto_delete; files sent by helper bots must be deleted by the same helper"""
+        helper_message_ids = defaultdict(list)
+        message_ids = list(message_ids)
+        for sender, message_id in delivered:
+            if sender.is_main:
+                message_ids.append(message_id)
+            else:
+                helper_message_ids[sender.index].append(message_id)
+        return {'chat_id': chat_id, 'message_ids': message_ids, 'helper_message_ids': dict(helper_message_ids)}
 
     async def _auto_delete(self, context):
         """Auto-delete messages"""
         data = context.job.data
         chat_id = data['chat_id']
-        message_ids = data['message_ids']
-        logger.info(f"Auto-delete job triggered for chat {chat_id}. Messages to delete: {message_ids}")
+        logger.info(f"Auto-delete job triggered for chat {chat_id}. Messages to delete: {data['message_ids']}")
 
+        await self._delete_chat_messages(self.app.bot, chat_id, data['message_ids'])
+        for helper_index, message_ids in data.get('helper_message_ids', {}).items():
+            await self._delete_chat_messages(self.delivery.members[helper_index].bot, chat_id, message_ids)
+
+    async def _delete_chat_messages(self, bot: Bot, chat_id: int, message_ids: list):
+        """Delete messages one by one, logging the ones that are already gone"""
         for msg_id in message_ids:
             try:
-                await self.app.bot.delete_message(chat_id, msg_id)
+                await bot.delete_message(chat_id, msg_id)
                 logger.info(f"Successfully deleted message {msg_id} in chat {chat_id}")
             except BadRequest as e:
                 # Catch specific Telegram API errors for better diagnosis
@@ -2153,9 +5953,175 @@ Settings:
             except Exception as e:
                 logger.error(f"Unexpected error deleting message {msg_id} in chat {chat_id}: {e}")
 
+    async def _sweep_expired_sessions(self, context):
+        """Periodically drop abandoned bulk/upload/caption sessions"""
+        try:
+            removed = await asyncio.to_thread(self.sessions.sweep_expired)
+            if removed:
+                logger.info(f"Expired {removed} abandoned session(s)")
+        except Exception as e:
+            logger.error(f"Session sweep error: {e}")
+
+    async def _sweep_expired_links(self, context):
+        """Periodically deactivate expired links"""
+        try:
+            deactivated = await asyncio.to_thread(deactivate_expired_links)
+            if deactivated:
+                logger.info(f"Deactivated {deactivated} expired link(s)")
+        except Exception as e:
+            logger.error(f"Expired link sweep error: {e}")
+
+    async def _check_read_replica(self, context):
+        """Periodically measure the read replica's lag; reads fall back to the primary when it is stale"""
+        await asyncio.to_thread(db_router.check)
+
+    async def _reconcile_group_counters(self, context):
+        """Periodically repair group file counters that drifted from the files table"""
+        try:
+            checked, repaired = await asyncio.to_thread(reconcile_group_counters)
+            if repaired:
+                logger.info(f"Group counter reconciliation: {repaired} of {checked} group(s) repaired")
+        except Exception as e:
+            logger.error(f"Group counter reconciliation error: {e}")
+
+    async def _refresh_link_snapshot(self, context):
+        """Periodically bring the offline link snapshot up to date"""
+        try:
+            summary = await asyncio.to_thread(self.link_snapshot.refresh)
+            logger.debug(f"Link snapshot {summary}")
+        except Exception as e:
+            # The snapshot keeps serving what it has; it is only as stale as the outage is long
+            logger.warning(f"Link snapshot refresh failed: {e}")
+
+    async def _rebuild_link_filter(self, context):
+        """Periodically rebuild the link code filter so revoked codes drop out of it"""
+        await asyncio.to_thread(self.link_filter.rebuild_and_log)
+
+    async def _drain_storage_gc(self, context):
+        """Periodically delete storage posts of deleted files"""
+        if self.reconciler.running:
+            return  # The running pass drains the queue itself
+        deleted = await self.reconciler.drain_gc_queue()
+        if deleted:
+            logger.info(f"Deleted {deleted} storage post(s) of deleted files")
+
+    async def _scheduled_reconcile(self, context):
+        """Periodic storage reconciliation (RECONCILE_INTERVAL)"""
+        if not self.reconciler.running:
+            await self._run_reconcile()
+
+    async def _run_import(self, job_id: int, progress_msg: Message):
+        """Run an import job and keep the admin posted"""
+        async def report_progress(stats):
+            try:
+                await progress_msg.edit_text(
+                    f"Import job #{job_id} running... ⏳\n\n"
+                    f"Posts scanned: {stats['scanned']} 🔍\n"
+                    f"Files imported: {stats['imported']} 📄\n"
+                    f"Skipped: {stats['skipped']}\n"
+                    f"Last message: {stats['last_message_id']}"
+                )
+            except Exception as e:
+                logger.error(f"Error reporting import progress: {e}")
+
+        try:
+            stats = await self.importer.run(job_id, report_progress)
+            text = (
+                f"Import job #{job_id} complete! ✅\n\n"
+                f"Posts scanned: {stats['scanned']} 🔍\n"
+                f"Files imported: {stats['imported']} 📄\n"
+                f"Skipped (no media or no group match): {stats['skipped']}\n"
+                f"Group links created: {stats['group_links']} 🔗\n\n"
+                "Use /groups to browse and share the imported groups."
+            )
+        except Exception as e:
+            logger.error(f"Import job {job_id} error: {e}")
+            text = f"Import job #{job_id} stopped: {e} 😔\nRun the same /importchannel command again to resume."
+
+        try:
+            await progress_msg.edit_text(text)
+        except Exception as e:
+            logger.error(f"Error reporting import result: {e}")
+
+    @staticmethod
+    def _broadcast_report(stats: dict) -> str:
+        done = stats["sent"] + stats["failed"] + stats["blocked"]
+        text = (
+            f"Sent: {stats['sent']}/{stats['total']} ✅\n"
+            f"Failed: {stats['failed']} ❌\n"
+            f"Blocked the bot (deactivated): {stats['blocked']} 🚫"
+        )
+        if stats["status"] == "running" and stats["rate"]:
+            eta = max(stats["total"] - done, 0) / stats["rate"]
+            text += f"\n\n{stats['rate']:.1f} messages/s, about {format_duration(max(60, round(eta / 60) * 60))} left"
+        return text
+
+    async def _run_broadcast(self, broadcast_id: int, chat_id: Optional[int], message_id: Optional[int]):
+        """Run a broadcast and keep its progress message up to date"""
+        async def edit(text):
+            if not chat_id or not message_id:
+                return
+            try:
+                await self.app.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+            except Exception as e:
+                logger.error(f"Error reporting broadcast progress: {e}")
+
+        async def report_progress(stats):
+            await edit(f"Broadcast #{broadcast_id} running... ⏳\n\n{self._broadcast_report(stats)}\n\n"
+                       f"/broadcast stop {broadcast_id} to stop it")
+
+        try:
+            stats = await self.broadcaster.run(broadcast_id, report_progress)
+        except Exception as e:
+            logger.error(f"Broadcast {broadcast_id} error: {e}")
+            await edit(f"Broadcast #{broadcast_id} interrupted: {e} 😔\nIt resumes automatically within 10 minutes.")
+            return
+        if stats is None:
+            return  # Another replica is sending it
+
+        logger.info(f"Broadcast #{broadcast_id} {stats['status']}: {stats['sent']} sent, "
+                    f"{stats['failed']} failed, {stats['blocked']} blocked")
+        title = "complete! ✅" if stats["status"] == "done" else "stopped ⏹️"
+        await edit(f"Broadcast #{broadcast_id} {title}\n\n{self._broadcast_report(stats)}")
+
+    async def _resume_broadcasts(self, context):
+        """Resume broadcasts interrupted by a restart; replicas skip those another replica is sending"""
+        try:
+            pending = await asyncio.to_thread(self.broadcaster.pending)
+        except Exception as e:
+            logger.error(f"Error looking up pending broadcasts: {e}")
+            return
+        for broadcast_id, chat_id, message_id in pending:
+            if broadcast_id not in self.broadcaster.running:
+                logger.info(f"Resuming broadcast #{broadcast_id}")
+                self.app.create_task(self._run_broadcast(broadcast_id, chat_id, message_id))
+
+    async def _run_reconcile(self, progress_msg: Optional[Message] = None):
+        """Run a reconciliation pass and report the outcome"""
+        try:
+            stats = await self.reconciler.run()
+            text = (
+                f"Storage Reconciliation Complete ✅\n\n"
+                f"Posts scanned: {stats['scanned']} 🔍\n"
+                f"Orphaned posts deleted: {stats['orphans_deleted']} 🗑️\n"
+                f"Deleted files cleaned up: {stats['gc_deleted']} 🧹\n"
+                f"Missing posts found: {stats['missing']} ⚠️\n"
+                f"Files re-uploaded: {stats['recopied']} ⬆️\n"
+                f"Failed: {stats['failed']} ❌"
+            )
+        except Exception as e:
+            logger.error(f"Storage reconciliation error: {e}")
+            text = f"Storage reconciliation stopped: {e} 😔\nRun /reconcile again to resume."
+
+        if progress_msg:
+            try:
+                await progress_msg.edit_text(text)
+            except Exception as e:
+                logger.error(f"Error reporting reconciliation result: {e}")
+
     async def _show_caption_settings_callback(self, query):
         """Show caption settings"""
-        caption_enabled, custom_caption = get_caption_setting()
+        caption_enabled, custom_caption = await asyncio.to_thread(get_caption_setting)
         status = "Enabled ✅" if caption_enabled else "Disabled ❌"
 
         await query.edit_message_text(
@@ -2170,14 +6136,20 @@ Settings:
 
     async def _toggle_global_caption(self, query):
         """Toggle global caption"""
-        caption_enabled, custom_caption = get_caption_setting()
+        caption_enabled, custom_caption = await asyncio.to_thread(get_caption_setting)
         new_status = not caption_enabled
 
-        conn = psycopg2.connect(SUPABASE_URL)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE bot_settings SET value = %s WHERE key = 'caption_enabled'", ('1' if new_status else '0',))
-        conn.commit()
-        conn.close()
+        def save():
+            conn = get_db_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute("UPDATE bot_settings SET value = %s WHERE key = 'caption_enabled'", ('1' if new_status else '0',))
+                bump_caption_epoch(cursor)
+                conn.commit()
+            finally:
+                conn.close()
+
+        await asyncio.to_thread(save)
 
         await query.edit_message_text(
             f"Caption {'Enabled ✅' if new_status else 'Disabled ❌'} Globally",
@@ -2190,18 +6162,27 @@ Settings:
         """Toggle user caption"""
         user_id = int(data.split("_")[-1])
 
-        conn = psycopg2.connect(SUPABASE_URL)
-        cursor = conn.cursor()
-        cursor.execute("SELECT caption_disabled, first_name FROM authorized_users WHERE user_id = %s", (user_id,))
-        current = cursor.fetchone()
-
-        if current:
-            new_status = not current[0]
-            cursor.execute("UPDATE authorized_users SET caption_disabled = %s WHERE user_id = %s", (new_status, user_id))
-            conn.commit()
+        def toggle() -> Optional[tuple]:
+            conn = get_db_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT caption_disabled, first_name FROM authorized_users WHERE user_id = %s", (user_id,))
+                current = cursor.fetchone()
+                if not current:
+                    return None
+                new_status = not current[0]
+                cursor.execute("UPDATE authorized_users SET caption_disabled = %s WHERE user_id = %s", (new_status, user_id))
+                bump_caption_epoch(cursor)
+                conn.commit()
+                return new_status, current[1]
+            finally:
+                conn.close()
 
+        toggled = await asyncio.to_thread(toggle)
+        if toggled:
+            new_status, first_name = toggled
             await query.edit_message_text(
-                f"Caption {'Disabled ❌' if new_status else 'Enabled ✅'} for {current[1] or 'User'}",
+                f"Caption {'Disabled ❌' if new_status else 'Enabled ✅'} for {first_name or 'User'}",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("User Management 👥", callback_data="user_management")]
                 ])
@@ -2209,8 +6190,6 @@ Settings:
         else:
             await query.edit_message_text("User not found 🤷‍♂️")
 
-        conn.close()
-
     async def _show_advanced_settings_callback(self, query):
         """Show advanced settings - now functional placeholder"""
         text = """Advanced Settings 🔧
@@ -2228,7 +6207,7 @@ No configurable options here yet.
     async def _edit_caption_text_callback(self, query, context):
         """Prompt admin to send new caption text"""
         user_id = query.from_user.id
-        self.caption_edit_pending[user_id] = {'state': 'waiting_for_caption'}
+        await self.sessions.set('caption_edit', user_id, {'state': 'waiting_for_caption'})
         await query.edit_message_text(
             "Please send the new custom caption text you want to set. ✏️\n\n"
             "Example: `t.me/NewChannelLink`\n\n"
@@ -2239,14 +6218,21 @@ No configurable options here yet.
     async def _update_custom_caption(self, update: Update, new_caption: str):
         """Update the custom caption in the database"""
         user_id = update.effective_user.id
-        if user_id in self.caption_edit_pending and self.caption_edit_pending[user_id]['state'] == 'waiting_for_caption':
+        caption_edit = await self.sessions.get('caption_edit', user_id)
+        if caption_edit and caption_edit['state'] == 'waiting_for_caption':
             try:
-                conn = psycopg2.connect(SUPABASE_URL)
-                cursor = conn.cursor()
-                cursor.execute("UPDATE bot_settings SET value = %s WHERE key = 'custom_caption'", (new_caption,))
-                conn.commit()
-                conn.close()
-                del self.caption_edit_pending[user_id] # Clear state
+                def save():
+                    conn = get_db_connection()
+                    try:
+                        cursor = conn.cursor()
+                        cursor.execute("UPDATE bot_settings SET value = %s WHERE key = 'custom_caption'", (new_caption,))
+                        bump_caption_epoch(cursor)
+                        conn.commit()
+                    finally:
+                        conn.close()
+
+                await asyncio.to_thread(save)
+                await self.sessions.delete('caption_edit', user_id) # Clear state
                 await update.message.reply_text(
                     f"Custom caption updated successfully to: ✅\n`{new_caption}`",
                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Caption Settings ✍️", callback_data="caption_settings")]])
@@ -2260,16 +6246,21 @@ No configurable options here yet.
     async def _show_user_caption_control(self, query):
         """Display list of users to toggle their caption settings"""
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT user_id, first_name, username, caption_disabled
-                FROM authorized_users
-                WHERE user_id NOT IN (%s, %s)
-                ORDER BY first_name ASC
-            """, (ADMIN_IDS[0], ADMIN_IDS[1]))
-            users = cursor.fetchall()
-            conn.close()
+            def load_users() -> list:
+                conn = get_db_connection()
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("""
+                        SELECT user_id, first_name, username, caption_disabled
+                        FROM authorized_users
+                        WHERE user_id NOT IN (%s, %s)
+                        ORDER BY first_name ASC
+                    """, (ADMIN_IDS[0], ADMIN_IDS[1]))
+                    return cursor.fetchall()
+                finally:
+                    conn.close()
+
+            users = await asyncio.to_thread(load_users)
 
             text = "User Specific Caption Control 👥\n\n"
             keyboard = [] # Fixed: Initialize keyboard here
@@ -2293,14 +6284,24 @@ No configurable options here yet.
         """Show detailed information about a specific user."""
         user_id = int(data.split("_")[-1])
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT user_id, username, first_name, added_by, added_at, is_active, caption_disabled
-                FROM authorized_users WHERE user_id = %s
-            """, (user_id,))
-            user_info = cursor.fetchone()
-            conn.close()
+            def load_user() -> Tuple[Optional[tuple], Optional[tuple]]:
+                conn = get_db_connection()
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("""
+                        SELECT user_id, username, first_name, added_by, added_at, is_active, caption_disabled
+                        FROM authorized_users WHERE user_id = %s
+                    """, (user_id,))
+                    user_info = cursor.fetchone()
+                    admin_name_row = None
+                    if user_info and user_info[3]:
+                        cursor.execute("SELECT first_name FROM authorized_users WHERE user_id = %s", (user_info[3],))
+                        admin_name_row = cursor.fetchone()
+                    return user_info, admin_name_row
+                finally:
+                    conn.close()
+
+            user_info, admin_name_row = await asyncio.to_thread(load_user)
 
             if user_info:
                 u_id, username, first_name, added_by, added_at, is_active, caption_disabled = user_info
@@ -2309,14 +6310,8 @@ No configurable options here yet.
 
                 # Fetch added_by_admin_name
                 added_by_admin_name = "Unknown Admin"
-                if added_by:
-                    conn = psycopg2.connect(SUPABASE_URL)
-                    cursor = conn.cursor()
-                    cursor.execute("SELECT first_name FROM authorized_users WHERE user_id = %s", (added_by,))
-                    admin_name_row = cursor.fetchone()
-                    conn.close()
-                    if admin_name_row:
-                        added_by_admin_name = admin_name_row[0] or f"Admin {added_by}"
+                if admin_name_row:
+                    added_by_admin_name = admin_name_row[0] or f"Admin {added_by}"
 
                 text = f"""User Information ℹ️:
 ID: {u_id}
@@ -2350,11 +6345,16 @@ Added At: {added_at_str}""" # Slice for cleaner timestamp
                                          )
             return
 
-        conn = psycopg2.connect(SUPABASE_URL)
-        cursor = conn.cursor()
-        cursor.execute("SELECT first_name FROM authorized_users WHERE user_id = %s", (user_id_to_remove,))
-        user_name = cursor.fetchone()
-        conn.close()
+        def load_name() -> Optional[tuple]:
+            conn = get_db_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT first_name FROM authorized_users WHERE user_id = %s", (user_id_to_remove,))
+                return cursor.fetchone()
+            finally:
+                conn.close()
+
+        user_name = await asyncio.to_thread(load_name)
 
         display_name = user_name[0] if user_name else f"User {user_id_to_remove}"
 
@@ -2379,12 +6379,19 @@ Added At: {added_at_str}""" # Slice for cleaner timestamp
             return
 
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM authorized_users WHERE user_id = %s", (user_id_to_remove,))
-            rowcount = cursor.rowcount
-            conn.commit()
-            conn.close()
+            admin_id = query.from_user.id
+
+            def remove_user() -> int:
+                conn = get_db_connection(user_id=admin_id)
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("DELETE FROM authorized_users WHERE user_id = %s", (user_id_to_remove,))
+                    conn.commit()
+                    return cursor.rowcount
+                finally:
+                    conn.close()
+
+            rowcount = await asyncio.to_thread(remove_user)
 
             if rowcount > 0:
                 await query.edit_message_text(
@@ -2400,53 +6407,154 @@ Added At: {added_at_str}""" # Slice for cleaner timestamp
             logger.error(f"Error executing user removal: {e}")
             await query.edit_message_text("An error occurred while removing the user. 😔")
 
-    async def _list_all_users_callback(self, query):
-        """List all authorized users with pagination if needed."""
+    async def _list_all_users_callback(self, query, page: int = 0):
+        """List all authorized users, one page at a time."""
+        try:
+            pages = await asyncio.to_thread(self._user_listing_pages, query.from_user.id, "all_users")
+            if not pages:
+                text = "No regular users found. 🤷‍♂️"
+                keyboard = [[InlineKeyboardButton("User Management 👥", callback_data="user_management")]]
+                await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+                return
+
+            text, keyboard = pages[min(page, len(pages) - 1)]
+            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+        except Exception as e:
+            logger.error(f"Error listing all users: {e}")
+            await query.edit_message_text("Error retrieving all users. 😔")
+
+    def _user_listing_pages(self, viewer_id: int, listing: str) -> list:
+        """Rendered pages of the regular users for /listusers ("users") or the admin panel ("all_users").
+
+        Cached until authorized_users changes (users_version); empty if there are no regular users.
+        """
+        conn = get_db_connection(read_only=True, user_id=viewer_id)
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
             cursor = conn.cursor()
+            cursor.execute("SELECT value FROM bot_settings WHERE key = 'users_version'")
+            row = cursor.fetchone()
+            version = row[0] if row else None
+            pages = self.pages.get(listing, version)
+            if pages is not None:
+                return pages
+
             cursor.execute("""
                 SELECT user_id, username, first_name, added_at, is_active, caption_disabled
-                FROM authorized_users WHERE user_id NOT IN (%s, %s)
+                FROM authorized_users WHERE user_id <> ALL(%s)
                 ORDER BY added_at DESC
-            """, (ADMIN_IDS[0], ADMIN_IDS[1]))
+            """, (ADMIN_IDS,))
             users = cursor.fetchall()
+        finally:
             conn.close()
 
-            text = "All Authorized Users 📜:\n\n"
-            keyboard = [] # Fixed: Initialize keyboard here
-            if not users:
-                text = "No regular users found. 🤷‍♂️"
-                keyboard = [[InlineKeyboardButton("User Management 👥", callback_data="user_management")]]
-                await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
-
-            for user_id, username, first_name, added_at, is_active, caption_disabled in users:
-                status = "Active ✅" if is_active else "Inactive ❌"
-                caption_status = "No Caption 🚫" if caption_disabled else "With Caption ✅"
+        records = []
+        for user_id, username, first_name, added_at, is_active, caption_disabled in users:
+            status = "Active ✅" if is_active else "Inactive ❌"
+            caption_status = "No Caption 🚫" if caption_disabled else "With Caption ✅"
+            added_at_str = added_at.strftime("%Y-%m-%d") if added_at else "N/A"  # Format datetime to string
 
-                added_at_str = added_at.strftime("%Y-%m-%d") if added_at else "N/A"  # Format datetime to string
+            if listing == "users":
+                text = "\n".join([f"{first_name or 'Unknown'}", f"ID: {user_id}", f"@{username or 'None'}",
+                                  f"Status: {status}", f"Caption: {caption_status}", f"Added: {added_at_str}\n\n"])
+            else:
+                text = (f"{first_name or 'Unknown'} (ID: {user_id})\n"
+                        f"@{username or 'None'} | Status: {status} | Caption: {caption_status}\n"
+                        f"Added: {added_at_str}\n\n")
+            records.append((text, []))
+
+        if not records:
+            pages = []
+        elif listing == "users":
+            pages = render_pages("Authorized Users 👥", records, [], lambda page: f"users_page_{page}")
+        else:
+            pages = render_pages("All Authorized Users 📜", records,
+                                 [[InlineKeyboardButton("User Management 👥", callback_data="user_management")]],
+                                 lambda page: f"all_users_page_{page}")
+        self.pages.put(listing, version, pages)
+        return pages
+
+    def _search_files(self, owner_id: int, search_text: str, limit: int, offset: int = 0) -> list:
+        """Ranked file-name search scoped to the owner's groups.
+
+        A file matches if its name contains the text or, with pg_trgm, has a
+        word similar to it (typos, e.g. "Meridain" finds "Meridian"); both are
+        served by the trigram GIN index on files.file_name. The newest
+        SEARCH_RANK_CANDIDATES matches are ranked by word similarity, newest
+        first on ties, so a query matching thousands of files never sorts them
+        all. Without pg_trgm only substring matches are found, exact names first.
+        """
+        pattern = "%" + search_text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        if TRGM_AVAILABLE:
+            match = "(f.file_name ILIKE %(pattern)s OR %(text)s <%% f.file_name)"
+            rank = "word_similarity(%(text)s, file_name) DESC, similarity(file_name, %(text)s) DESC"
+        else:
+            match = "f.file_name ILIKE %(pattern)s"
+            rank = "(lower(file_name) = lower(%(text)s)) DESC"
+        conn = get_db_connection(read_only=True, user_id=owner_id)
+        try:
+            cursor = conn.cursor()
+            if TRGM_AVAILABLE:
+                cursor.execute("SET LOCAL pg_trgm.word_similarity_threshold = %s", (SEARCH_FUZZY_THRESHOLD,))
+            cursor.execute(f"""
+                SELECT id, serial_number, file_name, file_type, file_size, telegram_file_id, uploader_id, group_name
+                FROM (
+                    SELECT f.id, f.serial_number, f.file_name, f.file_type, f.file_size, f.telegram_file_id,
+                           f.uploader_id, g.name AS group_name
+                    FROM files f
+                    JOIN groups g ON f.group_id = g.id
+                    WHERE g.owner_id = %(owner_id)s AND g.deleted_at IS NULL AND {match}
+                    ORDER BY f.id DESC
+                    LIMIT %(candidates)s
+                ) candidates
+                ORDER BY {rank}, id DESC
+                LIMIT %(limit)s OFFSET %(offset)s
+            """, {"owner_id": owner_id, "pattern": pattern, "text": search_text,
+                  "candidates": SEARCH_RANK_CANDIDATES, "limit": limit, "offset": offset})
+            return cursor.fetchall()
+        finally:
+            conn.close()
 
-                text += (f"{first_name or 'Unknown'} (ID: {user_id})\n"
-                         f"@{username or 'None'} | Status: {status} | Caption: {caption_status}\n"
-                         f"Added: {added_at_str}\n\n")
+    async def _show_search_results(self, message: Optional[Message], query: Optional[CallbackQuery], user_id: int, search_text: str, page: int):
+        """Render one page of /search results, linking each file to its details view."""
+        try:
+            # Fetch one extra row to know whether a next page exists
+            rows = await asyncio.to_thread(self._search_files, user_id, search_text, SEARCH_PAGE_SIZE + 1, page * SEARCH_PAGE_SIZE)
+            has_next = len(rows) > SEARCH_PAGE_SIZE
+            rows = rows[:SEARCH_PAGE_SIZE]
 
-            # Telegram message limit is 4096 characters for text messages.
-            # Split and send if too long.
-            if len(text) > 4000:
-                chunks = [text[i:i + 4000] for i in range(0, len(text), 4000)]
-                for i, chunk in enumerate(chunks):
-                    if i == 0:
-                        await query.edit_message_text(chunk, reply_markup=InlineKeyboardMarkup(keyboard))
-                    else:
-                        await query.message.reply_text(chunk)
+            keyboard = []
+            if not rows:
+                text = f"No files matching '{search_text}' found. 🤷‍♂️" if page == 0 else "No more results. 🤷‍♂️"
             else:
+                lines = [f"Search Results for '{search_text}' 🔍 (page {page + 1})\n"]
+                for file_id, serial_number, file_name, _, file_size, _, _, group_name in rows:
+                    lines.append(f"#{serial_number:03d} {file_name} ({format_size(file_size)}) - {group_name} 📁")
+                    keyboard.append([InlineKeyboardButton(f"#{serial_number:03d} {file_name[:25]}", callback_data=f"view_file_id_{file_id}")])
+                text = "\n".join(lines)
+
+            nav = []
+            if page > 0:
+                nav.append(InlineKeyboardButton("⬅️ Previous", callback_data=self.callback_state.pack(
+                    user_id, "search", {"q": search_text, "p": page - 1})))
+            if has_next:
+                nav.append(InlineKeyboardButton("Next ➡️", callback_data=self.callback_state.pack(
+                    user_id, "search", {"q": search_text, "p": page + 1})))
+            if nav:
+                keyboard.append(nav)
+            keyboard.append([InlineKeyboardButton("Main Menu 🏠", callback_data="main_menu")])
+
+            if query:
                 await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+            else:
+                await message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
         except Exception as e:
-            logger.error(f"Error listing all users: {e}")
-            await query.edit_message_text("Error retrieving all users. 😔")
-
+            logger.error(f"Search error for user {user_id}: {e}")
+            if query:
+                await query.edit_message_text("Error searching files. Please try again. 😔")
+            else:
+                await message.reply_text("Error searching files. Please try again. 😔")
 
     async def _handle_view_group(self, query, data):
         """Display details of a selected group, including a list of its files."""
@@ -2454,21 +6562,43 @@ Added At: {added_at_str}""" # Slice for cleaner timestamp
         user_id = query.from_user.id
 
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT name, total_files, total_size, created_at
-                FROM groups WHERE id = %s AND owner_id = %s
-            """, (group_id, user_id))
-            group_info = cursor.fetchone()
+            def load_group() -> Optional[tuple]:
+                conn = get_db_connection(read_only=True, user_id=user_id)
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("""
+                        SELECT name, total_files, total_size, created_at
+                        FROM groups WHERE id = %s AND owner_id = %s AND deleted_at IS NULL
+                    """, (group_id, user_id))
+                    group_info = cursor.fetchone()
+                    if not group_info:
+                        return None
 
-            if not group_info:
+                    cursor.execute("""
+                        SELECT serial_number, file_name, file_size, id
+                        FROM files WHERE group_id = %s
+                        ORDER BY serial_number ASC LIMIT 10
+                    """, (group_id,))
+                    files = cursor.fetchall()
+
+                    # Get the active group link for this group, if it exists
+                    cursor.execute("""
+                        SELECT link_code FROM file_links
+                        WHERE group_id = %s AND owner_id = %s AND link_type = 'group' AND is_active = 1
+                          AND expires_at IS NULL AND max_clicks IS NULL
+                    """, (group_id, user_id))
+                    return group_info, files, cursor.fetchone()
+                finally:
+                    conn.close()
+
+            loaded = await asyncio.to_thread(load_group)
+            if not loaded:
                 await query.edit_message_text("Group not found or you don't have access. 🚫",
                                               reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("My Groups 📂", callback_data="cmd_groups")]])
                                              )
-                conn.close()
                 return
 
+            group_info, files, group_link_info = loaded
             name, total_files, total_size, created_at = group_info
 
             created_at_str = created_at.strftime("%Y-%m-%d") if created_at else "N/A"  # Format datetime to string
@@ -2480,24 +6610,8 @@ Created On: {created_at_str} 🗓️
 
 Files in this group (first 10):"""
 
-            cursor.execute("""
-                SELECT serial_number, file_name, file_size, id
-                FROM files WHERE group_id = %s
-                ORDER BY serial_number ASC LIMIT 10
-            """, (group_id,))
-            files = cursor.fetchall()
-
-            # Get the active group link for this group, if it exists
-            cursor.execute("""
-                SELECT link_code FROM file_links
-                WHERE group_id = %s AND owner_id = %s AND link_type = 'group' AND is_active = 1
-            """, (group_id, user_id))
-            group_link_info = cursor.fetchone()
-            conn.close()
-
             group_link_code = group_link_info[0] if group_link_info else None
 
-
             if files:
                 for serial_number, file_name, file_size, file_id in files:
                     text += f"\n- #{serial_number:03d} {file_name} ({format_size(file_size)})"
@@ -2517,7 +6631,7 @@ Files in this group (first 10):"""
 
             # Add revoke button if a group link exists
             if group_link_code:
-                keyboard.append([InlineKeyboardButton("Revoke Group Link 🚫", callback_data=f"revoke_group_link_{group_link_code}")])
+                keyboard.append([InlineKeyboardButton("Revoke Group Link 🚫", callback_data=self.callback_state.pack(user_id, "revoke_link", {"c": group_link_code}))])
 
             keyboard.append([InlineKeyboardButton("My Groups 📂", callback_data="cmd_groups")])
 
@@ -2533,43 +6647,49 @@ Files in this group (first 10):"""
         user_id = query.from_user.id
 
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
+            def get_group_link() -> Optional[tuple]:
+                conn = get_db_connection()
+                try:
+                    cursor = conn.cursor()
 
-            # Find the group
-            cursor.execute("""
-                SELECT name FROM groups WHERE id = %s AND owner_id = %s
-            """, (group_id, user_id))
-            group_info = cursor.fetchone()
+                    # Find the group
+                    cursor.execute("""
+                        SELECT name FROM groups WHERE id = %s AND owner_id = %s AND deleted_at IS NULL
+                    """, (group_id, user_id))
+                    group_info = cursor.fetchone()
+                    if not group_info:
+                        return None
 
-            if not group_info:
+                    # Check if group link already exists and is active
+                    cursor.execute("""
+                        SELECT link_code FROM file_links
+                        WHERE group_id = %s AND owner_id = %s AND link_type = 'group' AND is_active = 1
+                          AND expires_at IS NULL AND max_clicks IS NULL
+                    """, (group_id, user_id))
+                    link_info = cursor.fetchone()
+
+                    link_code = link_info[0] if link_info else None
+
+                    if not link_code:
+                        # Generate new link if it doesn't exist
+                        link_code = generate_id()
+                        cursor.execute("""
+                            INSERT INTO file_links (link_code, link_type, group_id, owner_id, is_active)
+                            VALUES (%s, 'group', %s, %s, 1)
+                        """, (link_code, group_id, user_id))
+                        self.link_filter.add(link_code)
+                        conn.commit()
+                    return group_info[0], link_code
+                finally:
+                    conn.close()
+
+            group_link = await asyncio.to_thread(get_group_link)
+            if not group_link:
                 await query.edit_message_text("Group not found. 🤷‍♂️",
                                               reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("My Groups 📂", callback_data="cmd_groups")]])
                                              )
-                conn.close()
                 return
-
-            group_name = group_info[0]
-
-            # Check if group link already exists and is active
-            cursor.execute("""
-                SELECT link_code FROM file_links
-                WHERE group_id = %s AND owner_id = %s AND link_type = 'group' AND is_active = 1
-            """, (group_id, user_id))
-            link_info = cursor.fetchone()
-
-            link_code = link_info[0] if link_info else None
-
-            if not link_code:
-                # Generate new link if it doesn't exist
-                link_code = generate_id()
-                cursor.execute("""
-                    INSERT INTO file_links (link_code, link_type, group_id, owner_id, is_active)
-                    VALUES (%s, 'group', %s, %s, 1)
-                """, (link_code, group_id, user_id))
-                conn.commit()
-
-            conn.close()
+            group_name, link_code = group_link
 
             share_link = f"https://t.me/{BOT_USERNAME.replace('@', '')}?start={link_code}"
             keyboard = [
@@ -2593,25 +6713,44 @@ Files in this group (first 10):"""
         """This function is a direct call for generating a group link, similar to _handle_group_link but with a specific callback data."""
         await self._handle_group_link(query, data)
 
-    async def _list_group_files(self, query, data):
-        """List all files in a specified group."""
+    async def _list_group_files(self, query, data, page: int = 0):
+        """List all files in a specified group, one page at a time."""
         group_id = int(data.split("_")[-1])
         user_id = query.from_user.id
 
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM groups WHERE id = %s AND owner_id = %s", (group_id, user_id))
-            group_info = cursor.fetchone()
+            pages = await asyncio.to_thread(self._group_file_pages, group_id, user_id)
 
-            if not group_info:
+            if pages is None:
                 await query.edit_message_text("Group not found or you don't have access. 🚫",
                                               reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("My Groups 📂", callback_data="cmd_groups")]])
                                              )
-                conn.close()
                 return
 
-            group_name = group_info[0]
+            text, keyboard = pages[min(page, len(pages) - 1)]
+            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+        except Exception as e:
+            logger.error(f"Error listing group files: {e}")
+            await query.edit_message_text("Error retrieving group files. 😔")
+
+    def _group_file_pages(self, group_id: int, user_id: int) -> Optional[list]:
+        """Rendered pages of a group's file list, None if the group is not the user's.
+
+        Cached per group until its files change (groups.manifest_version).
+        """
+        conn = get_db_connection(read_only=True, user_id=user_id)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT name, manifest_version FROM groups WHERE id = %s AND owner_id = %s AND deleted_at IS NULL
+            """, (group_id, user_id))
+            group_info = cursor.fetchone()
+            if not group_info:
+                return None
+            pages = self.pages.get(("group_files", group_id), group_info)
+            if pages is not None:
+                return pages
 
             cursor.execute("""
                 SELECT serial_number, file_name, file_size, id
@@ -2619,42 +6758,32 @@ Files in this group (first 10):"""
                 ORDER BY serial_number ASC
             """, (group_id,))
             files = cursor.fetchall()
+        finally:
             conn.close()
 
-            if not files:
-                await query.edit_message_text(f"Group '{group_name}' has no files. 🤷‍♂️",
-                                              reply_markup=InlineKeyboardMarkup([
-                                                  [InlineKeyboardButton("View Group Details ℹ️", callback_data=f"view_group_id_{group_id}")],
-                                                  [InlineKeyboardButton("My Groups 📂", callback_data="cmd_groups")]
-                                              ])
-                                             )
-                return
-
-            text = f"Files in Group: {group_name} 📄\n\n"
-            keyboard = []
-            for serial_number, file_name, file_size, file_id in files:
-                text += f"#{serial_number:03d} {file_name} ({format_size(file_size)})\n"
-                keyboard.append([InlineKeyboardButton(f"#{serial_number:03d} {file_name[:25]}", callback_data=f"view_file_id_{file_id}")])
-
-            keyboard.append([
-                InlineKeyboardButton("View Group Details ℹ️", callback_data=f"view_group_id_{group_id}"),
-                InlineKeyboardButton("My Groups 📂", callback_data="cmd_groups")
-            ])
-
-            # Send message, splitting if too long
-            if len(text) > 4000:
-                chunks = [text[i:i + 4000] for i in range(0, len(text), 4000)]
-                for i, chunk in enumerate(chunks):
-                    if i == 0:
-                        await query.edit_message_text(chunk, reply_markup=InlineKeyboardMarkup(keyboard))
-                    else:
-                        await query.message.reply_text(chunk)
-            else:
-                await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
-
-        except Exception as e:
-            logger.error(f"Error listing group files: {e}")
-            await query.edit_message_text("Error retrieving group files. 😔")
+        group_name = group_info[0]
+        if not files:
+            pages = [(f"Group '{group_name}' has no files. 🤷‍♂️", [
+                [InlineKeyboardButton("View Group Details ℹ️", callback_data=f"view_group_id_{group_id}")],
+                [InlineKeyboardButton("My Groups 📂", callback_data="cmd_groups")]
+            ])]
+        else:
+            records = [
+                (f"#{serial_number:03d} {file_name} ({format_size(file_size)})\n",
+                 [[InlineKeyboardButton(f"#{serial_number:03d} {file_name[:25]}", callback_data=f"view_file_id_{file_id}")]])
+                for serial_number, file_name, file_size, file_id in files
+            ]
+            footer = [
+                [InlineKeyboardButton("Select Files to Delete ☑️", callback_data=f"select_files_group_{group_id}")],
+                [
+                    InlineKeyboardButton("View Group Details ℹ️", callback_data=f"view_group_id_{group_id}"),
+                    InlineKeyboardButton("My Groups 📂", callback_data="cmd_groups")
+                ]
+            ]
+            pages = render_pages(f"Files in Group: {group_name} 📄", records, footer,
+                                 lambda page: f"files_page_{group_id}_{page}")
+        self.pages.put(("group_files", group_id), group_info, pages)
+        return pages
 
     async def _view_file_details(self, query, data):
         """View details of a specific file."""
@@ -2662,55 +6791,57 @@ Files in this group (first 10):"""
         user_id = query.from_user.id
 
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT f.file_name, f.file_type, f.file_size, f.uploaded_at, f.serial_number,
-                       g.name as group_name, f.telegram_file_id, g.id as group_id
-                FROM files f
-                JOIN groups g ON f.group_id = g.id
-                WHERE f.id = %s AND g.owner_id = %s
-            """, (file_id, user_id))
-            file_info = cursor.fetchone()
+            def load_file() -> Optional[tuple]:
+                conn = get_db_connection()
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("""
+                        SELECT f.file_name, f.file_type, f.file_size, f.uploaded_at, f.serial_number,
+                               g.name as group_name, f.telegram_file_id, g.id as group_id
+                        FROM files f
+                        JOIN groups g ON f.group_id = g.id
+                        WHERE f.id = %s AND g.owner_id = %s AND g.deleted_at IS NULL
+                    """, (file_id, user_id))
+                    file_info = cursor.fetchone()
+                    if not file_info:
+                        return None
+
+                    # Get or create file specific link
+                    cursor.execute("""
+                        SELECT link_code FROM file_links WHERE file_id = %s AND link_type = 'file' AND owner_id = %s AND is_active = 1
+                          AND expires_at IS NULL AND max_clicks IS NULL
+                    """, (file_id, user_id))
+                    file_link_row = cursor.fetchone()
+                    if file_link_row:
+                        return file_info, file_link_row[0]
+
+                    # If no link exists, create one
+                    link_code = generate_id()
+                    cursor.execute("""
+                        INSERT INTO file_links (link_code, link_type, file_id, owner_id, is_active)
+                        VALUES (%s, 'file', %s, %s, 1)
+                    """, (link_code, file_id, user_id))
+                    self.link_filter.add(link_code)
+                    conn.commit() # Commit the new link creation
+                    return file_info, link_code
+                finally:
+                    conn.close()
 
-            if not file_info:
+            loaded = await asyncio.to_thread(load_file)
+            if not loaded:
                 await query.edit_message_text("File not found or you don't have access. 🚫",
                                               reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("My Groups 📂", callback_data="cmd_groups")]])
                                              )
-                conn.close()
                 return
 
+            file_info, link_code = loaded
             file_name, file_type, file_size, uploaded_at, serial_number, group_name, telegram_file_id, group_id = file_info
 
             uploaded_at_str = uploaded_at.strftime("%Y-%m-%d %H:%M") if uploaded_at else "N/A"  # Format datetime to string
 
-            # Get or create file specific link
-            cursor.execute("""
-                SELECT link_code FROM file_links WHERE file_id = %s AND link_type = 'file' AND owner_id = %s AND is_active = 1
-            """, (file_id, user_id))
-            file_link_row = cursor.fetchone()
-
-            file_link_text = "N/A"
-            share_button = []
-            revoke_button = []
-            if file_link_row:
-                link_code = file_link_row[0]
-                file_link_text = f"https://t.me/{BOT_USERNAME.replace('@', '')}?start={link_code}"
-                share_button.append(InlineKeyboardButton("Share File Link 🔗", url=file_link_text))
-                revoke_button.append(InlineKeyboardButton("Revoke File Link 🚫", callback_data=f"revoke_file_link_{link_code}"))
-            else:
-                # If no link exists, create one
-                link_code = generate_id()
-                cursor.execute("""
-                    INSERT INTO file_links (link_code, link_type, file_id, owner_id, is_active)
-                    VALUES (%s, 'file', %s, %s, 1)
-                """, (link_code, file_id, user_id))
-                conn.commit() # Commit the new link creation
-                file_link_text = f"https://t.me/{BOT_USERNAME.replace('@', '')}?start={link_code}"
-                share_button.append(InlineKeyboardButton("Share File Link 🔗", url=file_link_text))
-                revoke_button.append(InlineKeyboardButton("Revoke File Link 🚫", callback_data=f"revoke_file_link_{link_code}"))
-
-            conn.close() # Close connection after all DB operations
+            file_link_text = f"https://t.me/{BOT_USERNAME.replace('@', '')}?start={link_code}"
+            share_button = [InlineKeyboardButton("Share File Link 🔗", url=file_link_text)]
+            revoke_button = [InlineKeyboardButton("Revoke File Link 🚫", callback_data=self.callback_state.pack(user_id, "revoke_link", {"c": link_code}))]
 
             text = f"""File Details ℹ️:
 Name: {file_name}
@@ -2743,16 +6874,21 @@ File Link: {file_link_text}"""
         user_id = query.from_user.id
 
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT f.file_name, g.name, g.id
-                FROM files f
-                JOIN groups g ON f.group_id = g.id
-                WHERE f.id = %s AND g.owner_id = %s
-            """, (file_id_to_delete, user_id))
-            file_info = cursor.fetchone()
-            conn.close()
+            def load_file() -> Optional[tuple]:
+                conn = get_db_connection()
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("""
+                        SELECT f.file_name, g.name, g.id
+                        FROM files f
+                        JOIN groups g ON f.group_id = g.id
+                        WHERE f.id = %s AND g.owner_id = %s AND g.deleted_at IS NULL
+                    """, (file_id_to_delete, user_id))
+                    return cursor.fetchone()
+                finally:
+                    conn.close()
+
+            file_info = await asyncio.to_thread(load_file)
 
             if file_info:
                 file_name, group_name, group_id = file_info
@@ -2776,51 +6912,39 @@ File Link: {file_link_text}"""
         user_id = query.from_user.id
 
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-
-            # Get file info before deleting to update group stats
-            cursor.execute("""
-                SELECT f.file_name, f.file_size, f.group_id
-                FROM files f
-                JOIN groups g ON f.group_id = g.id
-                WHERE f.id = %s AND g.owner_id = %s
-            """, (file_id_to_delete, user_id))
-            file_info = cursor.fetchone()
+            def load_file() -> Optional[tuple]:
+                conn = get_db_connection()
+                try:
+                    cursor = conn.cursor()
+                    # Get file info before deleting to update group stats
+                    cursor.execute("""
+                        SELECT f.file_name, f.file_size, f.group_id
+                        FROM files f
+                        JOIN groups g ON f.group_id = g.id
+                        WHERE f.id = %s AND g.owner_id = %s AND g.deleted_at IS NULL
+                    """, (file_id_to_delete, user_id))
+                    return cursor.fetchone()
+                finally:
+                    conn.close()
 
+            file_info = await asyncio.to_thread(load_file)
             if not file_info:
                 await query.edit_message_text("File not found or you don't have permission to delete it. 🚫",
                                               reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("My Groups 📂", callback_data="cmd_groups")]])
                                              )
-                conn.close()
                 return
 
             file_name, file_size, group_id = file_info
 
-            # Delete file record
-            cursor.execute("DELETE FROM files WHERE id = %s", (file_id_to_delete,))
-            rowcount = cursor.rowcount
-
-            if rowcount > 0:
-                # Update group statistics
-                cursor.execute("""
-                    UPDATE groups SET total_files = total_files - 1, total_size = total_size - %s
-                    WHERE id = %s
-                """, (file_size, group_id))
-
-                # Due to ON DELETE CASCADE on file_links, associated file links should be automatically deleted.
-                # However, for explicit control or if cascade fails, you could set is_active = 0:
-                # cursor.execute("UPDATE file_links SET is_active = 0 WHERE file_id = %s", (file_id_to_delete,))
-
-                conn.commit()
-                conn.close()
+            # Due to ON DELETE CASCADE on file_links, associated file links are deleted with the file
+            deleted_count, _ = await asyncio.to_thread(self._delete_group_files, user_id, group_id, [file_id_to_delete])
 
+            if deleted_count > 0:
                 await query.edit_message_text(
                     f"File '{file_name}' deleted successfully! ✅",
                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Back to Group Files 📜", callback_data=f"list_files_group_{group_id}")]])
                 )
             else:
-                conn.close()
                 await query.edit_message_text(
                     f"File '{file_name}' not found or could not be deleted. 🤷‍♂️",
                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("My Groups 📂", callback_data="cmd_groups")]])
@@ -2829,17 +6953,198 @@ File Link: {file_link_text}"""
             logger.error(f"Error executing file deletion: {e}")
             await query.edit_message_text("An error occurred while deleting the file. 😔")
 
+    def _delete_group_files(self, owner_id: int, group_id: int, file_ids: list) -> Tuple[int, int]:
+        """Delete files of one group in a single statement, return (files deleted, bytes freed).
+
+        The files triggers adjust the group counters and the storage posts are queued for
+        the storage GC (which keeps posts another file still uses). Posts of
+        imported files live in their source channel and are never deleted.
+        """
+        conn = get_db_connection(user_id=owner_id)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                WITH deleted AS (
+                    DELETE FROM files f USING groups g
+                    WHERE f.group_id = g.id AND g.id = %s AND g.owner_id = %s AND f.id = ANY(%s)
+                    RETURNING f.file_size, f.storage_channel_id, f.storage_message_id
+                ), queued AS (
+                    INSERT INTO storage_gc_queue (channel_id, message_id)
+                    SELECT DISTINCT storage_channel_id, storage_message_id FROM deleted
+                    WHERE storage_channel_id = ANY(%s) AND storage_message_id IS NOT NULL
+                )
+                SELECT COUNT(*), COALESCE(SUM(file_size), 0) FROM deleted
+            """, (group_id, owner_id, list(file_ids), STORAGE_CHANNEL_IDS))
+            files, size = cursor.fetchone()
+            conn.commit()
+        finally:
+            conn.close()
+        return files, int(size)
+
+    async def _show_file_selection(self, query, user_id: int, page: int):
+        """Show one page of the group's files with checkboxes for multi-select deletion"""
+        per_page = FILE_SELECT_PAGE_SIZE
+        selection = await self.sessions.get('file_select', user_id)
+        if not selection:
+            await query.edit_message_text(
+                "Selection expired. Open the group's files again. ☑️",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("My Groups 📂", callback_data="cmd_groups")]])
+            )
+            return
+
+        group_id = selection['group_id']
+        selected = set(selection['selected'])
+        try:
+            def load_page() -> Optional[tuple]:
+                conn = get_db_connection()
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT name, total_files FROM groups WHERE id = %s AND owner_id = %s AND deleted_at IS NULL", (group_id, user_id))
+                    group_info = cursor.fetchone()
+                    if not group_info:
+                        return None
+                    group_name, total_files = group_info
+
+                    pages = max(1, (total_files + per_page - 1) // per_page)
+                    shown = min(max(page, 0), pages - 1)
+                    cursor.execute("""
+                        SELECT id, serial_number, file_name FROM files WHERE group_id = %s
+                        ORDER BY serial_number ASC LIMIT %s OFFSET %s
+                    """, (group_id, per_page, shown * per_page))
+                    return group_name, pages, shown, cursor.fetchall()
+                finally:
+                    conn.close()
+
+            loaded = await asyncio.to_thread(load_page)
+            if not loaded:
+                await query.edit_message_text("Group not found or you don't have access. 🚫",
+                                              reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("My Groups 📂", callback_data="cmd_groups")]]))
+                return
+            group_name, pages, page, files = loaded
+
+            text = (f"Select Files to Delete ☑️\n\nGroup: {group_name} 📁\n"
+                    f"Selected: {len(selected)} | Page {page + 1}/{pages}")
+            keyboard = []
+            for file_id, serial_number, file_name in files:
+                mark = "✅" if file_id in selected else "⬜"
+                keyboard.append([InlineKeyboardButton(f"{mark} #{serial_number:03d} {file_name[:25]}",
+                                                      callback_data=f"sel_toggle_{file_id}_{page}")])
+
+            navigation = []
+            if page > 0:
+                navigation.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"sel_page_{page - 1}"))
+            navigation.append(InlineKeyboardButton("Toggle Page ☑️", callback_data=f"sel_all_{page}"))
+            if page < pages - 1:
+                navigation.append(InlineKeyboardButton("Next ➡️", callback_data=f"sel_page_{page + 1}"))
+            keyboard.append(navigation)
+            if selected:
+                keyboard.append([InlineKeyboardButton(f"Delete Selected ({len(selected)}) 🗑️", callback_data="sel_delete")])
+            keyboard.append([InlineKeyboardButton("Cancel ❌", callback_data=f"list_files_group_{group_id}")])
+
+            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+        except Exception as e:
+            logger.error(f"Error showing file selection: {e}")
+            await query.edit_message_text("Error retrieving group files. 😔")
+
+    async def _toggle_file_selection(self, query, user_id: int, file_ids: Optional[list], page: int):
+        """Toggle files in the selection; file_ids=None toggles the whole page"""
+        selection = await self.sessions.get('file_select', user_id)
+        if selection and file_ids is None:
+            def load_page_ids() -> list:
+                conn = get_db_connection()
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("""
+                        SELECT id FROM files WHERE group_id = %s ORDER BY serial_number ASC LIMIT %s OFFSET %s
+                    """, (selection['group_id'], FILE_SELECT_PAGE_SIZE, page * FILE_SELECT_PAGE_SIZE))
+                    return [row[0] for row in cursor.fetchall()]
+                finally:
+                    conn.close()
+
+            file_ids = await asyncio.to_thread(load_page_ids)
+            # Select the whole page unless all of it is already selected
+            if set(file_ids) <= set(selection['selected']):
+                selection['selected'] = [f for f in selection['selected'] if f not in file_ids]
+            else:
+                selection['selected'] = list(dict.fromkeys(selection['selected'] + file_ids))
+            await self.sessions.set('file_select', user_id, selection)
+        elif selection:
+            selected = set(selection['selected'])
+            selected ^= set(file_ids)
+            selection['selected'] = sorted(selected)
+            await self.sessions.set('file_select', user_id, selection)
+        await self._show_file_selection(query, user_id, page)
+
+    def _delete_selection_prompt(self, user_id: int, selection: Optional[dict]) -> Tuple[str, list]:
+        """Confirmation text and buttons for deleting the selected files (the user's file_select session)"""
+        rows = []
+        if selection and selection['selected']:
+            conn = get_db_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT g.name, f.serial_number, f.file_size
+                    FROM files f JOIN groups g ON f.group_id = g.id
+                    WHERE f.id = ANY(%s) AND g.id = %s AND g.owner_id = %s
+                """, (selection['selected'], selection['group_id'], user_id))
+                rows = cursor.fetchall()
+            finally:
+                conn.close()
+
+        if not rows:
+            return ("No files selected. ☑️",
+                    [[InlineKeyboardButton("My Groups 📂", callback_data="cmd_groups")]])
+
+        group_name = rows[0][0]
+        text = (f"Are you sure you want to delete {len(rows)} file(s) from group '{group_name}'? 🗑️\n\n"
+                f"Files: {format_serial_ranges(row[1] for row in rows)}\n"
+                f"Size: {format_size(sum(row[2] or 0 for row in rows))}\n\n"
+                "This action cannot be undone. All associated links will also be removed. ⚠️")
+        keyboard = [
+            [InlineKeyboardButton(f"Yes, Delete {len(rows)} File(s) ✅", callback_data="sel_confirm_delete")],
+            [InlineKeyboardButton("No, Cancel ❌", callback_data=f"list_files_group_{selection['group_id']}")]
+        ]
+        return text, keyboard
+
+    async def _execute_delete_selection(self, query, user_id: int):
+        """Delete every selected file in one statement"""
+        selection = await self.sessions.delete('file_select', user_id)
+        if not selection or not selection['selected']:
+            await query.edit_message_text(
+                "Selection expired. Open the group's files again. ☑️",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("My Groups 📂", callback_data="cmd_groups")]])
+            )
+            return
+
+        group_id = selection['group_id']
+        try:
+            deleted_count, freed = await asyncio.to_thread(self._delete_group_files, user_id, group_id, selection['selected'])
+            logger.info(f"User {user_id} deleted {deleted_count} file(s) from group {group_id}")
+            await query.edit_message_text(
+                f"{deleted_count} file(s) deleted successfully! ✅\nFreed: {format_size(freed)}",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Back to Group Files 📜", callback_data=f"list_files_group_{group_id}")]])
+            )
+        except Exception as e:
+            logger.error(f"Error deleting selected files: {e}")
+            await query.edit_message_text("An error occurred while deleting the files. 😔")
+
     async def _confirm_delete_group(self, query, data):
         """Confirm group deletion before execution."""
         group_id_to_delete = int(data.split("_")[-1])
         user_id = query.from_user.id
 
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM groups WHERE id = %s AND owner_id = %s", (group_id_to_delete, user_id))
-            group_name_row = cursor.fetchone()
-            conn.close()
+            def load_name() -> Optional[tuple]:
+                conn = get_db_connection()
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT name FROM groups WHERE id = %s AND owner_id = %s AND deleted_at IS NULL", (group_id_to_delete, user_id))
+                    return cursor.fetchone()
+                finally:
+                    conn.close()
+
+            group_name_row = await asyncio.to_thread(load_name)
 
             if group_name_row:
                 group_name = group_name_row[0]
@@ -2864,36 +7169,48 @@ File Link: {file_link_text}"""
         user_id = query.from_user.id
 
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
+            def hide_group() -> Optional[tuple]:
+                conn = get_db_connection(user_id=user_id)
+                try:
+                    cursor = conn.cursor()
 
-            # Verify ownership before deleting
-            cursor.execute("SELECT name FROM groups WHERE id = %s AND owner_id = %s", (group_id_to_delete, user_id))
-            group_name_row = cursor.fetchone()
+                    # Verify ownership before deleting
+                    cursor.execute("SELECT name FROM groups WHERE id = %s AND owner_id = %s AND deleted_at IS NULL", (group_id_to_delete, user_id))
+                    group_name_row = cursor.fetchone()
+                    if not group_name_row:
+                        return None
+
+                    # Hide the group at once (renamed so the name can be reused) and stop its group links;
+                    # the files, their links and storage posts are removed in the background
+                    cursor.execute("""
+                        UPDATE groups SET deleted_at = NOW(), name = name || ' [deleted #' || id || ']'
+                        WHERE id = %s AND deleted_at IS NULL
+                        RETURNING total_files
+                    """, (group_id_to_delete,))
+                    hidden = cursor.fetchone()
+                    if hidden:
+                        cursor.execute("UPDATE file_links SET is_active = 0 WHERE group_id = %s AND is_active = 1", (group_id_to_delete,))
+                        conn.commit()
+                    return group_name_row[0], hidden
+                finally:
+                    conn.close()
 
-            if not group_name_row:
+            outcome = await asyncio.to_thread(hide_group)
+            if not outcome:
                 await query.edit_message_text("Group not found or you don't have permission to delete it. 🚫",
                                               reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("My Groups 📂", callback_data="cmd_groups")]])
                                              )
-                conn.close()
                 return
 
-            group_name = group_name_row[0]
-
-            # Delete group record. ON DELETE CASCADE will handle files and links.
-            cursor.execute("DELETE FROM groups WHERE id = %s", (group_id_to_delete,))
-            rowcount = cursor.rowcount
-
-            if rowcount > 0:
-                conn.commit()
-                conn.close()
-
+            group_name, hidden = outcome
+            if hidden:
                 await query.edit_message_text(
-                    f"Group '{group_name}' and all its contents deleted successfully! ✅",
+                    f"Group '{group_name}' deleted successfully! ✅\n\n"
+                    f"Removing its {hidden[0]} file(s) in the background... ⏳",
                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("My Groups 📂", callback_data="cmd_groups")]])
                 )
+                self.app.create_task(self._run_group_deletion(group_id_to_delete, group_name, query.message))
             else:
-                conn.close()
                 await query.edit_message_text(
                     f"Group '{group_name}' not found or could not be deleted. 🤷‍♂️",
                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("My Groups 📂", callback_data="cmd_groups")]])
@@ -2902,17 +7219,82 @@ File Link: {file_link_text}"""
             logger.error(f"Error executing group deletion: {e}")
             await query.edit_message_text("An error occurred while deleting the group. 😔")
 
+    async def _run_group_deletion(self, group_id: int, group_name: str = None, progress_msg: Optional[Message] = None):
+        """Remove a hidden group's files in bounded chunks, then the group itself"""
+        if group_id in self.deleting_groups:
+            return
+        self.deleting_groups.add(group_id)
+        deleted = 0
+        last_report = time.monotonic()
+        try:
+            while True:
+                count = await asyncio.to_thread(delete_group_files_chunk, group_id)
+                deleted += count
+                if not count:
+                    break
+                if progress_msg and time.monotonic() - last_report >= 3:
+                    last_report = time.monotonic()
+                    try:
+                        await progress_msg.edit_text(
+                            f"Deleting group '{group_name}'... ⏳\n\nFiles removed so far: {deleted} 🗑️"
+                        )
+                    except Exception as e:
+                        logger.error(f"Error reporting group deletion progress: {e}")
+                await asyncio.sleep(GROUP_DELETE_CHUNK_DELAY)
+
+            await asyncio.to_thread(finish_group_deletion, group_id)
+            logger.info(f"Group {group_id} deleted in the background ({deleted} files)")
+            text = f"Group '{group_name}' and all its contents deleted successfully! ✅\n\nFiles removed: {deleted} 🗑️"
+        except Exception as e:
+            logger.error(f"Background deletion of group {group_id} error: {e}")
+            text = f"Deleting group '{group_name}' was interrupted after {deleted} file(s) 😔\nIt will be resumed automatically."
+        finally:
+            self.deleting_groups.discard(group_id)
+
+        if progress_msg and deleted >= GROUP_DELETE_CHUNK_SIZE:
+            try:
+                await progress_msg.edit_text(
+                    text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("My Groups 📂", callback_data="cmd_groups")]])
+                )
+            except Exception as e:
+                logger.error(f"Error reporting group deletion result: {e}")
+
+    async def _resume_group_deletions(self, context):
+        """Finish group deletions interrupted by a restart (and retry failed ones)"""
+        def pending_groups() -> list:
+            conn = get_db_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT id FROM groups WHERE deleted_at IS NOT NULL ORDER BY deleted_at")
+                return [row[0] for row in cursor.fetchall()]
+            finally:
+                conn.close()
+
+        try:
+            group_ids = await asyncio.to_thread(pending_groups)
+        except Exception as e:
+            logger.error(f"Error looking up pending group deletions: {e}")
+            return
+        for group_id in group_ids:
+            logger.info(f"Resuming background deletion of group {group_id}")
+            await self._run_group_deletion(group_id)
+
     async def _prepare_add_files_to_group(self, query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, data: str):
         """Prepares the bot for adding multiple files to an existing group via a bulk session."""
         group_id = int(data.split("_")[-1])
         user_id = query.from_user.id
 
         try:
-            conn = psycopg2.connect(SUPABASE_URL)
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM groups WHERE id = %s AND owner_id = %s", (group_id, user_id))
-            group_info = cursor.fetchone()
-            conn.close()
+            def load_name() -> Optional[tuple]:
+                conn = get_db_connection()
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT name FROM groups WHERE id = %s AND owner_id = %s AND deleted_at IS NULL", (group_id, user_id))
+                    return cursor.fetchone()
+                finally:
+                    conn.close()
+
+            group_info = await asyncio.to_thread(load_name)
 
             if not group_info:
                 await query.edit_message_text("Group not found or you don't have access. 🚫",
@@ -2924,12 +7306,12 @@ File Link: {file_link_text}"""
             session_id = generate_id() # Generate a session ID for the bulk upload
 
             # Start a new bulk session for adding files to this existing group
-            self.bulk_sessions[user_id] = {
+            await self.sessions.set('bulk', user_id, {
                 'session_id': session_id,
                 'group_name': group_name,
                 'files': [],
-                'started_at': datetime.now()
-            }
+                'started_at': datetime.now().isoformat()
+            })
 
             keyboard = [
                 [
@@ -2957,12 +7339,17 @@ File Link: {file_link_text}"""
 # === Health Check Server Implementation ===
 class HealthCheckHandler(http.server.SimpleHTTPRequestHandler):
     def do_GET(self):
-        # A simple GET request handler for health checks
-        if self.path == '/healthz': # Define a specific path for the health check
+        # /healthz: the process is up. /readyz: startup warm-up has finished (503 with progress until then)
+        if self.path == '/healthz':
             self.send_response(200)
             self.send_header('Content-type', 'text/plain')
             self.end_headers()
             self.wfile.write(b"OK")
+        elif self.path == '/readyz':
+            self.send_response(200 if startup.ready else 503)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(startup.report()).encode())
         else:
             # For any other path, return a 404
             self.send_response(404)
@@ -2973,13 +7360,73 @@ def start_health_check_server():
     """Starts a simple HTTP server for health checks."""
     # Binding to 0.0.0.0 makes it accessible from outside the container
     # Use HEALTH_CHECK_PORT from config, which will get Render's $PORT env var
-    with socketserver.TCPServer(("", HEALTH_CHECK_PORT), HealthCheckHandler) as httpd:
+    with socketserver.ThreadingTCPServer(("", HEALTH_CHECK_PORT), HealthCheckHandler) as httpd:
         logger.info(f"Health check server serving on port {HEALTH_CHECK_PORT}")
         httpd.serve_forever()
 
 ###############################################################################
 # 6 — MAIN APPLICATION RUNNER
 ###############################################################################
+def build_application(token: str, base_url: Optional[str] = None) -> Application:
+    """Build the PTB application (base_url lets tools point it at a local Bot API stand-in)"""
+    # Manually create JobQueue instance
+    job_queue = JobQueue()
+
+    # Create application and pass the job_queue instance directly.
+    # Updates run concurrently, but each user's/chat's updates stay in order.
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .job_queue(job_queue)
+        .concurrent_updates(OrderedUpdateProcessor(CONCURRENT_UPDATES))
+    )
+    if base_url:
+        builder = builder.base_url(base_url).base_file_url(base_url.replace("/bot", "/file/bot"))
+    return builder.build()
+
+def register_handlers(application: Application, bot: FileStoreBot):
+    """Register every command, message, callback and inline handler"""
+    # Group -1 runs first: updates wait there until the schema check is done
+    application.add_handler(TypeHandler(Update, bot.wait_for_schema), group=-1)
+    application.add_handler(CommandHandler("start", bot.start_handler))
+    application.add_handler(CommandHandler("help", bot.help_handler))
+    application.add_handler(CommandHandler("clear", bot.clear_handler))
+    application.add_handler(CommandHandler("upload", bot.upload_handler))
+    application.add_handler(CommandHandler("bulkupload", bot.bulkupload_handler))
+    application.add_handler(CommandHandler("groups", bot.groups_handler))
+    application.add_handler(CommandHandler("search", bot.search_handler))
+    application.add_handler(CommandHandler("getlink", bot.getlink_handler))
+    
+    # === REGISTERING NEWLY IMPLEMENTED COMMANDS ===
+    application.add_handler(CommandHandler("deletefile", bot.deletefile_handler))
+    application.add_handler(CommandHandler("deletegroup", bot.deletegroup_handler))
+    application.add_handler(CommandHandler("getgrouplink", bot.getgrouplink_handler))
+    application.add_handler(CommandHandler("revokelink", bot.revoke_link_handler)) # NEW COMMAND
+    # ===============================================
+
+    # Admin commands
+    application.add_handler(CommandHandler("admin", bot.admin_panel_handler))
+    application.add_handler(CommandHandler("adduser", bot.add_user_handler))
+    application.add_handler(CommandHandler("removeuser", bot.remove_user_handler))
+    application.add_handler(CommandHandler("listusers", bot.list_users_handler))
+    application.add_handler(CommandHandler("botstats", bot.bot_stats_handler))
+    application.add_handler(CommandHandler("reconcile", bot.reconcile_handler))
+    application.add_handler(CommandHandler("importchannel", bot.importchannel_handler))
+    application.add_handler(CommandHandler("broadcast", bot.broadcast_handler))
+
+    # Message handler for files and for new caption text input
+    application.add_handler(MessageHandler(
+        filters.Document.ALL | filters.PHOTO | filters.VIDEO |
+        filters.AUDIO | filters.VOICE | filters.VIDEO_NOTE | (filters.TEXT & (~filters.COMMAND)),
+        bot.file_handler # This handler now also processes text for caption updates
+    ))
+
+    # Callback handler
+    application.add_handler(CallbackQueryHandler(bot.callback_handler))
+
+    # Inline mode (@bot <text>)
+    application.add_handler(InlineQueryHandler(bot.inline_query_handler))
+
 def main():
     """Run the bot with all fixes and complete functionality"""
     print("Starting Complete Enhanced FileStore Bot...")
@@ -2993,8 +7440,16 @@ def main():
         return
 
     # Corrected validation for STORAGE_CHANNEL_ID: it must be negative
-    if STORAGE_CHANNEL_ID >= 0:
-        logger.error("Invalid STORAGE_CHANNEL_ID! Must be negative (e.g., -100xxxxxxxxxx).")
+    if any(channel_id >= 0 for channel_id in STORAGE_CHANNEL_IDS):
+        logger.error("Invalid STORAGE_CHANNEL_ID(S)! Must be negative (e.g., -100xxxxxxxxxx).")
+        return
+
+    if DB_POOL_MODE not in ("direct", "transaction"):
+        logger.error("Invalid DB_POOL_MODE! Use direct or transaction.")
+        return
+
+    if STORAGE_PLACEMENT not in ("round_robin", "least_load"):
+        logger.error("Invalid STORAGE_PLACEMENT! Use round_robin or least_load.")
         return
 
     if not BOT_USERNAME:
@@ -3014,65 +7469,44 @@ def main():
     logger.info("Configuration validated successfully!")
 
     try:
-        # Manually create JobQueue instance
-        job_queue = JobQueue()
-
-        # Create application and pass the job_queue instance directly
-        application = ApplicationBuilder().token(BOT_TOKEN).job_queue(job_queue).build()
-
-        # Initialize bot
-        bot = FileStoreBot(application)
-
-        # Start health check server in a separate thread
-        # This allows the bot to run_polling in the main thread while the HTTP server listens
+        # Health check server first, in a separate thread, so the platform sees the process
+        # alive while the database is still being reached; /readyz reports the warm-up
         health_thread = threading.Thread(target=start_health_check_server, daemon=True)
         health_thread.start()
         logger.info(f"Health check server thread started on port {HEALTH_CHECK_PORT}.")
 
+        application = build_application(BOT_TOKEN)
+
+        # Initialize bot; the database is warmed up in the background once the application runs
+        bot = FileStoreBot(application)
+        application.post_init = bot.post_init
+
         # Add all handlers
-        application.add_handler(CommandHandler("start", bot.start_handler))
-        application.add_handler(CommandHandler("help", bot.help_handler))
-        application.add_handler(CommandHandler("clear", bot.clear_handler))
-        application.add_handler(CommandHandler("upload", bot.upload_handler))
-        application.add_handler(CommandHandler("bulkupload", bot.bulkupload_handler))
-        application.add_handler(CommandHandler("groups", bot.groups_handler))
-        application.add_handler(CommandHandler("getlink", bot.getlink_handler))
-        
-        # === REGISTERING NEWLY IMPLEMENTED COMMANDS ===
-        application.add_handler(CommandHandler("deletefile", bot.deletefile_handler))
-        application.add_handler(CommandHandler("deletegroup", bot.deletegroup_handler))
-        application.add_handler(CommandHandler("getgrouplink", bot.getgrouplink_handler))
-        application.add_handler(CommandHandler("revokelink", bot.revoke_link_handler)) # NEW COMMAND
-        # ===============================================
-
-        # Admin commands
-        application.add_handler(CommandHandler("admin", bot.admin_panel_handler))
-        application.add_handler(CommandHandler("adduser", bot.add_user_handler))
-        application.add_handler(CommandHandler("removeuser", bot.remove_user_handler))
-        application.add_handler(CommandHandler("listusers", bot.list_users_handler))
-        application.add_handler(CommandHandler("botstats", bot.bot_stats_handler))
-
-        # Message handler for files and for new caption text input
-        application.add_handler(MessageHandler(
-            filters.Document.ALL | filters.PHOTO | filters.VIDEO |
-            filters.AUDIO | filters.VOICE | filters.VIDEO_NOTE | (filters.TEXT & (~filters.COMMAND)),
-            bot.file_handler # This handler now also processes text for caption updates
-        ))
-
-        # Callback handler
-        application.add_handler(CallbackQueryHandler(bot.callback_handler))
+        register_handlers(application, bot)
 
         logger.info("Complete Enhanced FileStore Bot started successfully!")
         logger.info(f"Bot Username: {BOT_USERNAME}")
-        logger.info(f"Storage Channel: {STORAGE_CHANNEL_ID}")
+        logger.info(f"Storage Channels: {', '.join(map(str, STORAGE_CHANNEL_IDS))} ({STORAGE_PLACEMENT})")
         logger.info(f"Admin IDs: {', '.join(map(str, ADMIN_IDS))}")
         logger.info(f"Admin Contact: {ADMIN_CONTACT}")
         logger.info(f"File Size Limit: {format_size(MAX_FILE_SIZE)}")
+        logger.info(f"Concurrent Updates: {CONCURRENT_UPDATES}")
 
         print("Bot is running with complete functionality! Press Ctrl+C to stop.")
 
-        # Run bot
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        # Run bot. Webhook mode lets several replicas share the update stream.
+        if WEBHOOK_URL:
+            logger.info(f"Starting webhook on port {WEBHOOK_PORT} for {WEBHOOK_URL}")
+            application.run_webhook(
+                listen="0.0.0.0",
+                port=WEBHOOK_PORT,
+                url_path="webhook",
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/webhook",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES
+            )
+        else:
+            application.run_polling(allowed_updates=Update.ALL_TYPES)
 
     except Exception as e:
         logger.error(f"Bot startup error: {e}")
@@ -0,0 +1,245 @@
+# test_pooler.py - The bot's data layer directly and behind a transaction pooler
+"""
+Runs the bot's database paths (schema setup, link resolution and click
+counting, sessions, uploads and deletes, counter reconciliation) from several
+threads in both DB_POOL_MODEs:
+
+  direct       against the database itself; hot statements are PREPAREd and
+               must be reused
+  transaction  through tools/fake_pooler.py, a local stand-in for PgBouncer /
+               Supavisor in transaction mode
+
+As a control, direct mode through the pooler must fail: PREPAREd statements do
+not follow the client from one transaction to the next there. If the control
+passes, the stand-in is not rotating server connections and the
+transaction-mode result proves nothing.
+
+The tests write and delete rows of their own owner id; they are skipped when
+TEST_DATABASE_URL (or BENCH_DATABASE_URL) is not set or not reachable. Never
+point them at production:
+    TEST_DATABASE_URL=postgresql://postgres@localhost/filestore_bench python -m pytest tests/test_pooler.py
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+import psycopg2.extensions  # noqa: E402
+
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL") or os.environ.get("BENCH_DATABASE_URL")
+if not TEST_DATABASE_URL:
+    pytest.skip("TEST_DATABASE_URL not set", allow_module_level=True)
+try:
+    psycopg2.connect(TEST_DATABASE_URL, connect_timeout=5).close()
+except psycopg2.OperationalError as e:
+    pytest.skip(f"Postgres not reachable: {e}", allow_module_level=True)
+
+os.environ["SUPABASE_URL"] = TEST_DATABASE_URL
+os.environ.setdefault("BOT_TOKEN", "123456:POOLERTEST")
+os.environ.setdefault("STORAGE_CHANNEL_ID", "-1000000000001")
+os.environ.setdefault("BOT_USERNAME", "pooler_test_bot")
+os.environ.setdefault("ADMIN_IDS", "1,2")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "tools"))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import filecloudsupabaseX as filestore  # noqa: E402
+from fake_pooler import FakePooler  # noqa: E402
+
+filestore.logger.setLevel(logging.WARNING)
+
+TEST_OWNER_ID = 990_045
+THREADS = 8
+ITERATIONS = 10
+
+
+# ---------------- fixtures ----------------
+
+@pytest.fixture(scope="module")
+def pooler():
+    """The pooler stand-in on a background event loop, yields its connection string"""
+    params = psycopg2.extensions.parse_dsn(TEST_DATABASE_URL)
+    pooler = FakePooler(params.get("host", "localhost"), int(params.get("port", 5432)), pool_size=3)
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(pooler.start("127.0.0.1", 0))
+        started.set()
+        loop.run_forever()
+
+    thread = threading.Thread(target=run, name="fake-pooler", daemon=True)
+    thread.start()
+    assert started.wait(10), "pooler stand-in did not start"
+    port = pooler._server.sockets[0].getsockname()[1]
+    pooler.url = f"postgresql://{params.get('user', 'postgres')}@127.0.0.1:{port}/{params['dbname']}"
+    yield pooler
+
+    asyncio.run_coroutine_threadsafe(pooler.stop(), loop).result(10)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(10)
+
+
+@pytest.fixture
+def use_mode():
+    """Point the bot module at a database and pooling mode; restores direct mode afterwards"""
+    def switch(mode: str, url: str):
+        filestore.DB_POOL_MODE = mode
+        filestore.SUPABASE_URL = url
+        filestore.SUPABASE_DIRECT_URL = TEST_DATABASE_URL
+        filestore.db_router.primary_dsn = url
+        for pool in filestore._db_pools.values():
+            while pool.idle:
+                pool.idle.pop().close()
+        filestore._db_pools.clear()
+
+    yield switch
+    switch("direct", TEST_DATABASE_URL)
+    conn = psycopg2.connect(TEST_DATABASE_URL)
+    conn.cursor().execute("DELETE FROM groups WHERE owner_id = %s", (TEST_OWNER_ID,))  # A failed run's rows
+    conn.commit()
+    conn.close()
+
+
+# ---------------- helpers ----------------
+
+class Listener:
+    """SessionStore only needs subscribe/on_reconnect from the notification listener"""
+
+    def subscribe(self, channel, callback):
+        pass
+
+    def on_reconnect(self, callback):
+        pass
+
+
+def exercise(threads: int = THREADS, iterations: int = ITERATIONS):
+    """Run the data-layer paths concurrently; raises on the first error"""
+    filestore.init_database()
+    conn = filestore.get_db_connection()
+    conn.cursor().execute("DELETE FROM groups WHERE owner_id = %s", (TEST_OWNER_ID,))  # Leftovers of a failed run
+    conn.commit()
+    conn.close()
+    bot = filestore.FileStoreBot.__new__(filestore.FileStoreBot)
+
+    async def get_chat(user_id):
+        return SimpleNamespace(username="poolertest")
+    bot.app = SimpleNamespace(bot=SimpleNamespace(get_chat=get_chat))
+    sessions = filestore.SessionStore(filestore.SUPABASE_URL, Listener())
+    group_name = f"pooler-test-{filestore.generate_id()[:8]}"
+
+    def worker(index: int) -> int:
+        user_id = TEST_OWNER_ID + index
+        loop = asyncio.new_event_loop()
+        try:
+            file_id, serial, _ = loop.run_until_complete(bot._save_file_to_db(
+                TEST_OWNER_ID, group_name, SimpleNamespace(file_id=f"pooler_test_{index}"),
+                "document", f"test_{index}.bin", 1024))
+        finally:
+            loop.close()
+        link_code = filestore.generate_id()
+        conn = filestore.get_db_connection(user_id=TEST_OWNER_ID)
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO file_links (link_code, link_type, file_id, owner_id) VALUES (%s, 'file', %s, %s)
+        """, (link_code, file_id, TEST_OWNER_ID))
+        conn.commit()
+        conn.close()
+
+        for i in range(iterations):
+            row = bot._fetch_link(link_code, read_only=True, user_id=user_id)
+            assert row and row[0] == "file", f"link {link_code} not resolved"
+            conn = filestore.get_db_connection()
+            cursor = conn.cursor()
+            filestore.execute_prepared(cursor, "count_link_click", """
+                UPDATE file_links
+                SET clicks = clicks + 1,
+                    is_active = CASE WHEN clicks + 1 >= max_clicks THEN 0 ELSE is_active END
+                WHERE link_code = %s AND is_active = 1 AND (max_clicks IS NULL OR clicks < max_clicks)
+            """, (link_code,))
+            assert cursor.rowcount == 1, "click not counted"
+            conn.commit()
+            conn.close()
+
+            asyncio.run(sessions.set("pooler_test", user_id, {"i": i}))
+            sessions.clear_cache()
+            assert asyncio.run(sessions.get("pooler_test", user_id)) == {"i": i}, "session lost"
+        asyncio.run(sessions.delete("pooler_test", user_id))
+        return serial
+
+    with ThreadPoolExecutor(threads) as executor:
+        serials = sorted(executor.map(worker, range(threads)))
+    assert serials == list(range(1, threads + 1)), f"serial numbers {serials}"
+
+    conn = filestore.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT g.id, g.total_files, SUM(fl.clicks) FROM groups g
+        JOIN files f ON f.group_id = g.id JOIN file_links fl ON fl.file_id = f.id
+        WHERE g.name = %s AND g.owner_id = %s GROUP BY g.id
+    """, (group_name, TEST_OWNER_ID))
+    group_id, total_files, clicks = cursor.fetchone()
+    conn.close()
+    assert total_files == threads, f"total_files {total_files}"
+    assert clicks == threads * iterations, f"clicks {clicks}"
+
+    checked, repaired = filestore.reconcile_group_counters()
+    assert repaired == 0, f"{repaired} group counter(s) drifted"
+    assert filestore.delete_group_files_chunk(group_id, threads) == threads
+    conn = filestore.get_db_connection()
+    conn.cursor().execute("DELETE FROM groups WHERE id = %s", (group_id,))
+    conn.commit()
+    conn.close()
+
+
+def prepared_statements() -> set:
+    """Statements PREPAREd on the pooled connections to the primary"""
+    names = set()
+    for conn in filestore.db_pool(filestore.SUPABASE_URL).idle:
+        names.update(conn.prepared)
+    return names
+
+
+# ---------------- tests ----------------
+
+def test_execute_prepared_keeps_escaped_percent(use_mode):
+    use_mode("direct", TEST_DATABASE_URL)
+    conn = filestore.get_db_connection()
+    try:
+        cursor = conn.cursor()
+        for _ in range(2):  # PREPARE, then EXECUTE the prepared statement
+            filestore.execute_prepared(cursor, "test_escaped_percent", """
+                SELECT %s || '%%s', 'x%%' || %s, %s::TEXT LIKE 'ab%%'
+            """, ("a", "b", "abc"))
+            assert cursor.fetchone() == ("a%s", "x%b", True)
+        assert "test_escaped_percent" in conn.prepared
+    finally:
+        conn.close()
+
+
+def test_direct_mode(use_mode):
+    use_mode("direct", TEST_DATABASE_URL)
+    exercise()
+    assert {"count_link_click", "fetch_link"} <= prepared_statements()
+
+
+def test_transaction_mode_behind_pooler(use_mode, pooler):
+    use_mode("transaction", pooler.url)
+    switches = pooler.server_switches
+    exercise()
+    assert pooler.server_switches > switches, "the stand-in did not rotate server connections"
+
+
+def test_direct_mode_behind_pooler_fails(use_mode, pooler):
+    # Control: PREPAREd statements are lost when the next transaction lands on another server connection
+    use_mode("direct", pooler.url)
+    with pytest.raises((psycopg2.Error, AssertionError)):
+        exercise()
@@ -0,0 +1,252 @@
+# fake_bot_api.py - Local Telegram Bot API stand-in for benchmarks and load tests
+"""
+A small aiohttp server that speaks enough of the Bot API for FileStoreBot:
+getMe, getUpdates, getChat, the send* methods, sendMediaGroup, copyMessage,
+forwardMessage, edit*/answer* methods and deleteMessage.
+
+Latency and flood control (HTTP 429 with retry_after) can be injected so the
+bot's behaviour under a slow or rate-limited Telegram can be measured.
+
+Run standalone:
+    python tools/fake_bot_api.py --port 8081 --latency-ms 40 --flood-rate 0.01
+
+then point the bot at it with base_url http://127.0.0.1:8081/bot (see
+build_application in filecloudsupabaseX.py). Updates are injected with
+POST /control/updates (a JSON list of Update objects without update_id).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+BOT_USER = {"id": 100000, "is_bot": True, "first_name": "FakeBot", "username": "fake_filestore_bot"}
+
+MEDIA_METHODS = {
+    "sendPhoto": "photo",
+    "sendVideo": "video",
+    "sendDocument": "document",
+    "sendAudio": "audio",
+    "sendVoice": "voice",
+    "sendVideoNote": "video_note",
+}
+
+# Parameters that PTB sends JSON-encoded inside form fields
+JSON_FIELDS = {"reply_markup", "media", "entities", "caption_entities", "results", "allowed_updates", "button"}
+
+
+class FakeBotApi:
+    """In-memory Bot API with configurable latency and 429 injection."""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, flood_rate: float = 0.0, retry_after: int = 1):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+
+        self.updates = []
+        self._update_ids = itertools.count(1)
+        self._new_update = asyncio.Event()
+        self._message_ids = defaultdict(lambda: itertools.count(1))
+        self._file_ids = itertools.count(1)
+
+        self.calls = Counter()
+        self.floods = Counter()
+        self.sent = []  # (monotonic time, method, chat_id)
+        self._runner = None
+
+    # ---------------- control API ----------------
+
+    def push_update(self, update: dict) -> int:
+        """Queue an update for getUpdates and return its update_id"""
+        update = dict(update, update_id=next(self._update_ids))
+        self.updates.append(update)
+        self._new_update.set()
+        return update["update_id"]
+
+    def stats(self) -> dict:
+        return {
+            "calls": dict(self.calls),
+            "floods_injected": dict(self.floods),
+            "messages_sent": len(self.sent),
+            "pending_updates": len(self.updates),
+        }
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8081):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self._handle_method)
+        app.router.add_post("/control/updates", self._handle_push_updates)
+        app.router.add_get("/control/stats", self._handle_stats)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _handle_push_updates(self, request):
+        updates = await request.json()
+        ids = [self.push_update(update) for update in updates]
+        return web.json_response({"ok": True, "result": ids})
+
+    async def _handle_stats(self, request):
+        return web.json_response(self.stats())
+
+    # ---------------- Bot API ----------------
+
+    async def _handle_method(self, request):
+        method = request.match_info["method"]
+        params = await self._read_params(request)
+        self.calls[method] += 1
+
+        if method != "getUpdates":
+            delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+            if delay > 0:
+                await asyncio.sleep(delay / 1000)
+            if method.startswith(("send", "copy", "forward", "edit")) and random.random() < self.flood_rate:
+                self.floods[method] += 1
+                return web.json_response({
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }, status=429)
+
+        handler = getattr(self, f"_api_{method}", None)
+        if handler is None:
+            if method in MEDIA_METHODS:
+                result = self._send_media(MEDIA_METHODS[method], params)
+            else:
+                # Anything else (setMyCommands, answerCallbackQuery, ...) just succeeds
+                result = True
+        else:
+            result = await handler(params)
+        return web.json_response({"ok": True, "result": result})
+
+    async def _read_params(self, request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        form = await request.post()
+        params = {}
+        for key, value in form.items():
+            if not isinstance(value, str):
+                params[key] = "attached_file"  # Uploaded file bodies are not needed
+            elif key in JSON_FIELDS:
+                params[key] = json.loads(value)
+            else:
+                params[key] = value
+        return params
+
+    def _message(self, chat_id, **content) -> dict:
+        chat_id = int(chat_id)
+        self.sent.append((time.monotonic(), content.get("kind", "text"), chat_id))
+        content.pop("kind", None)
+        chat_type = "channel" if chat_id < 0 else "private"
+        return {
+            "message_id": next(self._message_ids[chat_id]),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": chat_type, "first_name": f"User {chat_id}"},
+            "from": BOT_USER,
+            **content,
+        }
+
+    def _file(self, file_id: str, kind: str) -> dict:
+        unique = f"uniq_{file_id[-16:]}"
+        if kind == "photo":
+            return [{"file_id": file_id, "file_unique_id": unique, "width": 1280, "height": 720, "file_size": 1024}]
+        obj = {"file_id": file_id, "file_unique_id": unique, "file_size": 1024}
+        if kind in ("video", "video_note", "audio", "voice"):
+            obj["duration"] = 1
+        if kind in ("video",):
+            obj.update(width=1280, height=720)
+        if kind == "video_note":
+            obj["length"] = 240
+        return obj
+
+    def _send_media(self, kind: str, params: dict) -> dict:
+        file_id = params.get(kind)
+        if not isinstance(file_id, str) or file_id == "attached_file":
+            file_id = f"fake_{kind}_{next(self._file_ids)}"
+        content = {kind: self._file(file_id, kind), "kind": kind}
+        if params.get("caption"):
+            content["caption"] = params["caption"]
+        return self._message(params["chat_id"], **content)
+
+    async def _api_getMe(self, params):
+        return BOT_USER
+
+    async def _api_getUpdates(self, params):
+        offset = int(params.get("offset", 0) or 0)
+        limit = int(params.get("limit", 100) or 100)
+        timeout = float(params.get("timeout", 0) or 0)
+
+        # Telegram semantics: an offset confirms every earlier update
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(self._new_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:limit]
+
+    async def _api_getChat(self, params):
+        chat_id = int(params["chat_id"])
+        if chat_id < 0:
+            return {"id": chat_id, "type": "channel", "title": f"Channel {chat_id}"}
+        return {"id": chat_id, "type": "private", "first_name": f"User {chat_id}", "username": f"user{chat_id}"}
+
+    async def _api_sendMessage(self, params):
+        return self._message(params["chat_id"], text=params.get("text", ""))
+
+    async def _api_sendMediaGroup(self, params):
+        messages = []
+        for item in params.get("media", []):
+            kind = item.get("type", "document")
+            messages.append(self._send_media(kind, {"chat_id": params["chat_id"], kind: item.get("media"),
+                                                    "caption": item.get("caption")}))
+        return messages
+
+    async def _api_copyMessage(self, params):
+        return {"message_id": self._message(params["chat_id"], text="copy", kind="copy")["message_id"]}
+
+    async def _api_forwardMessage(self, params):
+        return self._message(params["chat_id"], text="forwarded", kind="forward")
+
+    async def _api_editMessageText(self, params):
+        if "chat_id" not in params:
+            return True  # Inline message
+        return {**self._message(params["chat_id"], text=params.get("text", ""), kind="edit"),
+                "message_id": int(params["message_id"])}
+
+    async def _api_deleteMessage(self, params):
+        return True
+
+
+async def _serve(args):
+    api = FakeBotApi(args.latency_ms, args.jitter_ms, args.flood_rate, args.retry_after)
+    await api.start(args.host, args.port)
+    print(f"Fake Bot API listening on http://{args.host}:{args.port}/bot<token>/<method>")
+    while True:
+        await asyncio.sleep(30)
+        print(json.dumps(api.stats()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Telegram Bot API stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Added latency per API call")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Random +/- jitter on the latency")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="Probability of a 429 on send/edit calls")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after seconds reported with 429s")
+    asyncio.run(_serve(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+# fake_pooler.py - Local transaction-mode pooler stand-in (PgBouncer / Supavisor)
+"""
+A small asyncio proxy that pools Postgres server connections the way PgBouncer
+and Supavisor do with pool_mode = transaction: a client only holds a server
+connection while it is inside a transaction, and the next transaction may run
+on a different one. Session state (PREPARE, SET, LISTEN, session advisory
+locks) therefore does not follow the client, exactly as behind the real thing.
+
+Idle server connections are handed out oldest first, so consecutive
+transactions of one client rotate over the pool and session-state bugs show up
+reliably instead of by chance.
+
+Limitations: clients are not authenticated and the server must accept the
+configured user without a password (trust auth, as on a local test cluster);
+SSL, COPY and cancel requests are not supported.
+
+Run standalone:
+    python tools/fake_pooler.py --server-host /tmp --server-port 5432 --port 6543 --pool-size 2
+
+then connect with postgresql://postgres@127.0.0.1:6543/<database>.
+"""
+import argparse
+import asyncio
+import itertools
+import struct
+from collections import defaultdict, deque
+
+SSL_REQUEST = 80877103
+CANCEL_REQUEST = 80877102
+PROTOCOL_VERSION = 196608  # 3.0
+
+
+async def read_message(reader: asyncio.StreamReader):
+    """Read one regular protocol message, return (type byte, full message bytes)"""
+    header = await reader.readexactly(5)
+    length = struct.unpack("!I", header[1:])[0]
+    return header[:1], header + await reader.readexactly(length - 4)
+
+
+def message(kind: bytes, body: bytes = b"") -> bytes:
+    return kind + struct.pack("!I", len(body) + 4) + body
+
+
+class ServerConnection:
+    """One authenticated connection to the real server"""
+
+    def __init__(self, reader, writer, parameters: dict):
+        self.reader = reader
+        self.writer = writer
+        self.parameters = parameters
+
+    @classmethod
+    async def open(cls, host: str, port: int, user: str, database: str) -> "ServerConnection":
+        if host.startswith("/"):
+            reader, writer = await asyncio.open_unix_connection(f"{host}/.s.PGSQL.{port}")
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        body = struct.pack("!I", PROTOCOL_VERSION)
+        body += b"user\0" + user.encode() + b"\0database\0" + database.encode() + b"\0\0"
+        writer.write(struct.pack("!I", len(body) + 4) + body)
+        await writer.drain()
+
+        parameters = {}
+        while True:
+            kind, data = await read_message(reader)
+            if kind == b"R" and struct.unpack("!I", data[5:9])[0] != 0:
+                writer.close()
+                raise ConnectionError("the server asked for a password; the stand-in only supports trust auth")
+            if kind == b"E":
+                writer.close()
+                raise ConnectionError(data[5:].replace(b"\0", b" ").decode(errors="replace"))
+            if kind == b"S":
+                name, value = data[5:-1].split(b"\0", 1)
+                parameters[name] = value.rstrip(b"\0")
+            if kind == b"Z":
+                return cls(reader, writer, parameters)
+
+    def close(self):
+        self.writer.close()
+
+
+class FakePooler:
+    """Transaction-mode pooler: one pool of server connections per (user, database)"""
+
+    def __init__(self, server_host: str, server_port: int, pool_size: int = 2):
+        self.server_host = server_host
+        self.server_port = server_port
+        self.pool_size = pool_size
+        self.idle = defaultdict(deque)  # (user, database) -> idle ServerConnections, oldest first
+        self.open_count = defaultdict(int)
+        self.available = {}  # (user, database) -> asyncio.Condition
+        self.pids = itertools.count(10_000)
+        self.transactions = 0
+        self.server_switches = 0  # Client transactions that ran on a different server connection than the last one
+        self._server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 6543):
+        self._server = await asyncio.start_server(self._serve_client, host, port)
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        for connections in self.idle.values():
+            for connection in connections:
+                connection.close()
+
+    def stats(self) -> dict:
+        return {
+            "transactions": self.transactions,
+            "server_switches": self.server_switches,
+            "server_connections": sum(self.open_count.values()),
+        }
+
+    # ---------------- server pool ----------------
+
+    async def _acquire(self, key) -> ServerConnection:
+        condition = self.available.setdefault(key, asyncio.Condition())
+        async with condition:
+            while not self.idle[key] and self.open_count[key] >= self.pool_size:
+                await condition.wait()
+            if self.idle[key]:
+                return self.idle[key].popleft()
+            self.open_count[key] += 1
+        try:
+            return await ServerConnection.open(self.server_host, self.server_port, *key)
+        except Exception:
+            async with condition:
+                self.open_count[key] -= 1
+                condition.notify()
+            raise
+
+    async def _release(self, key, connection: ServerConnection, broken: bool = False):
+        condition = self.available[key]
+        async with condition:
+            if broken:
+                connection.close()
+                self.open_count[key] -= 1
+            else:
+                self.idle[key].append(connection)
+            condition.notify()
+
+    # ---------------- client sessions ----------------
+
+    async def _read_startup(self, reader, writer):
+        while True:
+            length = struct.unpack("!I", await reader.readexactly(4))[0]
+            payload = await reader.readexactly(length - 4)
+            code = struct.unpack("!I", payload[:4])[0]
+            if code == SSL_REQUEST:
+                writer.write(b"N")
+                await writer.drain()
+                continue
+            if code == CANCEL_REQUEST:
+                return None
+            fields = payload[4:].split(b"\0")
+            return dict(zip(fields[0::2], fields[1::2]))
+
+    async def _serve_client(self, reader, writer):
+        server = None
+        key = None
+        try:
+            startup = await self._read_startup(reader, writer)
+            if startup is None:
+                return
+            user = startup.get(b"user", b"postgres").decode()
+            key = (user, startup.get(b"database", user.encode()).decode())
+
+            # Borrow a server connection once for its parameters, then greet the client
+            server = await self._acquire(key)
+            parameters = server.parameters
+            await self._release(key, server)
+            server = None
+            greeting = message(b"R", struct.pack("!I", 0))
+            for name, value in parameters.items():
+                greeting += message(b"S", name + b"\0" + value + b"\0")
+            greeting += message(b"K", struct.pack("!II", next(self.pids), 0))
+            greeting += message(b"Z", b"I")
+            writer.write(greeting)
+            await writer.drain()
+
+            last_server = None
+            while True:
+                kind, data = await read_message(reader)
+                if kind == b"X":
+                    break
+                if server is None:
+                    server = await self._acquire(key)
+                    self.transactions += 1
+                    if last_server is not None and server is not last_server:
+                        self.server_switches += 1
+                    last_server = server
+                server.writer.write(data)
+                if kind not in (b"Q", b"S"):
+                    continue  # Extended protocol: the reply follows Sync
+                await server.writer.drain()
+                status = await self._relay_until_ready(server, writer)
+                if status == b"I":
+                    await self._release(key, server)
+                    server = None
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if server is not None:
+                await self._abandon(key, server)
+            writer.close()
+
+    async def _relay_until_ready(self, server: ServerConnection, writer) -> bytes:
+        """Forward server messages to the client up to ReadyForQuery, return its status"""
+        while True:
+            kind, data = await read_message(server.reader)
+            writer.write(data)
+            if kind == b"Z":
+                await writer.drain()
+                return data[5:6]
+
+    async def _abandon(self, key, server: ServerConnection):
+        """The client left inside a transaction: roll it back before reusing the connection"""
+        try:
+            server.writer.write(message(b"Q", b"ROLLBACK\0"))
+            await server.writer.drain()
+            while (await read_message(server.reader))[0] != b"Z":
+                pass
+            await self._release(key, server)
+        except Exception:
+            await self._release(key, server, broken=True)
+
+
+async def _serve(args):
+    pooler = FakePooler(args.server_host, args.server_port, args.pool_size)
+    await pooler.start(args.host, args.port)
+    print(f"Transaction pooler listening on {args.host}:{args.port}, "
+          f"{args.pool_size} server connection(s) per database")
+    while True:
+        await asyncio.sleep(30)
+        print(pooler.stats())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local transaction-mode pooler stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6543)
+    parser.add_argument("--server-host", default="localhost", help="Postgres host or Unix socket directory")
+    parser.add_argument("--server-port", type=int, default=5432)
+    parser.add_argument("--pool-size", type=int, default=2, help="Server connections per user/database")
+    asyncio.run(_serve(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
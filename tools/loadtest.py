@@ -0,0 +1,302 @@
+# loadtest.py - Replay synthetic traffic against FileStoreBot on a fake Bot API
+"""
+Runs FileStoreBot in-process against tools/fake_bot_api.py and a local
+Postgres, replays synthetic traffic and reports throughput and p50/p95/p99
+latency per path:
+
+  deep_link_file   /start <file link code> from many distinct users
+  deep_link_group  /start <group link code> (full group delivery)
+  bulk_upload      /bulkupload sessions: documents followed by Finish Upload
+  callback         button presses (menus, group views, file lists, links)
+
+Latency is measured from the moment an update is queued on the fake server
+until the bot has finished handling it, so it includes polling and per-user
+ordering waits.
+
+Example (never point this at production, it writes seed data):
+    python tools/loadtest.py --database-url postgresql://postgres@localhost/filestore_load \\
+        --deep-links 500 --group-link-ratio 0.2 --bulk-uploaders 5 --bulk-files 20 \\
+        --callbacks 500 --rate 200 --latency-ms 30 --flood-rate 0.01 --json bench_output.json
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fake_bot_api import FakeBotApi, BOT_USER  # noqa: E402
+
+LOADTEST_TOKEN = "123456:LOADTEST"
+OWNER_ID = 1000
+
+
+def load_bot_module(args):
+    """Import the bot with configuration that points at the local stand-ins"""
+    os.environ["BOT_TOKEN"] = LOADTEST_TOKEN
+    os.environ["SUPABASE_URL"] = args.database_url
+    os.environ.setdefault("STORAGE_CHANNEL_ID", "-1000000000001")
+    os.environ.setdefault("BOT_USERNAME", BOT_USER["username"])
+    os.environ.setdefault("ADMIN_IDS", "1,2")
+    os.environ.setdefault("ADMIN_CONTACT", "@loadtest")
+    module = importlib.import_module("filecloudsupabaseX")
+    module.BULK_UPLOAD_DELAY = args.bulk_delay
+    if not args.verbose:
+        module.logger.setLevel(logging.WARNING)
+    return module
+
+
+def seed_database(bot_module, args) -> dict:
+    """Create uploaders, one popular group with links, and return the codes to hit"""
+    import psycopg2
+
+    run_tag = bot_module.generate_id()[:6]
+    conn = psycopg2.connect(args.database_url)
+    cursor = conn.cursor()
+    uploaders = [OWNER_ID + i for i in range(max(args.bulk_uploaders, args.callback_users, 1))]
+    for user_id in uploaders:
+        cursor.execute("""
+            INSERT INTO authorized_users (user_id, username, first_name, added_by, is_active)
+            VALUES (%s, %s, %s, 1, 1) ON CONFLICT (user_id) DO NOTHING
+        """, (user_id, f"loaduser{user_id}", f"Load {user_id}"))
+
+    cursor.execute("""
+        INSERT INTO groups (name, owner_id) VALUES (%s, %s) RETURNING id
+    """, (f"load-{run_tag}", OWNER_ID))
+    group_id = cursor.fetchone()[0]
+
+    file_ids = []
+    for serial in range(1, args.group_size + 1):
+        cursor.execute("""
+            INSERT INTO files (group_id, serial_number, unique_id, file_name, file_type, file_size,
+                               telegram_file_id, uploader_id, storage_channel_id, storage_message_id)
+            VALUES (%s, %s, %s, %s, 'document', 1024, %s, %s, %s, %s) RETURNING id
+        """, (group_id, serial, bot_module.generate_id(), f"seed_{run_tag}_{serial}.bin",
+              f"fake_document_seed_{run_tag}_{serial}", OWNER_ID, bot_module.STORAGE_CHANNEL_ID, serial))
+        file_ids.append(cursor.fetchone()[0])
+
+    group_code = bot_module.generate_id()
+    file_code = bot_module.generate_id()
+    cursor.execute("""
+        INSERT INTO file_links (link_code, link_type, group_id, owner_id, is_active) VALUES (%s, 'group', %s, %s, 1)
+    """, (group_code, group_id, OWNER_ID))
+    cursor.execute("""
+        INSERT INTO file_links (link_code, link_type, file_id, owner_id, is_active) VALUES (%s, 'file', %s, %s, 1)
+    """, (file_code, file_ids[0], OWNER_ID))
+    conn.commit()
+    conn.close()
+    return {"run_tag": run_tag, "group_id": group_id, "group_code": group_code, "file_code": file_code,
+            "uploaders": uploaders}
+
+
+class Traffic:
+    """Builds synthetic Telegram updates"""
+
+    def __init__(self):
+        self._message_ids = 0
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "username": f"user{user_id}"}
+
+    def _message(self, user_id, **content):
+        self._message_ids += 1
+        return {"message_id": self._message_ids, "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id), **content}
+
+    def command(self, user_id, text):
+        command = text.split()[0]
+        return {"message": self._message(user_id, text=text,
+                                         entities=[{"type": "bot_command", "offset": 0, "length": len(command)}])}
+
+    def document(self, user_id, name):
+        return {"message": self._message(user_id, document={
+            "file_id": f"upload_{name}", "file_unique_id": f"uniq_{name}", "file_name": f"{name}.bin", "file_size": 2048,
+        })}
+
+    def callback(self, user_id, data):
+        self._message_ids += 1
+        message = {"message_id": self._message_ids, "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"}, "from": BOT_USER, "text": "menu"}
+        return {"callback_query": {"id": str(self._message_ids), "from": self._user(user_id),
+                                   "chat_instance": str(user_id), "data": data, "message": message}}
+
+
+def build_schedule(args, seed) -> list:
+    """Return [(path, update)] in injection order; bulk sessions keep their own order"""
+    traffic = Traffic()
+    independent = []
+    for _ in range(args.deep_links):
+        user_id = random.randint(10_000_000, 99_999_999)
+        if random.random() < args.group_link_ratio:
+            independent.append(("deep_link_group", traffic.command(user_id, f"/start {seed['group_code']}")))
+        else:
+            independent.append(("deep_link_file", traffic.command(user_id, f"/start {seed['file_code']}")))
+
+    choices = ["main_menu", "cmd_groups", "cmd_links", f"view_group_id_{seed['group_id']}",
+               f"list_files_group_{seed['group_id']}"]
+    for _ in range(args.callbacks):
+        independent.append(("callback", traffic.callback(random.choice(seed["uploaders"]), random.choice(choices))))
+    random.shuffle(independent)
+
+    # Interleave each uploader's ordered session into the shuffled stream
+    schedule = independent
+    for user_id in seed["uploaders"][:args.bulk_uploaders]:
+        session = [("bulk_upload", traffic.command(user_id, f"/bulkupload bulk-{seed['run_tag']}-{user_id}"))]
+        session += [("bulk_upload", traffic.document(user_id, f"{seed['run_tag']}_{user_id}_{i}"))
+                    for i in range(args.bulk_files)]
+        session.append(("bulk_upload", traffic.callback(user_id, "finish_bulk")))
+        positions = sorted(random.randint(0, len(schedule)) for _ in session)
+        merged, cursor = [], 0
+        for position, item in zip(positions, session):
+            merged.extend(schedule[cursor:position])
+            merged.append(item)
+            cursor = position
+        merged.extend(schedule[cursor:])
+        schedule = merged
+    return schedule
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def build_report(injected, completed, api, elapsed) -> dict:
+    per_path = defaultdict(list)
+    first_inject = defaultdict(lambda: float("inf"))
+    last_done = defaultdict(float)
+    for update_id, (path, started) in injected.items():
+        first_inject[path] = min(first_inject[path], started)
+        if update_id in completed:
+            per_path[path].append((completed[update_id] - started) * 1000)
+            last_done[path] = max(last_done[path], completed[update_id])
+
+    paths = {}
+    for path in sorted({p for p, _ in injected.values()}):
+        latencies = per_path[path]
+        window = max(last_done[path] - first_inject[path], 1e-9)
+        paths[path] = {
+            "injected": sum(1 for p, _ in injected.values() if p == path),
+            "completed": len(latencies),
+            "throughput_per_s": round(len(latencies) / window, 2) if latencies else 0.0,
+            "p50_ms": round(percentile(latencies, 50), 1),
+            "p95_ms": round(percentile(latencies, 95), 1),
+            "p99_ms": round(percentile(latencies, 99), 1),
+            "max_ms": round(max(latencies), 1) if latencies else 0.0,
+        }
+    return {"elapsed_s": round(elapsed, 2), "paths": paths, "api": api.stats()}
+
+
+def print_report(report):
+    print(f"\nLoad test finished in {report['elapsed_s']}s\n")
+    print(f"{'path':<18}{'done':>12}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for path, row in report["paths"].items():
+        done = f"{row['completed']}/{row['injected']}"
+        print(f"{path:<18}{done:>12}{row['throughput_per_s']:>10}{row['p50_ms']:>10}"
+              f"{row['p95_ms']:>10}{row['p99_ms']:>10}{row['max_ms']:>10}")
+    print(f"\nBot API calls: {report['api']['calls']}")
+    print(f"429s injected: {report['api']['floods_injected']}")
+
+
+async def run(args) -> dict:
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    bot_module = load_bot_module(args)
+    api = FakeBotApi(args.latency_ms, args.jitter_ms, args.flood_rate, args.retry_after)
+    await api.start("127.0.0.1", args.port)
+
+    application = bot_module.build_application(LOADTEST_TOKEN, base_url=f"http://127.0.0.1:{args.port}/bot")
+    bot = bot_module.FileStoreBot(application)
+    bot_module.register_handlers(application, bot)
+    await bot.warm_up()  # Schema and caches before seeding; the bot would do this in post_init
+
+    injected = {}   # update_id -> (path, monotonic time queued)
+    completed = {}  # update_id -> monotonic time handled
+    all_done = asyncio.Event()
+
+    async def record_done(update, context):
+        completed[update.update_id] = time.monotonic()
+        if len(completed) >= len(schedule):
+            all_done.set()
+
+    # Group 100 runs after the bot's own handlers have finished with the update
+    application.add_handler(TypeHandler(Update, record_done), group=100)
+
+    seed = seed_database(bot_module, args)
+    schedule = build_schedule(args, seed)
+
+    started = time.monotonic()
+    async with application:
+        await application.start()
+        await application.updater.start_polling(poll_interval=0.0, timeout=2)
+
+        interval = 1.0 / args.rate if args.rate > 0 else 0.0
+        for path, update in schedule:
+            update_id = api.push_update(update)
+            injected[update_id] = (path, time.monotonic())
+            if interval:
+                await asyncio.sleep(interval)
+
+        try:
+            await asyncio.wait_for(all_done.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            print(f"Timed out with {len(schedule) - len(completed)} update(s) still in flight")
+
+        await application.updater.stop()
+        await application.stop()
+
+    elapsed = time.monotonic() - started
+    await api.stop()
+    return build_report(injected, completed, api, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FileStoreBot load generator")
+    parser.add_argument("--database-url", default=os.environ.get("LOADTEST_DATABASE_URL"),
+                        help="Local Postgres DSN (never production)")
+    parser.add_argument("--port", type=int, default=8081, help="Port for the fake Bot API")
+    parser.add_argument("--deep-links", type=int, default=300)
+    parser.add_argument("--group-link-ratio", type=float, default=0.2)
+    parser.add_argument("--group-size", type=int, default=20, help="Files in the seeded group")
+    parser.add_argument("--bulk-uploaders", type=int, default=3)
+    parser.add_argument("--bulk-files", type=int, default=20, help="Files per bulk session")
+    parser.add_argument("--bulk-delay", type=float, default=0.0, help="Override BULK_UPLOAD_DELAY")
+    parser.add_argument("--callbacks", type=int, default=300)
+    parser.add_argument("--callback-users", type=int, default=20, help="Distinct users pressing buttons")
+    parser.add_argument("--rate", type=float, default=200.0, help="Updates injected per second (0 = all at once)")
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--flood-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=300.0, help="Seconds to wait for in-flight updates")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for a reproducible schedule")
+    parser.add_argument("--json", help="Write the report to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Keep the bot's INFO logging")
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error("--database-url (or LOADTEST_DATABASE_URL) is required")
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2))
+        print(f"Report written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()